@@ -8,7 +8,11 @@ from dotenv import load_dotenv
 
 
 import static.common as com
+import static.members as members
+import static.visibility as visibility
+from static.edit_scheduler import scheduler
 import data.databaseapi as db
+from data.config import configs
 
 logging.basicConfig(level=logging.INFO)
 
@@ -20,8 +24,16 @@ if DEBUG:
     from asyncio import set_event_loop_policy, WindowsSelectorEventLoopPolicy
     set_event_loop_policy(WindowsSelectorEventLoopPolicy())
 
+class Urnby(discord.Bot):
+    async def close(self):
+        await scheduler.close()
+        await super().close()
+        # Flushes the buffered command log before the connections go away
+        await db.close_database()
+        print(f"{com.get_current_iso()} - Database closed", flush=True)
+
 intents = discord.Intents.default()
-UrnbyBot = discord.Bot(intents=intents)
+UrnbyBot = Urnby(intents=intents)
 
 cogs_list = [
     'clocks',
@@ -36,7 +48,20 @@ cogs_list = [
 @UrnbyBot.event
 async def on_ready():
     await db.init_database()
+    await configs.load()
     print(f"{com.get_current_iso()} - {UrnbyBot.user} is online!", flush=True)
+
+# Bot wide command log, entries are buffered and written in batches by databaseapi.command_log
+@UrnbyBot.before_invoke
+async def log_command(ctx):
+    guild_id = 0
+    if ctx.guild:
+        guild_id = ctx.guild.id
+    now_iso = com.get_current_iso()
+    print(f'{now_iso} [{guild_id}] - Command {ctx.command.qualified_name} by {ctx.author.name} - {ctx.author.id} - {ctx.selected_options}', flush=True)
+    channel_name = ctx.channel.name if ctx.guild else 'DM'
+    command = {'command_name': ctx.command.qualified_name, 'options': str(ctx.selected_options), 'datetime': now_iso, 'user': ctx.author.id, 'user_name': ctx.author.name, 'channel_name': channel_name}
+    await db.store_command(guild_id, command)
 '''
 @UrnbyBot.command()
 @commands.is_owner()
@@ -60,6 +85,11 @@ async def ownerrestart(ctx):
     print('Cogs restarted')
     await ctx.send_response(content="Restarted!")
 '''
+# Member directory invalidation, on_guild_remove
+members.register(UrnbyBot)
+# Channel visibility verdicts, dropped on channel / role / config changes
+visibility.register(UrnbyBot)
+
 for cog in cogs_list:
     UrnbyBot.load_extension(f'cogs.{cog}')
 
@@ -1,19 +1,16 @@
 from discord.ext import commands
-import json
+
+from data.config import configs
 
 class NotCommandChannel(commands.CheckFailure):
     pass
 
-@staticmethod
-def get_config():
-    return json.load(open('data/config.json', 'r', encoding='utf-8'))
-
 def is_command_channel():
     async def predicate(ctx):
         if ctx.guild is None:
             return NotCommandChannel()
-        config = get_config()
-        if ctx.channel_id in config[str(ctx.guild.id)]['command_channels']:
+        config = configs.get(ctx.guild.id)
+        if config and ctx.channel_id in config.command_channels:
             return True
         raise NotCommandChannel()
     return commands.check(predicate)
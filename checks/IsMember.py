@@ -1,25 +1,24 @@
 from discord.ext import commands
 import discord 
-import json
+
+from data.config import configs
+from static.members import roles
 
 class NotMember(commands.CheckFailure):
     pass
 
-@staticmethod
-def get_config():
-    return json.load(open('data/config.json', 'r', encoding='utf-8'))
-
 def is_member():
     async def predicate(ctx):
         if ctx.guild is None:
             return False
-        allowed_member_roles = get_config()[str(ctx.guild.id)]['member_roles']
-        
-        author_member = await ctx.guild.fetch_member(ctx.author.id)
-        author_roles = author_member.roles
-        for role in author_roles:
-            if role.id in allowed_member_roles:
-                return True
+        config = configs.get(ctx.guild.id)
+        if not config:
+            raise NotMember
+        # The interaction payload carries the author's current roles, the directory is only a fallback
+        author = ctx.author if isinstance(ctx.author, discord.Member) else ctx.author.id
+        author_roles = await roles.role_ids(ctx.guild, author)
+        if author_roles.intersection(config.member_roles):
+            return True
             
         raise NotMember
     return commands.check(predicate)
@@ -1,30 +1,23 @@
 from discord.ext import commands
 import discord 
-import json
+
+from data.config import configs
+from static.visibility import visibility
 
 class NotMemberVisible(commands.CheckFailure):
     pass
 
-@staticmethod
-def get_config():
-    return json.load(open('data/config.json', 'r', encoding='utf-8'))
-
 def is_member_visible():
     async def predicate(ctx):
         # Can not be DMs
         if ctx.guild is None:
             raise NotMemberVisible
         
-        member_roles = get_config()[str(ctx.guild.id)]['member_roles']
-        for role in member_roles:
-            _role = ctx.guild.get_role(role)
-            channel_perms = ctx.channel.permissions_for(_role)
-            
-            req_perms = discord.Permissions.none()
-            req_perms.update(read_messages = True) 
-            req_perms.update(read_message_history = True)
-            if not channel_perms.is_superset(req_perms):
-                raise NotMemberVisible
+        config = configs.get(ctx.guild.id)
+        if not config:
+            raise NotMemberVisible
+        if not visibility.visible(ctx.guild, ctx.channel, config.member_roles):
+            raise NotMemberVisible
             
         return True
     return commands.check(predicate)
@@ -9,6 +9,9 @@ from discord.ext import commands
 # Internal
 import data.databaseapi as db
 import static.common as com
+from static.members import directory
+from static.events import publish_guild_change
+from static.locks import guild_locks
 from checks.IsAdmin import is_admin, NotAdmin
 from checks.IsCommandChannel import is_command_channel, NotCommandChannel
 from checks.IsMemberVisible import is_member_visible, NotMemberVisible
@@ -30,6 +33,13 @@ class CampQueue(commands.Cog):
     
     rep_group = discord.commands.SlashCommandGroup('rep')
     
+    # Commands that change the replacement queue, listeners such as the dashboard re-render on these
+    STATE_COMMANDS = {'rep add', 'rep remove', 'repclear'}
+
+    async def cog_after_invoke(self, ctx):
+        if ctx.guild and ctx.command.qualified_name in self.STATE_COMMANDS:
+            publish_guild_change(self.bot, ctx.guild.id, ctx.command.qualified_name)
+    
     @commands.Cog.listener()
     async def on_connect(self):
         print(f'campqueue connected to discord')
@@ -40,15 +50,6 @@ class CampQueue(commands.Cog):
         if missing_tables:
             print(f"Warning, missing the following tables in db: {missing_tables}")
     
-    async def cog_before_invoke(self, ctx):
-        guild_id = 0
-        if ctx.guild:
-            guild_id = ctx.guild.id
-        now_iso = com.get_current_iso()
-        print(f'{now_iso} [{guild_id}] - Command {ctx.command.qualified_name} by {ctx.author.name} - {ctx.author.id} - {ctx.selected_options}', flush=True)
-        command = {'command_name': ctx.command.qualified_name, 'options': str(ctx.selected_options), 'datetime': now_iso, 'user': ctx.author.id, 'user_name': ctx.author.name, 'channel_name': ctx.channel.name}
-        await db.store_command(guild_id, command)
-        return
     ''' Removing for superfluousness
     
     # ========================
@@ -150,15 +151,16 @@ class CampQueue(commands.Cog):
             'in_timestamp': com.get_current_timestamp(),
         }
         
-        if not await db.get_session(ctx.guild.id):
-            await ctx.send_response(content=f'There is no session to queue up for')
-            return
+        async with guild_locks.hold(ctx.guild.id, 'rep add'):
+            if not await db.get_session(ctx.guild.id):
+                await ctx.send_response(content=f'There is no session to queue up for')
+                return
 
-        if await db.is_user_active(ctx.guild.id, userid):
-            await ctx.send_response(content=f'{display_name} is already clocked in')
-            return
+            if await db.is_user_active(ctx.guild.id, userid):
+                await ctx.send_response(content=f'{display_name} is already clocked in')
+                return
         
-        added = await db.add_replacement(ctx.guild.id, rep)
+            added = await db.add_replacement(ctx.guild.id, rep)
         if not added:
             await ctx.send_response(content=f'{display_name} is already in queue')
             return
@@ -174,7 +176,8 @@ class CampQueue(commands.Cog):
         userid, display_name = await get_userid_and_name(ctx, userid)
         if not userid:
             return
-        removed = await db.remove_replacement(ctx.guild.id, userid)
+        async with guild_locks.hold(ctx.guild.id, 'rep remove'):
+            removed = await db.remove_replacement(ctx.guild.id, userid)
         if removed is None:
             await ctx.send_response(content=f'User is not in queue')
             return
@@ -212,7 +215,8 @@ class CampQueue(commands.Cog):
     @is_admin()
     @is_command_channel()
     async def _adminrepclear(self, ctx):
-        res = await db.clear_replacement_queue(ctx.guild.id)
+        async with guild_locks.hold(ctx.guild.id, 'repclear'):
+            res = await db.clear_replacement_queue(ctx.guild.id)
         if res is None:
             await ctx.send_response(content=f'Problem occured while clearing camp queue.')
             return
@@ -237,14 +241,14 @@ async def get_userid_and_name(ctx, param) -> int:
     # Try userid for int interpretation
     ret = {'result': None, 'type': MemberQueryResult.QUERY_FAILED}
     try:
-        int(param)
-        res = await ctx.guild.fetch_member(int(param))
-        ret = {'result': res, 'type': MemberQueryResult.FOUND}
+        res = await directory.fetch(ctx.guild, int(param))
+        if res:
+            ret = {'result': res, 'type': MemberQueryResult.FOUND}
+        else:
+            ret = {'result': None, 'type': MemberQueryResult.ID_NOT_FOUND}
     except (ValueError, TypeError) as err:
         # Failed int parsing
         pass 
-    except discord.errors.NotFound:
-        ret = {'result': None, 'type': MemberQueryResult.ID_NOT_FOUND}
     if not ret['result']:
         # try querying string for member
         try:
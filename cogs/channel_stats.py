@@ -1,7 +1,5 @@
 # Builtin
-import json
 import datetime
-import os
 import re
 
 # External
@@ -10,24 +8,23 @@ from discord.ext import commands, tasks
 
 # Internal
 import static.common as com
+from static.members import directory
+from static.edit_scheduler import scheduler
 import data.databaseapi as db
+from data.config import configs
 
-# Can only change channel name twice every 10 minutes
+# Channel renames are limited to twice every 10 minutes, the edit scheduler holds them back until allowed
+# and only sends the latest name, so the loop can declare names more often than that
 REFRESH_TYPE = 'seconds'
-REFRESH_TIME = 360
+REFRESH_TIME = 120
 
 CAMP_HOURS_TILL_DS = 18
 
-DEBUG = os.getenv('DEBUG')
-if DEBUG:
-    REFRESH_TIME = 360
-    
 class Channel_Stats(commands.Cog):
     
     def __init__(self, bot):
         self.bot = bot
         self.printer.start()
-        self.last_data = {}
         print('Initilization on channel stats complete')
         
     @commands.Cog.listener()
@@ -52,95 +49,84 @@ class Channel_Stats(commands.Cog):
         for guild in self.bot.guilds:
             if not self.guild_have_manage_channels(guild):
                 continue
-            config = get_config(guild.id)
-            if not config or not config.get('channel_stats'):
+            config = configs.get(guild.id)
+            if not config or not config.channel_stats:
                 continue
             print(f"{com.get_current_iso()} [{guild.id}] - Refreshing channel stats")
-            l = len(config['channel_stats'])
-            
-            users = await db.get_unique_users(guild.id)
-            
-            res = await db.get_users_hours(guild.id, users, limit = l)
-            def ordinal(n: int):
-                if 11 <= (n % 100) <= 13:
-                    suffix = 'th'
-                else:
-                    suffix = ['th', 'st', 'nd', 'rd', 'th'][min(n % 10, 4)]
-                return str(n) + suffix
-            if res != self.last_data.get(guild.id):
-                self.last_data[guild.id] = res
-                for idx, chan in enumerate(config['channel_stats']):
-                    try:
-                        member = await guild.fetch_member(res[idx]['user'])
-                    except discord.errors.NotFound:
-                        member = None
-                    disp = 'placehold'
-                    if member:
-                        disp = member.display_name
-                        nonletter = re.search(r'[^\w]', disp)
-                        if nonletter:
-                            disp = disp[:nonletter.start()]
-                    name = f"{ordinal(idx+1)} {disp[:10]} - {res[idx]['total']}"
-                    channel = None
-                    for g_chan in guild.channels:
-                        if g_chan.id == chan:
-                            channel = g_chan
-                    if not channel:
-                        continue
-                    print(f'{com.get_current_iso()} [{guild.id}] - Setting channel {channel.name} to {name}')
-                    await channel.edit(name=name)
-                
-            now = com.get_current_datetime()
-            tod_dict = await db.get_tod(guild.id, mob_name="Drusella Sathir")
-            mins_till_ds = -1
-            mins_till_ds_str = "Unknown ToD"
-            if tod_dict:
-                tod_datetime = com.datetime_from_timestamp(tod_dict['tod_timestamp']) + datetime.timedelta(days=1)
-                mins_till_ds = int((tod_datetime - now).total_seconds()/com.SECS_IN_MINUTE)
-                if mins_till_ds < 0:
-                    mins_till_ds_str = "Unknown ToD"
-                else:
-                    mins_till_ds_str = f'DS in: {mins_till_ds:4}mins'
-            channel = None
-            if config.get('countdown_stats'):
-                channel = next((c for c in guild.channels if c.id == config['countdown_stats']), None)
-                if channel and channel.name != mins_till_ds_str and channel.permissions_for(guild.get_member(self.bot.user.id)).manage_channels:
-                    print(f'{com.get_current_iso()} [{guild.id}] - Setting channel {channel.name} to {mins_till_ds_str}')
-                    await channel.edit(name=mins_till_ds_str)
-            channel = None
-            if config.get('campstatus_stats'):
-                _open = "<CLOSED"
-                if mins_till_ds >= 0 and mins_till_ds <= com.MINUTE_IN_HOUR * get_config(guild.id).get("camp_hour_count", 18):
-                    _open = "<OPEN"
-                if mins_till_ds < 0:
-                    _open = "<UNKNOWN"
-                ses = await db.get_session(guild.id)
-                if ses:
-                    _open += "+ACTIVE"                
-                _open += ">"
-                channel = next((c for c in guild.channels if c.id == config['campstatus_stats']), None)
-                if channel and channel.name != _open and channel.permissions_for(guild.get_member(self.bot.user.id)).manage_channels:
-                    print(f'{com.get_current_iso()} [{guild.id}] - Setting channel {channel.name} to {_open}')
-                    await channel.edit(name=_open)
-            channel = None
-            if config.get('active_stats') and config.get('max_active'):
-                _max = config.get('max_active')
-                actives = await db.get_all_actives(guild.id)
-                
-                _current = len(actives)
-                s = f'Actives {_current}/{_max}'
-                reps = await db.get_replacement_queue(guild.id)
-                if reps:
-                    s += f'+{len(reps)}'
-                channel = next((c for c in guild.channels if c.id == config['active_stats']), None)
-                if channel and channel.name != s and channel.permissions_for(guild.get_member(self.bot.user.id)).manage_channels:
-                    print(f'{com.get_current_iso()} [{guild.id}] - Setting channel {channel.name} to {s}')
-                    await channel.edit(name=s)
-            
+            desired = await self.plan_names(guild, config)
+            self.apply_names(guild, desired)
+
+    # Every stats channel name the guild should show, as {channel_id: name}
+    async def plan_names(self, guild, config) -> dict:
+        desired = {}
+        top = await db.get_top_users_hours(guild.id, len(config.channel_stats))
+        ranked_members = await directory.fetch_many(guild, [item['user'] for item in top])
+        for idx, (chan, item) in enumerate(zip(config.channel_stats, top)):
+            member = ranked_members.get(int(item['user']))
+            disp = 'placehold'
+            if member:
+                disp = member.display_name
+                nonletter = re.search(r'[^\w]', disp)
+                if nonletter:
+                    disp = disp[:nonletter.start()]
+            desired[chan] = f"{ordinal(idx+1)} {disp[:10]} - {item['total']}"
+
+        now = com.get_current_datetime()
+        tod_dict = await db.get_tod(guild.id, mob_name="Drusella Sathir")
+        mins_till_ds = -1
+        mins_till_ds_str = "Unknown ToD"
+        if tod_dict:
+            tod_datetime = com.datetime_from_timestamp(tod_dict['tod_timestamp']) + datetime.timedelta(days=1)
+            mins_till_ds = int((tod_datetime - now).total_seconds()/com.SECS_IN_MINUTE)
+            if mins_till_ds < 0:
+                mins_till_ds_str = "Unknown ToD"
+            else:
+                mins_till_ds_str = f'DS in: {mins_till_ds:4}mins'
+        if config.countdown_stats:
+            desired[config.countdown_stats] = mins_till_ds_str
+
+        if config.campstatus_stats:
+            _open = "<CLOSED"
+            if mins_till_ds >= 0 and mins_till_ds <= com.MINUTE_IN_HOUR * config.camp_hour_count:
+                _open = "<OPEN"
+            if mins_till_ds < 0:
+                _open = "<UNKNOWN"
+            ses = await db.get_session(guild.id)
+            if ses:
+                _open += "+ACTIVE"
+            _open += ">"
+            desired[config.campstatus_stats] = _open
+
+        if config.active_stats and config.max_active:
+            actives = await db.get_all_actives(guild.id)
+            s = f"Actives {len(actives)}/{config.max_active}"
+            reps = await db.get_replacement_queue(guild.id)
+            if reps:
+                s += f'+{len(reps)}'
+            desired[config.active_stats] = s
+        return desired
+
+    # Rename only the channels whose name differs from the plan
+    def apply_names(self, guild, desired):
+        me = guild.get_member(self.bot.user.id)
+        for channel_id, name in desired.items():
+            channel = guild.get_channel(channel_id)
+            if not channel or not channel.permissions_for(me).manage_channels:
+                continue
+            if channel.name == name:
+                # Back to the current name, drop any rename still waiting in the scheduler
+                scheduler.cancel(channel)
+                continue
+            print(f'{com.get_current_iso()} [{guild.id}] - Setting channel {channel.name} to {name}')
+            scheduler.submit(channel, guild.id, name=name)
+
+def ordinal(n: int):
+    if 11 <= (n % 100) <= 13:
+        suffix = 'th'
+    else:
+        suffix = ['th', 'st', 'nd', 'rd', 'th'][min(n % 10, 4)]
+    return str(n) + suffix
 
-def get_config(guild_id):
-    return json.load(open('data/config.json', 'r', encoding='utf-8')).get(str(guild_id))
-        
 
 def setup(bot):
     bot.add_cog(Channel_Stats(bot))
\ No newline at end of file
@@ -1,10 +1,8 @@
 # Builtin
 import datetime
-import json
-import asyncio
-import copy
+import os
+import sqlite3
 from enum import Enum
-from pathlib import Path
 
 # External
 import discord
@@ -13,7 +11,13 @@ from aiosqlite import OperationalError
 
 # Internal
 import data.databaseapi as db
+import data.export as export
+from data.config import configs
 import static.common as com
+import static.bonus as bonus
+from static.members import directory
+from static.events import publish_guild_change
+from static.locks import guild_locks
 from views.SkipQueueView import SkipQueueView
 from views.ClearOutView import ClearOutView
 from checks.IsAdmin import is_admin, NotAdmin
@@ -40,7 +44,6 @@ class MemberQueryResult(Enum):
 class Clocks(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.state_lock = asyncio.Lock()
         
         print('Initilization on clocks complete', flush=True)
         
@@ -48,6 +51,15 @@ class Clocks(commands.Cog):
     get_group = discord.commands.SlashCommandGroup('get')
     session_group = discord.commands.SlashCommandGroup('session')
     
+    # Commands that change session, actives or hours, listeners such as the dashboard re-render on these
+    STATE_COMMANDS = {'clockin', 'clockout', 'Clockout User', 'session start', 'session end', 'urn',
+                      'admin directurn', 'admin changehistory', 'admin directrecord', 'admin reloadstate',
+                      'admin recomputebonus'}
+
+    async def cog_after_invoke(self, ctx):
+        if ctx.guild and ctx.command.qualified_name in self.STATE_COMMANDS:
+            publish_guild_change(self.bot, ctx.guild.id, ctx.command.qualified_name)
+
     @commands.Cog.listener()
     async def on_ready(self):
         missing_tables = await db.check_tables(['historical', 'session', 'session_history', 'active', 'commands'])
@@ -56,15 +68,6 @@ class Clocks(commands.Cog):
         #saving for example to get handle on other cogs
         #self.cq = self.bot.get_cog('CampQueue')
     
-    async def cog_before_invoke(self, ctx):
-        guild_id = 0
-        if ctx.guild:
-            guild_id = ctx.guild.id
-        now_iso = com.get_current_iso()
-        print(f'{now_iso} [{guild_id}] - Command {ctx.command.qualified_name} by {ctx.author.name} - {ctx.author.id} - {ctx.selected_options}', flush=True)
-        command = {'command_name': ctx.command.qualified_name, 'options': str(ctx.selected_options), 'datetime': now_iso, 'user': ctx.author.id, 'user_name': ctx.author.name, 'channel_name': ctx.channel.name}
-        await db.store_command(guild_id, command)
-        return
     
     # ==============================================================================
     # Error Handlers
@@ -131,7 +134,7 @@ class Clocks(commands.Cog):
         if ctx.guild is None:
             await ctx.send_response(content='This command can not be used in Direct Messages')
             return
-        config = self.get_config(ctx.guild.id)
+        config = configs.raw(ctx.guild.id)
         await ctx.send_response(content=f"{config}", ephemeral=not public)
     
     # ==============================================================================
@@ -146,10 +149,12 @@ class Clocks(commands.Cog):
             await ctx.send_response(content=f"There are no active users at this time", ephemeral=not public)
             return
         content = "_ _\nActive Users:\n```"
+        active_members = await directory.fetch_many(ctx.guild, [active['user'] for active in actives])
         for active in actives:
-            user = await ctx.guild.fetch_member(active['user'])
+            user = active_members.get(int(active['user']))
+            name = user.display_name if user else str(active['user'])
             delta = com.get_hours_from_secs(timestamp_now - active['in_timestamp'])
-            content += f"\n{user.display_name[:19]:20}{delta:.2f} hours active"
+            content += f"\n{name[:19]:20}{delta:.2f} hours active"
         content += "```"
         await ctx.send_response(content=content, ephemeral=not public)
     
@@ -158,81 +163,83 @@ class Clocks(commands.Cog):
     @is_member_visible()
     @is_command_channel()
     async def _clockin(self, ctx):
-        # Session Check
-        session = await db.get_session(ctx.guild.id)
-        if not session:
-            await ctx.send_response(content=f'Sorry, there is no current session to clock into')
-            return
-        # Already active check
-        actives = await db.get_all_actives(ctx.guild.id)
-        
-        for active in actives:
-            if active['user'] == ctx.author.id:
-                await ctx.send_response(content=f'You are already active, did you mean to clockout?')
+        # Checks and the insert run under the guild lock so a double clockin can't store two actives
+        async with guild_locks.hold(ctx.guild.id, 'clockin'):
+            # Session Check
+            session = await db.get_session(ctx.guild.id)
+            if not session:
+                await ctx.send_response(content=f'Sorry, there is no current session to clock into')
                 return
+            # Already active check
+            actives = await db.get_all_actives(ctx.guild.id)
         
-        now = com.get_current_datetime()
-        # Create entry and store
-        doc = {
-                'user': ctx.author.id,
-                'character': '',
-                'session': session['session'],
-                'in_timestamp': int(now.timestamp()),
-                'out_timestamp': '',
-                '_DEBUG_user_name': ctx.author.display_name,
-                '_DEBUG_in': now.isoformat(),
-                '_DEBUG_out': '',
-                '_DEBUG_delta': '',
-            }
-        content = ''
-        older_reps = await db.get_replacements_before_user(ctx.guild.id, ctx.author.id)
-        if older_reps:
-            await ctx.send_response("There are members ahead of you in the queue. You must be #1 in queue or there must not be a queue to clockin. Use /requestreps to alert #1 to join the camp or be removed from the queue if afk")
-            return
-            """
-            view = SkipQueueView()
-            await ctx.send_response("There are members ahead of you in the rep queue, are you sure you want to remove them from the queue and skip to clockin?", view=view)
-            await view.wait()
-            if view.result == False:
-                # Time out
+            for active in actives:
+                if active['user'] == ctx.author.id:
+                    await ctx.send_response(content=f'You are already active, did you mean to clockout?')
+                    return
+        
+            now = com.get_current_datetime()
+            # Create entry and store
+            doc = {
+                    'user': ctx.author.id,
+                    'character': '',
+                    'session': session['session'],
+                    'in_timestamp': int(now.timestamp()),
+                    'out_timestamp': '',
+                    '_DEBUG_user_name': ctx.author.display_name,
+                    '_DEBUG_in': now.isoformat(),
+                    '_DEBUG_out': '',
+                    '_DEBUG_delta': '',
+                }
+            content = ''
+            older_reps = await db.get_replacements_before_user(ctx.guild.id, ctx.author.id)
+            if older_reps:
+                await ctx.send_response("There are members ahead of you in the queue. You must be #1 in queue or there must not be a queue to clockin. Use /requestreps to alert #1 to join the camp or be removed from the queue if afk")
                 return
-            elif view.result == True:
-                '''
-                content = f'Removing these replacements which are OLDER than this replacement:'
-                for rep in older_reps:
-                    await remove_rep(ctx, rep['user'])
-                    content += f'\n<@{rep["user"]}> @ {com.datetime_from_timestamp(rep["in_timestamp"]).isoformat()}'
+                """
+                view = SkipQueueView()
+                await ctx.send_response("There are members ahead of you in the rep queue, are you sure you want to remove them from the queue and skip to clockin?", view=view)
+                await view.wait()
+                if view.result == False:
+                    # Time out
+                    return
+                elif view.result == True:
+                    '''
+                    content = f'Removing these replacements which are OLDER than this replacement:'
+                    for rep in older_reps:
+                        await remove_rep(ctx, rep['user'])
+                        content += f'\n<@{rep["user"]}> @ {com.datetime_from_timestamp(rep["in_timestamp"]).isoformat()}'
                 
-                content += '\n'
-                '''
-                content += f'Skipping {len(older_reps)} replacements and clocking {ctx.author.display_name} in. Alerting queuers they have been sent to the back of the queue: '
-                for rep in older_reps:
-                    await db.remove_replacement(ctx.guild.id, rep["user"])
-                    rep = {
-                        'user': rep['user'],
-                        'name': rep['name'],
-                        'in_timestamp': com.get_current_timestamp(),
-                    }
-                    added = await db.add_replacement(ctx.guild.id, rep)
-                    content += f'<@{rep["user"]}> '
-                content += '\n'
-            """
-        rep_removed = await db.remove_replacement(ctx.guild.id, ctx.author.id)
+                    content += '\n'
+                    '''
+                    content += f'Skipping {len(older_reps)} replacements and clocking {ctx.author.display_name} in. Alerting queuers they have been sent to the back of the queue: '
+                    for rep in older_reps:
+                        await db.remove_replacement(ctx.guild.id, rep["user"])
+                        rep = {
+                            'user': rep['user'],
+                            'name': rep['name'],
+                            'in_timestamp': com.get_current_timestamp(),
+                        }
+                        added = await db.add_replacement(ctx.guild.id, rep)
+                        content += f'<@{rep["user"]}> '
+                    content += '\n'
+                """
+            rep_removed = await db.remove_replacement(ctx.guild.id, ctx.author.id)
         
-        content += f'{ctx.author.display_name} {com.scram("Successfully")} clocked in at <t:{doc["in_timestamp"]}:f>'
-        if rep_removed is not None:
-            content += f' and was removed from replacement list'
+            content += f'{ctx.author.display_name} {com.scram("Successfully")} clocked in at <t:{doc["in_timestamp"]}:f>'
+            if rep_removed is not None:
+                content += f' and was removed from replacement list'
         
-        await db.store_active_record(ctx.guild.id, doc)
+            await db.store_active_record(ctx.guild.id, doc)
         try:
             await ctx.send_response(content=content)
         except (discord.errors.InteractionResponded, RuntimeError):
             await ctx.send_followup(content=content)
         
-        config = self.get_config(ctx.guild.id)
-        if 'max_active' in config.keys() and config['max_active'] < len(actives)+1:
+        config = configs.get(ctx.guild.id)
+        if config and config.max_active is not None and config.max_active < len(actives)+1:
             actives = await db.get_all_actives(ctx.guild.id)
-            content = f'Max number of active users is {config["max_active"]}, we are at {len(actives)} currently'
+            content = f'Max number of active users is {config.max_active}, we are at {len(actives)} currently'
             for active in actives:
                 content += f', <@{active["user"]}>'
             content = content + " please reduce active users"
@@ -257,14 +264,14 @@ class Clocks(commands.Cog):
         if res['status'] == False:
             return
         
-        bonus_sessions = await self.get_bonus_sessions(ctx.guild.id, res['record'], res['row'])
-        member = await ctx.guild.fetch_member(target)
-        if bonus_sessions:
-            for item in bonus_sessions:
-                row = await db.store_new_historical(ctx.guild.id, item)
-                tot = await db.get_user_hours(ctx.guild.id, member.id)
+        member = await directory.fetch(ctx.guild, target)
+        name = member.display_name if member else str(target)
+        if res['bonuses']:
+            for stored in res['bonuses']:
+                item, row = stored['record'], stored['row']
+                tot = await db.get_user_hours(ctx.guild.id, target)
             
-            await ctx.send_followup(content=f'{member.display_name} Obtained bonus hours, stored record #{row} for {item["_DEBUG_delta"]} hours. Your total is at {tot}')
+            await ctx.send_followup(content=f'{name} Obtained bonus hours, stored record #{row} for {item["_DEBUG_delta"]} hours. Your total is at {tot}')
     
     @commands.user_command(name="Clockout User")
     @is_member()
@@ -273,78 +280,56 @@ class Clocks(commands.Cog):
         await ctx.send_response(content=f"{ctx.author.display_name} attempted to clock out user {member.display_name}. {res['content']}\n")
         if res['status'] == False:
             return
-        bonus_sessions = await self.get_bonus_sessions(ctx.guild.id, res['record'], res['row'])
-        if bonus_sessions:
-            for item in bonus_sessions:
-                row = await db.store_new_historical(ctx.guild.id, item)
+        if res['bonuses']:
+            for stored in res['bonuses']:
+                item, row = stored['record'], stored['row']
                 tot = await db.get_user_hours(ctx.guild.id, member.id)
                 await ctx.send_followup(content=f'{member.display_name} Obtained bonus hours, stored record #{row} for {item["_DEBUG_delta"]} hours. User total is at {tot}')
         return
     
-    async def get_bonus_sessions(self, guild_id, record, row):
-        config = self.get_config(guild_id)
-        if not config.get('bonus_hours'):
+    def bonus_records(self, guild_id, config, record, row):
+        if not config or not config.bonus_hours:
             return None
-        bonuses = []
-        
-        for bonus in config['bonus_hours']:
-            _in = com.datetime_from_timestamp(record['in_timestamp'])
-            _out = com.datetime_from_timestamp(record['out_timestamp'])
-            for day in range((_out.date() - _in.date()).days+1):
-                bonus_in = com.datetime_combine((_in.date()+datetime.timedelta(days=day)).isoformat(), bonus['start'])
-                bonus_out = com.datetime_combine((_in.date()+datetime.timedelta(days=day)).isoformat(), bonus['end'])
-                if _in <= bonus_out and _out >= bonus_in:
-                    
-                    print(f'{com.get_current_iso()} [{guild_id}] - Bonus hours found for {record["_DEBUG_user_name"]}', flush=True)
-                    #we have an intersection
-                    #duration calculation
-                    duration = int(min(_out.timestamp()-_in.timestamp(), 
-                                   _out.timestamp()-bonus_in.timestamp(), 
-                                   bonus_out.timestamp()-_in.timestamp(), 
-                                   bonus_out.timestamp()-bonus_in.timestamp()))
-                    duration = int(duration * (float(bonus['pct'])/100))
-                    start = _in if _in > bonus_in else bonus_in
-                    rec = copy.deepcopy(record)
-                    rec['character'] = f'{bonus["pct"]}_PCT_BONUS_{bonus["start"]}_TO_{bonus["end"]} {row}'
-                    rec['in_timestamp'] = int(start.timestamp())
-                    rec['out_timestamp'] = int(start.timestamp()+duration)
-                    rec['_DEBUG_in'] = start.isoformat()
-                    rec['_DEBUG_out'] = (start + datetime.timedelta(seconds=duration)).isoformat()
-                    rec['_DEBUG_delta'] = com.get_hours_from_secs(duration)
-                    bonuses.append(rec)
+        bonuses = bonus.record_bonuses(bonus.compile_windows(config.bonus_hours), record, row)
+        if bonuses:
+            print(f'{com.get_current_iso()} [{guild_id}] - Bonus hours found for {record["_DEBUG_user_name"]}', flush=True)
         return bonuses
 
     async def _inner_clockout(self, ctx, user_id):
-        # Session Check
-        session = await db.get_session(ctx.guild.id)
-        if not session:
-            return {'status': False, 'record': None, 'row': None, 'content': f'Sorry, there is no current session to clock out of'}
-        
-        # Ensure user was unique in active
-        actives = await db.get_all_actives(ctx.guild.id)
-        found = [_ for _ in actives if _['user'] == user_id]
-        if not found:
-            return {'status': False, 'record': None, 'row': None, 'content': f'Did not find you in active records, did you forget to clock in?'}
-        if len(found) > 1:
-            #error somehow they are clocked in more then once
-            raise ValueError(f'Error - user was clocked in more then once guild: {ctx.guild.id} - user: {user_id}')
-            return {'status': False, 'record': found, 'row': None, 'content': f'Error - user was clocked in more then once guild: {ctx.guild.id} - user: {user_id}'}
-        record = found[0]
+        async with guild_locks.hold(ctx.guild.id, 'clockout'):
+            # Session Check
+            session = await db.get_session(ctx.guild.id)
+            if not session:
+                return {'status': False, 'record': None, 'row': None, 'content': f'Sorry, there is no current session to clock out of'}
         
-        res = await db.remove_active_record(ctx.guild.id, record)
+            # Ensure user was unique in active
+            actives = await db.get_all_actives(ctx.guild.id)
+            found = [_ for _ in actives if _['user'] == user_id]
+            if not found:
+                return {'status': False, 'record': None, 'row': None, 'content': f'Did not find you in active records, did you forget to clock in?'}
+            if len(found) > 1:
+                #error somehow they are clocked in more then once
+                raise ValueError(f'Error - user was clocked in more then once guild: {ctx.guild.id} - user: {user_id}')
+                return {'status': False, 'record': found, 'row': None, 'content': f'Error - user was clocked in more then once guild: {ctx.guild.id} - user: {user_id}'}
+            record = found[0]
         
-        _out = com.get_current_datetime()
-        record['_DEBUG_out'] = _out.isoformat()
-        record['out_timestamp'] = int(_out.timestamp())
-        record['_DEBUG_delta'] = com.get_hours_from_secs(record['out_timestamp']-record['in_timestamp'])
+            _out = com.get_current_datetime()
+            record['_DEBUG_out'] = _out.isoformat()
+            record['out_timestamp'] = int(_out.timestamp())
+            record['_DEBUG_delta'] = com.get_hours_from_secs(record['out_timestamp']-record['in_timestamp'])
         
-        res = await db.store_new_historical(ctx.guild.id, record)
+            # The record and its bonus records are stored in one transaction under the lock
+            config = configs.get(ctx.guild.id)
+            stored = await db.close_active_record(ctx.guild.id, record,
+                                                  get_bonuses=lambda record, row: self.bonus_records(ctx.guild.id, config, record, row))
         
-        if not res:
-            return {'status': False, 'record': record, 'row': None, 'content': f'Failed to store record to historical, contact admin\n{found}'}
+        if not stored:
+            return {'status': False, 'record': record, 'row': None, 'bonuses': [], 'content': f'Failed to store record to historical, contact admin\n{found}'}
+        res = stored['row']
         tot = await db.get_user_hours(ctx.guild.id, user_id)
-        user = await ctx.guild.fetch_member(user_id)
-        return {'status': True,'record': record, 'row': res, 'content': f'{user.display_name} {com.scram("Successfully")} clocked out at <t:{record["out_timestamp"]}>, stored record #{res} for {record["_DEBUG_delta"]} hours. Your total is at {tot}'}
+        user = await directory.fetch(ctx.guild, user_id)
+        name = user.display_name if user else str(user_id)
+        return {'status': True,'record': record, 'row': res, 'bonuses': stored['bonuses'], 'content': f'{name} {com.scram("Successfully")} clocked out at <t:{record["out_timestamp"]}>, stored record #{res} for {record["_DEBUG_delta"]} hours. Your total is at {tot}'}
     
     # ==============================================================================
     # Session Commands
@@ -368,8 +353,7 @@ class Clocks(commands.Cog):
     @is_command_channel()
     async def _sessionstart(self, ctx, sessionname: discord.Option(str, name="session_name", required=True)):
         content = f"I'm busy updating, please try again later"
-        await self.state_lock.acquire()
-        try:
+        async with guild_locks.hold(ctx.guild.id, 'session start'):
             session = await db.get_session(ctx.guild.id)
             if not session:
                 now = com.get_current_datetime()
@@ -391,8 +375,6 @@ class Clocks(commands.Cog):
                     content = f'Session start failed session names must be unique, try again or contact an administrator'
             else:
                 content = f'Sorry, a session, {session["session"]}, is already in place, please end the session before starting a new one'
-        finally:
-            self.state_lock.release()
         await ctx.send_response(content=content)
     
     @session_group.command(name='end', description='Ends active session, clocking out all active users in the process')
@@ -401,8 +383,7 @@ class Clocks(commands.Cog):
     @is_command_channel()
     async def _sessionend(self, ctx):
         content = f"I'm busy updating, please try again later"
-        await self.state_lock.acquire()
-        try:
+        async with guild_locks.hold(ctx.guild.id, 'session end'):
             session = await db.get_session(ctx.guild.id)
             if session:
                 now = com.get_current_datetime()
@@ -413,35 +394,27 @@ class Clocks(commands.Cog):
                 session['_DEBUG_delta'] = com.get_hours_from_secs(session['end_timestamp'] - 
                                                               session['start_timestamp'])
                 
-                actives = await db.get_all_actives(ctx.guild.id)
-                close_outs = []
-                fails = []
-                
-                for active in actives:
-                    res = await self._inner_clockout(ctx, active["user"])
-                    close_outs.append((res['record']['_DEBUG_user_name'], res['record']['_DEBUG_delta']))
-                    if not res['status']:
-                        fails.append(active)
-                        continue
-                    bonus_sessions = await self.get_bonus_sessions(ctx.guild.id, res['record'], res['row'])
-                    if not bonus_sessions:
-                        continue
-                    for item in bonus_sessions:
-                        row = await db.store_new_historical(ctx.guild.id, item)
-                        close_outs.append((item['_DEBUG_user_name'], f'Bonus id#{row}', item['_DEBUG_delta']))
-                content = f'Session, "{session["session"]}" ended and lasted {session["_DEBUG_delta"]} hours'
-                if close_outs:       
-                    content += f'\nAutomagically closed out {close_outs}'
-                if fails:
-                    content += f'\nFailed to close out record {fails}, contact administrator'
-                
-                await db.store_historical_session(ctx.guild.id, session)
-                await db.delete_session(ctx.guild.id)
-                await db.clear_replacement_queue(ctx.guild.id)
+                config = configs.get(ctx.guild.id)
+                res = await db.end_session(ctx.guild.id, session, now,
+                                           get_bonuses=lambda record, row: self.bonus_records(ctx.guild.id, config, record, row))
+                if res is None:
+                    content = f'Sorry there is no current session to end'
+                else:
+                    content = f'Session, "{session["session"]}" ended and lasted {session["_DEBUG_delta"]} hours'
+                    if res['closed']:
+                        total = round(sum(item['record']['_DEBUG_delta'] for item in res['closed']), 2)
+                        content += f'\nAutomagically closed out {len(res["closed"])} users for {total} hours'
+                    if res['bonuses']:
+                        bonus_total = round(sum(item['record']['_DEBUG_delta'] for item in res['bonuses']), 2)
+                        content += f', plus {len(res["bonuses"])} bonus records for {bonus_total} hours'
+                    bonus_users = {item['record']['user'] for item in res['bonuses']}
+                    details = [f'{item["record"]["_DEBUG_user_name"]} {item["record"]["_DEBUG_delta"]}{" (+bonus)" if item["record"]["user"] in bonus_users else ""}' for item in res['closed']]
+                    if details:
+                        content += '\n' + ', '.join(details)
+                    if len(content) > 1990:
+                        content = content[:content.rfind(', ', 0, 1985)] + ' ...'
             else:
                 content=f'Sorry there is no current session to end'
-        finally:
-            self.state_lock.release()
         await ctx.send_response(content=content)
     
     # ==============================================================================
@@ -452,11 +425,8 @@ class Clocks(commands.Cog):
     @is_member()
     async def _list(self, ctx, public: discord.Option(bool, name='public', default=False)
                              , zeros: discord.Option(bool, name='includezeros', default=False)):
-        # List all users in ranked order
-        # get unique users
-        users = await db.get_unique_users(ctx.guild.id)
-        
-        res = await db.get_users_hours_v2(ctx.guild.id, users, print_info=True)
+        # List all users in ranked order, from the guild's snapshot until historical changes
+        res = await db.get_leaderboard(ctx.guild.id)
         
         content_container = []
         content = '_ _\nUsers sorted by total time:'
@@ -494,28 +464,33 @@ class Clocks(commands.Cog):
             # Time out
             return
         elif view.result == True:
-            tot = await db.get_user_seconds(ctx.guild.id, ctx.author.id)
-            if tot < com.SECS_IN_HOUR:
-                await view.message.edit(content=f"You must have at least one hour accrued to collect an urn")
-                return
-            session = await db.get_session(ctx.guild.id)
-            session_name = ''
-            if session:
-                session_name = session['session']
-            now = com.get_current_datetime()
-            hours = com.get_hours_from_secs(tot)
-            doc = {
-                'user': ctx.author.id,
-                'character': f"URN_ZERO_OUT_EVENT -{hours}",
-                'session': session_name,
-                'in_timestamp': int(now.timestamp()),
-                'out_timestamp': (now.timestamp())-tot,
-                '_DEBUG_user_name': ctx.author.display_name,
-                '_DEBUG_in': now.isoformat(),
-                '_DEBUG_out': now.isoformat(),
-                '_DEBUG_delta': -1*hours,
-            }
-            res = await db.store_new_historical(ctx.guild.id, doc)
+            async with guild_locks.hold(ctx.guild.id, 'urn'):
+                # The prompt may have been open long enough to clock in, check again under the lock
+                if await db.is_user_active(ctx.guild.id, ctx.author.id):
+                    await view.message.edit(content=f"Please clock out before attempting to claim your Urn")
+                    return
+                tot = await db.get_user_seconds(ctx.guild.id, ctx.author.id)
+                if tot < com.SECS_IN_HOUR:
+                    await view.message.edit(content=f"You must have at least one hour accrued to collect an urn")
+                    return
+                session = await db.get_session(ctx.guild.id)
+                session_name = ''
+                if session:
+                    session_name = session['session']
+                now = com.get_current_datetime()
+                hours = com.get_hours_from_secs(tot)
+                doc = {
+                    'user': ctx.author.id,
+                    'character': f"URN_ZERO_OUT_EVENT -{hours}",
+                    'session': session_name,
+                    'in_timestamp': int(now.timestamp()),
+                    'out_timestamp': (now.timestamp())-tot,
+                    '_DEBUG_user_name': ctx.author.display_name,
+                    '_DEBUG_in': now.isoformat(),
+                    '_DEBUG_out': now.isoformat(),
+                    '_DEBUG_delta': -1*hours,
+                }
+                res = await db.store_new_historical(ctx.guild.id, doc)
             if not res:
                 print(f"Clearout failure\n {doc}", flush=True)
             await view.message.edit(content=f"Ooooh, yes! :urn: :tada: {hours} hours well spent!")
@@ -697,27 +672,28 @@ class Clocks(commands.Cog):
         userid = await check_user_id(ctx, _id)
         if userid is None:
             return
-        secs = await db.get_user_seconds(ctx.guild.id, userid)
-        hours = com.get_hours_from_secs(secs)
-        datetime_kill = com.datetime_from_iso(date+"T"+time+":00-05:00")
-        rev_timestamp = datetime_kill.timestamp() - secs
-        rev_datetime = com.datetime_from_timestamp(rev_timestamp)
-        doc = {
-                'user': int(userid),
-                'character': f"URN_ZERO_OUT_EVENT -{hours}",
-                'session': sessionname,
-                'in_timestamp': int(datetime_kill.timestamp()),
-                'out_timestamp': int(rev_timestamp),
-                '_DEBUG_user_name': username,
-                '_DEBUG_in': datetime_kill.isoformat(),
-                '_DEBUG_out': rev_datetime.isoformat(),
-                '_DEBUG_delta': -1*hours,
-            }
-        try:
-            res = await db.store_new_historical(ctx.guild.id, doc)
-        except OperationalError as err:
-            await ctx.send_response(content=f'Failed, database error - {err}, please try again or contact an administator')
-            return
+        async with guild_locks.hold(ctx.guild.id, 'admin directurn'):
+            secs = await db.get_user_seconds(ctx.guild.id, userid)
+            hours = com.get_hours_from_secs(secs)
+            datetime_kill = com.datetime_from_iso(date+"T"+time+":00-05:00")
+            rev_timestamp = datetime_kill.timestamp() - secs
+            rev_datetime = com.datetime_from_timestamp(rev_timestamp)
+            doc = {
+                    'user': int(userid),
+                    'character': f"URN_ZERO_OUT_EVENT -{hours}",
+                    'session': sessionname,
+                    'in_timestamp': int(datetime_kill.timestamp()),
+                    'out_timestamp': int(rev_timestamp),
+                    '_DEBUG_user_name': username,
+                    '_DEBUG_in': datetime_kill.isoformat(),
+                    '_DEBUG_out': rev_datetime.isoformat(),
+                    '_DEBUG_delta': -1*hours,
+                }
+            try:
+                res = await db.store_new_historical(ctx.guild.id, doc)
+            except OperationalError as err:
+                await ctx.send_response(content=f'Failed, database error - {err}, please try again or contact an administator')
+                return
         if not res:
             await ctx.send_response(content=f'Something went wrong, return index 0 please contact an administator')
             return
@@ -725,6 +701,47 @@ class Clocks(commands.Cog):
         
         await ctx.send_response(content=f'{username} - <@{int(userid)}> {com.scram("Successfully")} URNed and stored record #{res} for {doc["_DEBUG_delta"]} hours. Total is at {tot}')
     
+    @admin_group.command(name='rebuildtotals', description='Recompute every user\'s stored totals from historical records')
+    @is_admin()
+    @is_member()
+    @is_member_visible()
+    async def _adminrebuildtotals(self, ctx):
+        count = await db.rebuild_user_totals(ctx.guild.id)
+        await ctx.send_response(content=f'Rebuilt stored totals for {count} users')
+
+    @admin_group.command(name='reloadstate', description='Reload the cached session, actives and replacement queue from the database')
+    @is_admin()
+    @is_member()
+    @is_member_visible()
+    async def _adminreloadstate(self, ctx):
+        stats = db.state_cache.stats()
+        db.state_cache.invalidate(ctx.guild.id)
+        await db.state_cache.get(ctx.guild.id)
+        await ctx.send_response(content=f'Reloaded cached state, {stats["hits"]} hits / {stats["misses"]} misses ({stats["hit_ratio"]*100:.1f}%) across {stats["guilds"]} guilds since startup')
+
+    @admin_group.command(name='recomputebonus', description='Recompute bonus hour records for records clocked in between two dates')
+    @is_admin()
+    @is_member()
+    @is_member_visible()
+    async def _adminrecomputebonus(self, ctx,
+                                   startdate: discord.Option(str, name="startdate", description="Form YYYY-MM-DD", required=True),
+                                   enddate: discord.Option(str, name="enddate", description="Form YYYY-MM-DD, included", required=True)):
+        try:
+            first = datetime.date.fromisoformat(startdate).toordinal()
+            last = datetime.date.fromisoformat(enddate).toordinal()
+        except ValueError as err:
+            await ctx.send_response(content=f'Invalid date: {err}', ephemeral=True)
+            return
+        if last < first:
+            await ctx.send_response(content=f'End date {enddate} is before start date {startdate}', ephemeral=True)
+            return
+        config = configs.get(ctx.guild.id)
+        windows = bonus.compile_windows(config.bonus_hours) if config else ()
+        await ctx.defer()
+        res = await db.replace_bonus_records(ctx.guild.id, bonus.local_timestamp(first, 0), bonus.local_timestamp(last + 1, 0),
+                                             lambda sources: bonus.batch_bonuses(windows, [(source, source['rowid']) for source in sources]))
+        await ctx.send_followup(content=f'Recomputed bonus hours for {res["sources"]} records from {startdate} to {enddate}, removed {res["removed"]} and stored {res["added"]} bonus records')
+
     @admin_group.command(name='changehistory', description='Change a historical record of a user')
     @is_admin()
     @is_member()
@@ -824,47 +841,38 @@ class Clocks(commands.Cog):
     
     @get_group.command(name='data', description='Command to retrive all data of a table')
     @is_member()
-    async def _getdata(self, ctx, data_type=discord.Option(name='datatype', choices=['actives','historical','session', 'historicalsession', 'commands', 'errors'], default='historical')):
-        res = await db.flush_wal()
-        if not res:
-            await ctx.send_response(content='Couldn\'t flush journal, possible multiple connections active, contact administrator')
-            return
-        if data_type == 'historical':
-            data = await db.get_historical(ctx.guild.id)
-        elif data_type == 'actives':
-            data = await db.get_all_actives(ctx.guild.id)
-        elif data_type == 'session':
-            data = [await db.get_session(ctx.guild.id)]
-        elif data_type == 'commands':
-            data = await db.get_commands_history(ctx.guild.id)
-        elif data_type == 'historicalsession':
-            data = await db.get_session_history(ctx.guild.id)
-        else:
+    async def _getdata(self, ctx,
+                       data_type=discord.Option(name='datatype', choices=['actives','historical','session', 'historicalsession', 'commands', 'errors'], default='historical'),
+                       fmt=discord.Option(name='format', choices=export.EXPORT_FORMATS, default='jsonl')):
+        if data_type not in export.EXPORT_QUERIES:
             await ctx.send_response(content='Option not available yet')
             return
-        out_file = Path('/temp/data.json')
-        out_file.parent.mkdir(exist_ok=True, parents=True)
-        json.dump(data, open('temp/data.json', 'w', encoding='utf-8'), indent=1)
-        await ctx.send_response(content='Here\'s the data!', file=discord.File('temp/data.json', filename='data.json'))
+        await ctx.defer()
+        try:
+            out_path, count = await export.export_table(ctx.guild.id, data_type, fmt)
+        except sqlite3.Error as err:
+            await ctx.send_followup(content=f'Failed exporting {data_type}, database error - {err}, please try again or contact an administator')
+            return
+        try:
+            await ctx.send_followup(content=f'Here\'s the data! {count} rows', file=discord.File(out_path, filename=f'{data_type}.{fmt}.gz'))
+        finally:
+            os.remove(out_path)
         return
     
-    def get_config(self, guild_id):
-        return json.load(open('data/config.json', 'r', encoding='utf-8')).get(str(guild_id))
-    
 
 # function to accept a user id to check, or partial/full string to match user name on, returns None on didnt find or an userid int
 async def check_user_id(ctx, param) -> int:
     # Try userid for int interpretation
     ret = {'result': None, 'type': MemberQueryResult.QUERY_FAILED}
     try:
-        int(param)
-        res = await ctx.guild.fetch_member(int(param))
-        ret = {'result': res, 'type': MemberQueryResult.FOUND}
+        res = await directory.fetch(ctx.guild, int(param))
+        if res:
+            ret = {'result': res, 'type': MemberQueryResult.FOUND}
+        else:
+            ret = {'result': None, 'type': MemberQueryResult.ID_NOT_FOUND}
     except (ValueError, TypeError) as err:
         # Failed int parsing
         pass 
-    except discord.errors.NotFound:
-        ret = {'result': None, 'type': MemberQueryResult.ID_NOT_FOUND}
     
     if not ret['result']:
         # try querying string for member
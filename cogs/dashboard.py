@@ -1,10 +1,11 @@
 # Builtin
 import datetime
-import json
 import asyncio
 import time
 import os
+import hashlib
 from enum import Enum
+from typing import NamedTuple
 
 # External
 import discord
@@ -12,7 +13,11 @@ from discord.ext import commands, tasks
 
 # Internal
 import data.databaseapi as db
+from data.config import configs
 import static.common as com
+from static.members import directory, roles
+from static.edit_scheduler import scheduler
+from static.locks import guild_locks
 from checks.IsAdmin import is_admin, NotAdmin
 from checks.IsCommandChannel import is_command_channel, NotCommandChannel
 from checks.IsMemberVisible import is_member_visible, NotMemberVisible
@@ -20,14 +25,26 @@ from checks.IsMember import is_member, NotMember
 from checks.IsInDev import is_in_dev, InDevelopment
 
 REFRESH_TYPE = 'seconds'
-REFRESH_TIME = 60
+# The printer wakes this often and refreshes the guilds that are due, see Cadence
+REFRESH_TIME = 15
+# Events arriving within this many seconds are coalesced into one render
+EVENT_DEBOUNCE = 3
 #CAMP_HOURS_TILL_DS = 18
 HOURS_SOFTCAP = 5
 MOBILE_REDUCE_SPACE = 10
 
+# Guilds refreshed at once, each gets GUILD_REFRESH_TIMEOUT seconds before it is counted as failed
+DASH_CONCURRENCY = 4
+GUILD_REFRESH_TIMEOUT = 45
+# Consecutive failures before a guild's dashboard is paused
+MAX_GUILD_FAILS = 10
+
+# The "Last Updated" header alone only forces an edit this often, body changes are sent every refresh
+HEADER_REFRESH_TIME = int(os.getenv('DASH_HEADER_REFRESH_TIME', 5 * 60))
+
 DEBUG = os.getenv('DEBUG')
 if DEBUG:
-    REFRESH_TIME = 15
+    REFRESH_TIME = 5
 
 class Format(Enum):
     Normal = 0
@@ -54,27 +71,180 @@ class BackgroundColor(Enum):
     LightGray        = 46 
     White            = 47 
 
-def ansi_format(t: str, format : Format = Format.Normal, exformat : Format = None, background : BackgroundColor = None , color : TextColor = None):
-    # TODO make it better for having two formating options, maybe move to common module
-    uni_esc = f'\u001b'
-    format_start = '['
-    format_end = 'm'
-    res = uni_esc + format_start
-    if format:
-        res += str(format.value)
-    else:
-        res += str(Format.Normal.value)
+ANSI_RESET = '\u001b[0m'
+
+def ansi_prefix(format : Format = Format.Normal, exformat : Format = None, background : BackgroundColor = None , color : TextColor = None) -> str:
+    codes = [str((format or Format.Normal).value)]
     if exformat:
-        res += ';' + str(exformat.value)
+        codes.append(str(exformat.value))
     if background:
-        res += ';' + str(background.value)
+        codes.append(str(background.value))
     if color:
-        res += ';' + str(color.value)
-    res += format_end + t + uni_esc + format_start + str(Format.Normal.value) + format_end
-    return res
+        codes.append(str(color.value))
+    return '\u001b[' + ';'.join(codes) + 'm'
+
+def ansi_format(t: str, format : Format = Format.Normal, exformat : Format = None, background : BackgroundColor = None , color : TextColor = None):
+    return ansi_prefix(format, exformat, background, color) + t + ANSI_RESET
+
+# Bold colored cells are all the dashboard uses, built once
+BOLD = {color: ansi_prefix(Format.Bold, color=color) for color in TextColor}
+
+# ==============================================================================
+# Cadence, how often each guild's dashboard is refreshed by the printer
+# ==============================================================================
+
+class Cadence(Enum):
+    # Session running, times on the dashboard move every minute
+    Active = 60 if not DEBUG else 15
+    # No session, nothing moves until a command or the camp opening. Commands wake the guild through
+    # guild_state_change, the opening is scheduled exactly, so this is only a safety net
+    Idle = 15 * 60
+    # Not configured for a dashboard, only rechecked in case the config changes
+    Disabled = 30 * 60
+
+# ==============================================================================
+# View model, everything a dashboard shows gathered once per refresh
+# ==============================================================================
+
+class ActiveRow(NamedTuple):
+    name: str
+    delta: float
+    ses_delta: float
+    color: TextColor
+
+class QueueRow(NamedTuple):
+    name: str
+    ses_hours: str
+    mins: int
+    color: TextColor
+
+class TopRow(NamedTuple):
+    name: str
+    total: float
+
+class DashboardView(NamedTuple):
+    open_label: str
+    ds_in: str
+    session_name: str
+    session_start: str
+    actives: tuple
+    queue: tuple
+    top: tuple
+    top_count: int
+    # Only set while the spawn is still ahead
+    spawn_timestamp: int
+    paused: bool
+    camp_open: bool
+
+# ==============================================================================
+# Renderers, pure functions of the view. Both return the body, the header is added by the caller
+# ==============================================================================
+
+MEDALS = ['🥇', '🥈', '🥉']
+TAIL = "```\n"
+
+def _seperator(reduce):
+    return '-' * (50 - reduce)
+
+def _title(view):
+    if view.spawn_timestamp:
+        return f' DS Spawn <t:{view.spawn_timestamp}:R> at <t:{view.spawn_timestamp}>_ ```ansi\n'
+    return '_ ```ansi\n'
+
+def _col1(view, reduce):
+    seperator = _seperator(reduce)
+    col1 = [
+        f"{' Active Session':15}{view.open_label:^{19-reduce}}{'DS in: ':7}{view.ds_in:8}{' ':1}",
+        seperator,
+        f"{' ' + view.session_name[:28-reduce]:{30-reduce}}{'@ ':2}{view.session_start:13}{' EST ':5}",
+        seperator,
+        f"{' Active Users':<{34-reduce}}{'Current / Total':>15}{' ':1}",
+        seperator,
+    ]
+    for item in view.actives:
+        col1.append(f"{' ' + item.name[:24-reduce]:{36-reduce}}{BOLD[item.color]}{item.delta:>5.2f} / {item.ses_delta:>5.2f} {ANSI_RESET}")
+    col1.append(seperator)
+    col1.append(f"{' Camp Queue':{36-reduce}}{'Mins in queue':>13}{' ':1}")
+    col1.append(seperator)
+    for item in view.queue:
+        col1.append(f"{BOLD[item.color]}{' ' + item.name[:35-reduce] + ' ' + item.ses_hours:{43-reduce}} @ {item.mins:3} {ANSI_RESET}")
+    return col1
+
+def _col2(view, reduce):
+    col2 = [f" Top {view.top_count} in Hours", _seperator(reduce)]
+    for idx in range(view.top_count):
+        if idx >= len(view.top):
+            col2.append("")
+            continue
+        medal = MEDALS[idx] if idx < len(MEDALS) else ''
+        item = view.top[idx]
+        col2.append(f"{' ' + item.name[:41-reduce]:{42-reduce}} {item.total:>6.2f} {medal}")
+    return col2
+
+def _footer(view):
+    if not view.paused:
+        return ''
+    return "Paused till session start. " + ("Camp is open!" if view.camp_open else '')
+
+# limit is the length the body may grow to before further rows are dropped
+def render_desktop(view, limit=1900) -> str:
+    col1 = _col1(view, 0)
+    col2 = _col2(view, 0)
+    parts = [_title(view)]
+    size = len(parts[0])
+    for idx in range(len(col1)):
+        if size < limit:
+            row = col1[idx] + ('-' if idx == 1 else '|') + col2[idx]
+            parts.append(row)
+            size += len(row)
+        parts.append('\n')
+        size += 1
+    parts.append(TAIL)
+    parts.append(_footer(view))
+    return ''.join(parts)
+
+def render_mobile(view, limit=1900) -> str:
+    parts = [_title(view)]
+    for row in _col1(view, MOBILE_REDUCE_SPACE):
+        parts.append(row + '\n')
+    parts.append('\n' + _seperator(MOBILE_REDUCE_SPACE) + '\n')
+    size = sum(len(part) for part in parts)
+    for row in _col2(view, MOBILE_REDUCE_SPACE):
+        if size < limit:
+            parts.append(row + '\n')
+            size += len(row) + 1
+    parts.append(TAIL)
+    parts.append(_footer(view))
+    return ''.join(parts)
+
+def render_header(now) -> str:
+    return f'_Last Updated: <t:{int(now.timestamp())}:R>.'
     
-def get_config(guild_id):
-    return json.load(open('data/config.json', 'r', encoding='utf-8')).get(str(guild_id))
+class RenderCache:
+    """Last dashboard sent per guild and variant, so unchanged bodies aren't edited again"""
+    def __init__(self, header_refresh=HEADER_REFRESH_TIME):
+        self.header_refresh = header_refresh
+        # (guild_id, variant) -> {'message': id, 'hash': body digest, 'sent': monotonic time}
+        self.entries = {}
+        self.sent = 0
+        self.skipped = 0
+
+    @staticmethod
+    def digest(body):
+        return hashlib.blake2b(body.encode('utf-8'), digest_size=16).digest()
+
+    def needs_edit(self, guild_id, variant, message_id, body) -> bool:
+        entry = self.entries.get((guild_id, variant))
+        if not entry or entry['message'] != message_id or entry['hash'] != self.digest(body):
+            return True
+        return time.monotonic() - entry['sent'] >= self.header_refresh
+
+    def record(self, guild_id, variant, message_id, body):
+        self.entries[(guild_id, variant)] = {'message': message_id, 'hash': self.digest(body), 'sent': time.monotonic()}
+
+    def forget(self, guild_id):
+        for key in [key for key in self.entries if key[0] == guild_id]:
+            del self.entries[key]
     
 class Dashboard(commands.Cog):
     
@@ -82,13 +252,22 @@ class Dashboard(commands.Cog):
         self.bot = bot
         self.delay = {}
         self.open_transitioned = {}
-        self.cache_datetime = None
-        self.config_cache = {}
-        self.refresh_cache_config()
         self.printer.start()
         self.dash_message = {}
         self.dash_mobile_message = {}
-        self.fail_count = 0
+        self.render_cache = RenderCache()
+        # Consecutive failed refreshes per guild
+        self.fail_count = {}
+        # Guilds with an event render scheduled, and those that changed again since it started
+        self.pending_render = {}
+        self.dirty = set()
+        # One refresh at a time per guild, the poll and event renders share the messages
+        self.guild_locks = {}
+        # guild_id -> {'cadence': Cadence, 'next': timestamp, 'reason': str}
+        self.schedule = {}
+        # guild_id -> (camp opens, DS spawns) timestamps from the last full refresh, None without a ToD
+        self.camp_window = {}
+        configs.add_listener(self._on_config_change)
         print('Initilization on dashboard complete')
         
     # ==============================================================================
@@ -140,34 +319,44 @@ class Dashboard(commands.Cog):
         missing_tables = await db.check_tables(['historical', 'session', 'session_history', 'active', 'tod'])
         if missing_tables:
             print(f"Warning, Dashboard reports missing the following tables in db: {missing_tables}")
+        # on_ready listeners run alongside the bot's, wait for the config to be loaded
+        await configs.load()
+        # Anything scheduled before the config was in is stale
+        self.schedule.clear()
             
         for guild in self.bot.guilds:
-            config = self.get_config(guild.id)
+            config = configs.get(guild.id)
             if not config:
                 continue
             await self._purge_dashboard(guild)
 
     def cog_unload(self):
+        configs.remove_listener(self._on_config_change)
         self.printer.stop()
+        for task in self.pending_render.values():
+            task.cancel()
         print('Dashboard update stopped', flush=True)
     
-    '''
-    @commands.slash_command(name="dashboardtimeleft")
+    dashboard_group = discord.commands.SlashCommandGroup('dashboard')
+
+    @dashboard_group.command(name="timeleft", description='Time till the next dashboard refresh and the refresh cadence in use')
     @is_member()
     @is_command_channel()
     @is_member_visible()
     async def _timeleft(self, ctx):
-        now = com.get_current_datetime()
-        delta = "Printer not scheduled"
-        if self.printer.next_iteration:
-            delta = self.printer.next_iteration - now
-        await ctx.send_response(content=f'Time till dashboard refresh check {delta}')
-    '''
+        schedule = self.schedule.get(ctx.guild.id)
+        if not schedule:
+            await ctx.send_response(content='Dashboard refresh not scheduled yet, it will refresh on the next check')
+            return
+        await ctx.send_response(content=f'Next dashboard refresh <t:{max(schedule["next"], com.get_current_timestamp())}:R>, '
+                                        f'cadence {schedule["cadence"].name} (every {schedule["cadence"].value}s, {schedule["reason"]})')
         
     @commands.slash_command(name="dashboardrestart")
     @is_member()
     @is_command_channel()
     async def _dashboardrestart(self, ctx):
+        self.fail_count.clear()
+        self.schedule.clear()
         self.printer.cancel()
         self.printer.restart()
         await ctx.send_response(f"Restarting Dashboard")
@@ -177,6 +366,8 @@ class Dashboard(commands.Cog):
     @is_command_channel()
     @is_member_visible()
     async def _refresh(self, ctx):
+        self.fail_count[ctx.guild.id] = 0
+        self._wake(ctx.guild.id)
         session = await db.get_session(ctx.guild.id)
         if self.delay.get(ctx.guild.id) and not session:
             self.delay[ctx.guild.id] = False
@@ -185,294 +376,306 @@ class Dashboard(commands.Cog):
             self.delay[ctx.guild.id] = False
             await ctx.send_response(f"Refeshing should be enabled. Forcing update, if no update comes, contact admin")
     
+    @commands.slash_command(name="dashboardstats")
+    @is_member()
+    @is_command_channel()
+    async def _dashboardstats(self, ctx):
+        cache = self.render_cache
+        members = directory.stats()
+        edits = scheduler.stats()
+        checks = roles.stats()
+        locks = guild_locks.stats()
+        leaderboard = db.leaderboard_cache.stats()
+        await ctx.send_response(f"Dashboard edits sent {cache.sent}, skipped unchanged {cache.skipped}, header refresh every {cache.header_refresh}s\n"
+                                f"Edit scheduler {edits['pending']} pending, {edits['in_flight']} in flight, {edits['sent']} sent, {edits['coalesced']} coalesced, {edits['retries']} retries, {edits['failed']} failed\n"
+                                f"Member directory {members['members']} cached, {members['hits']} hits / {members['misses']} misses ({members['hit_ratio']*100:.1f}%), {members['requests']} member requests\n"
+                                f"Member checks {checks['checks']}, {checks['payload']} from the interaction, {checks['cached']} from the directory ({checks['cached_ratio']*100:.1f}% without REST), {checks['rest']} REST fetches\n"
+                                f"Guild locks {locks['locks']} held, {locks['acquired']} acquired, {locks['contended']} contended, wait avg {locks['wait_avg']*1000:.1f}ms / max {locks['wait_max']*1000:.1f}ms\n"
+                                f"Leaderboard snapshots {leaderboard['guilds']} cached, {leaderboard['hits']} hits / {leaderboard['misses']} misses ({leaderboard['hit_ratio']*100:.1f}%)")
+
+    # Declares the new content when the body changed or the header is due, the header is the volatile "Last Updated" line
+    # The edit itself is sent by the scheduler, the render cache is updated once it went out
+    def _declare_dash(self, guild_id, variant, message, header, body):
+        if not self.render_cache.needs_edit(guild_id, variant, message.id, body):
+            self.render_cache.skipped += 1
+            return False
+        def sent():
+            self.render_cache.record(guild_id, variant, message.id, body)
+            self.render_cache.sent += 1
+        scheduler.submit(message, guild_id, on_sent=sent, content=header + body)
+        return True
+
     async def _purge_dashboard(self, guild):
         def chk(msg):
             if msg.author.id == self.bot.user.id:
                 return True
             return False
-        config = self.get_config(guild.id)
-        if config.get('dashboard_channel'):
+        config = configs.get(guild.id)
+        self.render_cache.forget(guild.id)
+        for messages in (self.dash_message, self.dash_mobile_message):
+            if messages.get(guild.id):
+                scheduler.cancel(messages[guild.id])
+        if config.dashboard_channel:
             print(f'{com.get_current_iso()} [{guild.id}] - Purging dashboard', flush=True)
-            channel = await guild.fetch_channel(config['dashboard_channel'])
+            channel = await guild.fetch_channel(config.dashboard_channel)
             await channel.purge(check=chk)
             self.dash_message[guild.id] = await channel.send(content=f'Starting Dashboard...', silent=True)
 
-        if config.get('mobile_dash_channel'):
+        if config.mobile_dash_channel:
             print(f'{com.get_current_iso()} [{guild.id}] - Purging mobile dash', flush=True)
-            mobile_channel = await guild.fetch_channel(config['mobile_dash_channel'])
+            mobile_channel = await guild.fetch_channel(config.mobile_dash_channel)
             await mobile_channel.purge(check=chk)
             self.dash_mobile_message[guild.id] = await mobile_channel.send(content=f'Starting Dashboard...', silent=True)
 
     
     @tasks.loop(**{REFRESH_TYPE:REFRESH_TIME})
     async def printer(self):
-        if self.fail_count > 10:
-            print("fail count above 10, stopping printer")
-            self.printer.stop()
+        # Until the config is loaded every guild would look unconfigured
+        if not configs.loaded:
             return
-        for guild in self.bot.guilds:
-            try:
-                config = self.get_config(guild.id)
-                if not config or not config.get('dashboard_channel'):
-                    continue
-                channel = await guild.fetch_channel(config['dashboard_channel'])
-                mobile_channel = None
-                if config.get('mobile_dash_channel'):
-                    mobile_channel = await guild.fetch_channel(config['mobile_dash_channel'])
-                if not self.dash_message.get(guild.id):
-                    await channel.send(content=f'Starting Dashboard...', silent=True)
-                if not self.dash_mobile_message.get(guild.id):
-                    await mobile_channel.send(content=f'Starting Dashboard...', silent=True)
-                session_real = await db.get_session(guild.id)
-                historical_recs_from_session = []
-                if session_real:
-                    historical_recs_from_session = await db.get_historical_session(guild.id, session_real['session'])
-                now = com.get_current_datetime()
-                tod_dict = await db.get_tod(guild.id, mob_name="Drusella Sathir")
-                mins_till_ds_str = "Unknown"
-                mins_till_ds = -1
-                if tod_dict:
-                    tod_datetime = com.datetime_from_timestamp(tod_dict['tod_timestamp']) + datetime.timedelta(days=1)
-                    mins_till_ds = int((tod_datetime - now).total_seconds()/com.SECS_IN_MINUTE)
-                    if mins_till_ds < 0:
-                        mins_till_ds_str = "Unknown"
-                    else:
-                        mins_till_ds_str = f'{mins_till_ds:4}mins'
-                _open = ""
-                if mins_till_ds >= 0 and mins_till_ds <= com.MINUTE_IN_HOUR * get_config(guild.id).get("camp_hour_count", 18):
-                    _open = "<OPEN>"
-                    # If we are in delayed mode, and we havent refreshed with the new transition, refresh automatically
-                    if self.delay.get(guild.id) and not self.open_transitioned.get(guild.id):
-                        self.open_transitioned[guild.id] = True
-                        self.delay[guild.id] = False
-                        await self._purge_dashboard(guild)
-                if self.delay.get(guild.id) and session_real:
-                    self.delay[guild.id] = False
-                    await self._purge_dashboard(guild)
-                        
-                elif self.delay.get(guild.id) and not session_real:
-                    continue
-                
-                
-                actives = await db.get_all_actives(guild.id)
-                
-                for item in actives:
-                    item['display_name'] = 'placeholder'
-                    item['delta'] = com.get_hours_from_secs(now.timestamp() - item['in_timestamp'])
-                    mem_historical = [_ for _ in historical_recs_from_session if _['user'] == item['user']]
-                    item['ses_delta'] = item['delta']
-                    try:
-                        member = await guild.fetch_member(int(item['user']))
-                    except discord.errors.NotFound:
-                        member = None
-                    if member:
-                        item['display_name'] = member.display_name
-                    for _item in mem_historical:
-                        if "PCT_BONUS" in _item['character']:
-                            continue
-                        item['ses_delta'] += com.get_hours_from_secs(_item['out_timestamp'] - _item['in_timestamp'])
-                    item['ses_delta'] = round(item['ses_delta'], 2)
-                
-                if not session_real:
-                    session = {'session': "None"}
-                    timestr = ''
-                else:
-                    session = session_real
-                    timestr = com.datetime_from_timestamp(session['start_timestamp']).strftime("%b%d %I:%M%p")
-                
-                camp_queue = await db.get_replacement_queue(guild.id)
-                
-                # NOTE! Actives and Camp queue must be completed before this step as we are limiting based on the number of the aforementioned 
-                lines = 2
-                ex_lines = 7
-                cont_lines = len(actives) + len(camp_queue)
-                users = await db.get_unique_users(guild.id)
-                
-                res = await db.get_users_hours_v2(guild.id, users, limit = ex_lines+cont_lines, trim_afk=True)
-                
-                for item in res:
-                    item['display_name'] = str(item['user'])
-                    if guild.get_member(int(item['user'])):
-                        item['display_name'] = next((x.display_name for x in guild.members if x.id == int(item['user'])), None)
-                    else:
-                        try:
-                            member = await guild.fetch_member(int(item['user']))
-                        except discord.errors.NotFound:
-                            continue
-                        item['display_name'] = member.display_name
-                
-                def get_seperator(mobile=False):
-                    reduce = 0
-                    if mobile:
-                        reduce = MOBILE_REDUCE_SPACE
-                    return f"{'-'*(50-reduce)}"
-                
-                async def get_col1(mobile=False):
-                    col1 = []
-                    reduce = 0
-                    now = com.get_current_datetime()
-                    urns = await db.get_urns_v2(guild.id)
-                    if mobile:
-                        reduce = MOBILE_REDUCE_SPACE
-                    seperator = get_seperator(mobile)
-                    
-                    # 1st column 50 spaces 
-                    col1.append(f"{' Active Session':15}{_open:^{19-reduce}}{'DS in: ':7}{mins_till_ds_str:8}{' ':1}")
-                    col1.append(seperator)
-                    col1.append(f"{' ' + session['session'][:28-reduce]:{30-reduce}}{'@ ':2}{timestr:13}{' EST ':5}")
-                    col1.append(seperator)
-                    col1.append(f"{' Active Users':<{34-reduce}}{'Current / Total':>15}{' ':1}") 
-                    col1.append(seperator)
-                    for item in actives:
-                        if item['ses_delta'] >= HOURS_SOFTCAP:
-                            color = TextColor.Red
-                        else:
-                            color = TextColor.Green
-                        
-                        user_urns = [x for x in urns if x['user'] == item['user']]
-                        if user_urns:
-                            sorted(user_urns, key = lambda a: a['in_timestamp'])
-                            if user_urns[-1]['in_timestamp'] > int((now - datetime.timedelta(days=7)).timestamp()):
-                                color = TextColor.Pink
-                        formated_times = ansi_format(f"{item['delta']:>5.2f}{' / ':3}{item['ses_delta']:>5.2f}{' ':1}", format=Format.Bold, color=color)
-                        col1.append(f"{' ' + item['display_name'][:24-reduce]:{36-reduce}}{formated_times:14}")
-                    col1.append(seperator)
-                    col1.append(f"{' Camp Queue':{36-reduce}}{'Mins in queue':>13}{' ':1}")
-                    col1.append(seperator)
-                    
-                    for item in camp_queue:
-                        mins = int((now - com.datetime_from_timestamp(item['in_timestamp'])).total_seconds()/com.SECS_IN_MINUTE)
-                        tots = await db.get_user_hours_v2(guild.id, item['user'])
-                        ses_hours = ""
-                        user_urns = [x for x in urns if x['user'] == item['user']]
-                        if tots['session_total'] >= HOURS_SOFTCAP:
-                            color = TextColor.Red
-                            ses_hours = f"{{{tots['session_total']}}}"
-                        elif tots['session_total']:
-                            color = TextColor.Green
-                            ses_hours = f"{{{tots['session_total']}}}"
-                        else:
-                            color = TextColor.Green
-                        if user_urns:
-                            sorted(user_urns, key = lambda a: a['in_timestamp'])
-                            if user_urns[-1]['in_timestamp'] > int((now - datetime.timedelta(days=7)).timestamp()):
-                                color = TextColor.Pink
-                        formated_queue_item = ansi_format(f"{' ' + item['name'][:35-reduce] +' '+ ses_hours:{43-reduce}}{' @ ':3}{mins:3}{' ':1}", format=Format.Bold, color = color)
-                        col1.append(formated_queue_item)
-                    return col1
-                
-                async def get_col2(mobile=False):
-                    #Appending 2nd column
-                    col2 = []
-                    reduce = 0
-                    if mobile:
-                        reduce = 10
-                    seperator = get_seperator(mobile)
-                    col2.append(f" Top {ex_lines+cont_lines} in Hours")
-                    col2.append(seperator)
-                    for idx in range(ex_lines+cont_lines):
-                        if idx >= len(res):
-                            col2.append(f"")
-                            continue
-                        match idx:
-                            case 0:
-                                medal='🥇'
-                            case 1:
-                                medal='🥈'
-                            case 2:
-                                medal='🥉'
-                            case _:
-                                medal=''
-                        col2.append(f"{' ' + res[idx]['display_name'][:41-reduce]:{42-reduce}}{' ':1}{res[idx]['total']:>6.2f}{' ':1}{medal}")
-                    return col2
-                
-                col1 = await get_col1()
-                col2 = await get_col2()
-                now = com.get_current_datetime()
-                rec = await db.get_tod(guild.id)
-                if rec:
-                    spawn_timestamp = int((com.datetime_from_timestamp(rec["tod_timestamp"]) + datetime.timedelta(days=1)).timestamp())
-                 
-                title = f'_Last Updated: <t:{int(now.timestamp())}:R>.'
-                if rec and spawn_timestamp > now.timestamp():
-                    title += f' DS Spawn <t:{spawn_timestamp}:R> at <t:{spawn_timestamp}>'
-                title += f'_ ```ansi\n'
-                tail = "```\n"
-                
-                desktop_dash = title
-                for idx, _ in enumerate(col1):
-                    div = '|'
-                    if idx == 1:
-                        div = '-'
-                    if len(desktop_dash) < 1900:
-                        desktop_dash += col1[idx] + div + col2[idx]
-                    desktop_dash += '\n'
-                desktop_dash += tail
-                
-                mcol1 = await get_col1(True)
-                mcol2 = await get_col2(True)
-                
-                mobile_dash = title
-                
-                for idx in range(len(mcol1)):
-                    mobile_dash += mcol1[idx] + '\n'
-                mobile_dash += '\n' + get_seperator(True) + '\n'
-                for idx in range(len(mcol2)):
-                    if len(mobile_dash) < 1900:
-                        mobile_dash += mcol2[idx] + '\n'
-                mobile_dash += tail
-                
-                
-                if not session_real:
-                    desktop_dash += "Paused till session start. "
-                    mobile_dash += "Paused till session start. "
-                    
-                    if self.open_transitioned.get(guild.id):
-                        desktop_dash += "Camp is open!"
-                        mobile_dash += "Camp is open!"
-                        
-                    await self.dash_message[guild.id].edit(content=desktop_dash)
-                    
-                    
-                    if mobile_channel and mobile_channel.permissions_for(guild.get_member(self.bot.user.id)).send_messages:
-                        await self.dash_mobile_message[guild.id].edit(content=mobile_dash)
-                    else:
-                        print(f'{guild.id} mobile channel {mobile_channel} could not sent permissions or config not in')
-                    
-                    self.delay[guild.id] = True
-                else:
-                    await self.dash_message[guild.id].edit(content=desktop_dash)
-                    
-                    if mobile_channel and mobile_channel.permissions_for(guild.get_member(self.bot.user.id)).send_messages:
-                        await self.dash_mobile_message[guild.id].edit(content=mobile_dash)
-                    else:
-                        print(f'{guild.id} mobile channel {mobile_channel} could not sent permissions or config not in')
-                    
-                    self.open_transitioned[guild.id] = False
-                    self.delay[guild.id] = False
-            except discord.errors.DiscordServerError as e:
-                print("Couldnt connect to discord API")
-                print(full_stack())
-                continue
-            except Exception as e:
-                print(f"Printer raised unknown exception: {e}")
-                self.fail_count += 1
-                continue
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(DASH_CONCURRENCY)
+        now = com.get_current_timestamp()
+        guilds = [guild for guild in self.bot.guilds
+                  if self.fail_count.get(guild.id, 0) <= MAX_GUILD_FAILS and self.schedule.get(guild.id, {}).get('next', 0) <= now]
+        if not guilds:
+            return
+        async def run(guild):
+            async with semaphore:
+                await self._refresh_guild_safe(guild)
+        await asyncio.gather(*(run(guild) for guild in guilds))
+        elapsed = time.perf_counter() - start
+        failing = {guild_id: count for guild_id, count in self.fail_count.items() if count}
+        print(f'{com.get_current_iso()} - Dashboard tick refreshed {len(guilds)} guilds in {elapsed:.2f}s{f", failing {failing}" if failing else ""}', flush=True)
 
-    
-    def get_config(self, guild_id):
+    def _set_cadence(self, guild_id, cadence, reason, wake_at=None):
+        now = com.get_current_timestamp()
+        next_refresh = now + cadence.value
+        if wake_at and now < wake_at < next_refresh:
+            next_refresh = wake_at
+            reason += f', waking at <t:{wake_at}:t>'
+        self.schedule[guild_id] = {'cadence': cadence, 'next': next_refresh, 'reason': reason}
+
+    # Due on the next printer tick, used when something happened that the schedule doesn't know about
+    def _wake(self, guild_id):
+        if guild_id in self.schedule:
+            self.schedule[guild_id]['next'] = 0
+
+    # A config write can enable or move a dashboard, the guild is refreshed on the next tick
+    def _on_config_change(self, guild_id):
+        if guild_id is None:
+            self.schedule.clear()
+        else:
+            self.schedule.pop(guild_id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_state_change(self, guild_id, reason):
+        self.dirty.add(guild_id)
+        if guild_id not in self.pending_render:
+            self.pending_render[guild_id] = asyncio.create_task(self._debounced_render(guild_id))
+
+    async def _debounced_render(self, guild_id):
+        try:
+            while guild_id in self.dirty:
+                await asyncio.sleep(EVENT_DEBOUNCE)
+                # Anything published from here on needs another render
+                self.dirty.discard(guild_id)
+                guild = self.bot.get_guild(guild_id)
+                if not guild or self.fail_count.get(guild_id, 0) > MAX_GUILD_FAILS:
+                    return
+                await self._refresh_guild_safe(guild, woken=True)
+        finally:
+            self.pending_render.pop(guild_id, None)
+
+    # One guild's refresh, bounded by GUILD_REFRESH_TIMEOUT so a slow guild can't hold up the tick
+    async def _refresh_guild_safe(self, guild, woken=False):
+        lock = self.guild_locks.setdefault(guild.id, asyncio.Lock())
+        try:
+            async with lock:
+                await asyncio.wait_for(self._refresh_guild(guild, woken), timeout=GUILD_REFRESH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f'{com.get_current_iso()} [{guild.id}] - Dashboard refresh timed out after {GUILD_REFRESH_TIMEOUT}s', flush=True)
+            self._guild_failed(guild.id)
+            self._set_cadence(guild.id, Cadence.Active, 'retrying after a timeout')
+        except discord.errors.DiscordServerError as e:
+            print(f'{com.get_current_iso()} [{guild.id}] - Couldnt connect to discord API')
+            print(full_stack())
+            self._set_cadence(guild.id, Cadence.Active, 'retrying after a discord error')
+        except Exception as e:
+            print(f'{com.get_current_iso()} [{guild.id}] - Printer raised unknown exception: {e}')
+            self._guild_failed(guild.id)
+            self._set_cadence(guild.id, Cadence.Active, 'retrying after an error')
+        else:
+            self.fail_count[guild.id] = 0
+
+    def _guild_failed(self, guild_id):
+        self.fail_count[guild_id] = self.fail_count.get(guild_id, 0) + 1
+        if self.fail_count[guild_id] > MAX_GUILD_FAILS:
+            print(f'{com.get_current_iso()} [{guild_id}] - fail count above {MAX_GUILD_FAILS}, dashboard paused for this guild until /dashboardrestart', flush=True)
+
+    # A delayed dashboard with no session only changes on a guild_state_change or when the camp opens, so
+    # until then a tick needs no fetch or query for it. woken is set for renders caused by an event
+    def _waiting_for_open(self, guild_id, woken) -> bool:
+        if woken or not self.delay.get(guild_id) or guild_id not in self.camp_window:
+            return False
+        window = self.camp_window[guild_id]
+        if not window or self.open_transitioned.get(guild_id):
+            return True
+        now = com.get_current_timestamp()
+        return not window[0] <= now <= window[1]
+
+    async def _refresh_guild(self, guild, woken=False):
+        if not configs.loaded:
+            return
+        config = configs.get(guild.id)
+        if not config or not config.dashboard_channel:
+            self._set_cadence(guild.id, Cadence.Disabled, 'no dashboard configured')
+            return
+        if self._waiting_for_open(guild.id, woken):
+            window = self.camp_window[guild.id]
+            self._set_cadence(guild.id, Cadence.Idle, 'no session', wake_at=window[0] if window else None)
+            return
+        channel = await guild.fetch_channel(config.dashboard_channel)
+        mobile_channel = None
+        if config.mobile_dash_channel:
+            mobile_channel = await guild.fetch_channel(config.mobile_dash_channel)
+        if not self.dash_message.get(guild.id):
+            await channel.send(content=f'Starting Dashboard...', silent=True)
+        if not self.dash_mobile_message.get(guild.id):
+            await mobile_channel.send(content=f'Starting Dashboard...', silent=True)
+        session_real = await db.get_session(guild.id)
         now = com.get_current_datetime()
-        if self.cache_datetime and (now - self.cache_datetime).total_seconds() > 5 * com.SECS_IN_MINUTE:
-            self.refresh_cache_config()
-        if self.config_cache:
-            return self.config_cache.get(str(guild_id))
+        tod_dict = await db.get_tod(guild.id, mob_name="Drusella Sathir")
+        mins_till_ds_str = "Unknown"
+        mins_till_ds = -1
+        if tod_dict:
+            tod_datetime = com.datetime_from_timestamp(tod_dict['tod_timestamp']) + datetime.timedelta(days=1)
+            mins_till_ds = int((tod_datetime - now).total_seconds()/com.SECS_IN_MINUTE)
+            if mins_till_ds < 0:
+                mins_till_ds_str = "Unknown"
+            else:
+                mins_till_ds_str = f'{mins_till_ds:4}mins'
+        _open = ""
+        camp_hours = config.camp_hour_count
+        open_at = None
+        self.camp_window[guild.id] = None
+        if tod_dict:
+            open_at = int(tod_datetime.timestamp()) - camp_hours * com.SECS_IN_HOUR
+            self.camp_window[guild.id] = (open_at, int(tod_datetime.timestamp()))
+        if session_real:
+            self._set_cadence(guild.id, Cadence.Active, 'session active')
         else:
-            return None
+            # Wake exactly when the camp opens so the OPEN transition is picked up right away
+            self._set_cadence(guild.id, Cadence.Idle, 'no session', wake_at=open_at)
+        if mins_till_ds >= 0 and mins_till_ds <= com.MINUTE_IN_HOUR * camp_hours:
+            _open = "<OPEN>"
+            # If we are in delayed mode, and we havent refreshed with the new transition, refresh automatically
+            if self.delay.get(guild.id) and not self.open_transitioned.get(guild.id):
+                self.open_transitioned[guild.id] = True
+                self.delay[guild.id] = False
+                await self._purge_dashboard(guild)
+        if self.delay.get(guild.id) and session_real:
+            self.delay[guild.id] = False
+            await self._purge_dashboard(guild)
+                
+        elif self.delay.get(guild.id) and not session_real:
+            return
+        
+        
+        view = await self.build_view(guild, session_real, tod_dict, _open, mins_till_ds_str, now)
+        header = render_header(com.get_current_datetime())
+        desktop_dash = render_desktop(view, 1900 - len(header))
+        mobile_dash = render_mobile(view, 1900 - len(header))
+        
+        if not session_real:
+            self._declare_dash(guild.id, 'desktop', self.dash_message[guild.id], header, desktop_dash)
+            
+            
+            if mobile_channel and mobile_channel.permissions_for(guild.get_member(self.bot.user.id)).send_messages:
+                self._declare_dash(guild.id, 'mobile', self.dash_mobile_message[guild.id], header, mobile_dash)
+            else:
+                print(f'{guild.id} mobile channel {mobile_channel} could not sent permissions or config not in')
+            
+            self.delay[guild.id] = True
+        else:
+            self._declare_dash(guild.id, 'desktop', self.dash_message[guild.id], header, desktop_dash)
+            
+            if mobile_channel and mobile_channel.permissions_for(guild.get_member(self.bot.user.id)).send_messages:
+                self._declare_dash(guild.id, 'mobile', self.dash_mobile_message[guild.id], header, mobile_dash)
+            else:
+                print(f'{guild.id} mobile channel {mobile_channel} could not sent permissions or config not in')
+            
+            self.open_transitioned[guild.id] = False
+            self.delay[guild.id] = False
     
-    def refresh_cache_config(self):
-        self.cache_datetime = com.get_current_datetime()
-        self.config_cache = json.load(open('data/config.json', 'r', encoding='utf-8'))
+    # Data stage, every query and member lookup for one refresh. The result is only read by the renderers
+    async def build_view(self, guild, session_real, tod, open_label, ds_in, now) -> DashboardView:
+        actives = await db.get_all_actives(guild.id)
+        camp_queue = await db.get_replacement_queue(guild.id)
+        last_urns = await db.get_last_urns(guild.id)
+        probation_cutoff = int((now - datetime.timedelta(days=7)).timestamp())
+        def color_for(user, red):
+            if last_urns.get(user, 0) > probation_cutoff:
+                return TextColor.Pink
+            return TextColor.Red if red else TextColor.Green
+        
+        historical_recs_from_session = []
+        if session_real:
+            historical_recs_from_session = await db.get_historical_session(guild.id, session_real['session'])
+        session_hours = {}
+        for item in historical_recs_from_session:
+            if "PCT_BONUS" in item['character']:
+                continue
+            session_hours[item['user']] = session_hours.get(item['user'], 0) + com.get_hours_from_secs(item['out_timestamp'] - item['in_timestamp'])
         
+        active_members = await directory.fetch_many(guild, [item['user'] for item in actives])
+        active_rows = []
+        for item in actives:
+            member = active_members.get(int(item['user']))
+            delta = com.get_hours_from_secs(now.timestamp() - item['in_timestamp'])
+            ses_delta = round(delta + session_hours.get(item['user'], 0), 2)
+            active_rows.append(ActiveRow(member.display_name if member else 'placeholder', delta, ses_delta, color_for(item['user'], ses_delta >= HOURS_SOFTCAP)))
+        
+        queue_rows = []
+        if camp_queue:
+            queue_hours = {item['user']: item for item in await db.get_users_hours_v2(guild.id, [item['user'] for item in camp_queue])}
+            for item in camp_queue:
+                mins = int((now - com.datetime_from_timestamp(item['in_timestamp'])).total_seconds()/com.SECS_IN_MINUTE)
+                session_total = queue_hours[item['user']]['session_total']
+                ses_hours = f"{{{session_total}}}" if session_total else ""
+                queue_rows.append(QueueRow(item['name'], ses_hours, mins, color_for(item['user'], session_total >= HOURS_SOFTCAP)))
+        
+        # NOTE! Actives and Camp queue must be completed before this step as we are limiting based on the number of the aforementioned 
+        ex_lines = 7
+        top_count = ex_lines + len(actives) + len(camp_queue)
+        users = await db.get_unique_users(guild.id)
+        res = await db.get_users_hours_v2(guild.id, users, limit = top_count, trim_afk=True)
+        top_members = await directory.fetch_many(guild, [item['user'] for item in res])
+        top_rows = []
+        for item in res:
+            member = top_members.get(int(item['user']))
+            top_rows.append(TopRow(member.display_name if member else str(item['user']), item['total']))
+        
+        spawn_timestamp = None
+        if tod:
+            spawn_timestamp = int((com.datetime_from_timestamp(tod["tod_timestamp"]) + datetime.timedelta(days=1)).timestamp())
+            if spawn_timestamp <= now.timestamp():
+                spawn_timestamp = None
+        
+        return DashboardView(
+            open_label=open_label,
+            ds_in=ds_in,
+            session_name=session_real['session'] if session_real else "None",
+            session_start=com.datetime_from_timestamp(session_real['start_timestamp']).strftime("%b%d %I:%M%p") if session_real else '',
+            actives=tuple(active_rows),
+            queue=tuple(queue_rows),
+            top=tuple(top_rows),
+            top_count=top_count,
+            spawn_timestamp=spawn_timestamp,
+            paused=not session_real,
+            camp_open=bool(self.open_transitioned.get(guild.id)),
+        )
+    
 
 def full_stack():
     import traceback, sys
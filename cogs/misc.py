@@ -1,6 +1,5 @@
 # Builtin
 import datetime
-import json
 import time
 
 # External
@@ -9,6 +8,7 @@ from discord.ext import commands
 
 # Internal
 import data.databaseapi as db
+from data.config import configs
 import static.common as com
 from checks.IsAdmin import is_admin, NotAdmin
 from checks.IsCommandChannel import is_command_channel, NotCommandChannel
@@ -30,15 +30,6 @@ class Misc(commands.Cog):
     async def on_connect(self):
         pass
     
-    async def cog_before_invoke(self, ctx):
-        guild_id = 0
-        if ctx.guild:
-            guild_id = ctx.guild.id
-        now_iso = com.get_current_iso()
-        print(f'{now_iso} [{guild_id}] - Command {ctx.command.qualified_name} by {ctx.author.name} - {ctx.author.id} - {ctx.selected_options}', flush=True)
-        command = {'command_name': ctx.command.qualified_name, 'options': str(ctx.selected_options), 'datetime': now_iso, 'user': ctx.author.id, 'user_name': ctx.author.name, 'channel_name': ctx.channel.name}
-        await db.store_command(guild_id, command)
-        return
     
     # ==============================================================================
     # Error Handlers
@@ -113,15 +104,13 @@ class Misc(commands.Cog):
                           _key: discord.Option(str, name="key", choices=array_config + value_config, required=True),
                           _value: discord.Option(str, name="value", required=True)):
         
-        guild_config = get_guild_config(str(ctx.guild.id))
         if _key in value_config:
-            guild_config[_key] = int(_value)
+            res = await configs.set(ctx.guild.id, _key, int(_value))
         elif _key in array_config:
-            guild_config[_key].append(int(_value))
+            res = await configs.append(ctx.guild.id, _key, int(_value))
         else:
             raise TypeError('configuration item type not found, contact administrator')
-        save_guild_config(str(ctx.guild.id), guild_config)
-        await ctx.send_response(content=f"Config item set - {_key} = {guild_config[_key]}")
+        await ctx.send_response(content=f"Config item set - {_key} = {res}")
     
     @commands.slash_command(name='configaddbonushours', description='Add a set of bonus hours')
     @is_admin()
@@ -129,9 +118,6 @@ class Misc(commands.Cog):
                           _start: discord.Option(str, name="start", required=True),
                           _end: discord.Option(str, name="end", required=True),
                           _pct: discord.Option(int, name="pct", required=True)):
-        guild_config = get_guild_config(str(ctx.guild.id))
-        if not guild_config.get('bonus_hours'):
-            guild_config['bonus_hours'] = []
         try:
             _start = '0'+_start if len(_start) == 4 else _start
             _end = '0'+end if len(_end) == 4 else _end
@@ -142,17 +128,14 @@ class Misc(commands.Cog):
             await ctx.send_response(content=f"Invalid input for value: {err}")
             return
         
-        guild_config['bonus_hours'].append({"start":_start, "end":_end, "pct": _pct})
-        save_guild_config(str(ctx.guild.id), guild_config)
-        await ctx.send_response(content=f"Config item set - bonus_hours = {guild_config['bonus_hours']}")
+        res = await configs.append(ctx.guild.id, 'bonus_hours', {"start":_start, "end":_end, "pct": _pct})
+        await ctx.send_response(content=f"Config item set - bonus_hours = {res}")
     
     @commands.slash_command(name='configclearitem', description='Clear a configuration item, will need to set values again')
     @is_admin()
     async def _config_clear_item(self, ctx, _key: discord.Option(name="key", choices=array_config+value_config+special_config, required=True)):
-        guild_config = get_guild_config(str(ctx.guild.id))
-        guild_config[_key] = ""
-        save_guild_config(str(ctx.guild.id), guild_config)
-        await ctx.send_response(content=f"Config item cleared - {_key} = {guild_config[_key]}")
+        res = await configs.set(ctx.guild.id, _key, "")
+        await ctx.send_response(content=f"Config item cleared - {_key} = {res}")
     
     @commands.slash_command(name='echo', description='Echo echo echo......')
     @is_admin()
@@ -160,22 +143,6 @@ class Misc(commands.Cog):
         await ctx.channel.send(content=content)
         await ctx.send_response(content="Your word is my command", ephemeral=True)
 
-def get_guild_config(guild_id):
-    config = json.load(open('data/config.json', 'r', encoding='utf-8'))
-    guild_config = config.get(str(guild_id))
-    if not guild_config:
-        guild_config = {}
-    return guild_config
-
-def save_guild_config(guild_id, new_guild_config):
-    config = get_config()
-    config[guild_id] = new_guild_config
-    json.dump(config, open('data/config.json', 'w', encoding='utf-8'), indent=1)
-    return True
-
-def get_config():
-    return json.load(open('data/config.json', 'r', encoding='utf-8'))
-
 def setup(bot):
     bot.add_cog(Misc(bot))
 
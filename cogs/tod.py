@@ -9,6 +9,7 @@ from discord.ext import commands
 # Internal
 import static.common as com
 import data.databaseapi as db
+from static.events import publish_guild_change
 from views.ClearOutView import ClearOutView
 from checks.IsAdmin import is_admin, NotAdmin
 from checks.IsCommandChannel import is_command_channel, NotCommandChannel
@@ -22,6 +23,13 @@ class Tod(commands.Cog):
         self.bot = bot
         print('Initilization on tod complete')
 
+    # Commands that change the ToD, listeners such as the dashboard re-render on these
+    STATE_COMMANDS = {'todnow', 'settod'}
+
+    async def cog_after_invoke(self, ctx):
+        if ctx.guild and ctx.command.qualified_name in self.STATE_COMMANDS:
+            publish_guild_change(self.bot, ctx.guild.id, ctx.command.qualified_name)
+
     @commands.Cog.listener()
     async def on_ready(self):
         missing_tables = await db.check_tables(['tod'])
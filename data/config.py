@@ -0,0 +1,151 @@
+# Guild configuration service
+# Guild config lives in the guild_config table, one row per guild and key. It is loaded once into memory
+# and every write updates its row in one statement and then reloads that guild, so readers never see a
+# stale entry. Each guild entry is parsed into a GuildConfig, bonus hour windows become time objects.
+# A config.json left from older versions is imported on the first load and renamed out of the way.
+import asyncio
+import copy
+import datetime
+import json
+import os
+from typing import NamedTuple
+
+import data.databaseapi as db
+import static.common as com
+
+LEGACY_CONFIG_PATH = 'data/config.json'
+DEFAULT_CAMP_HOURS = 18
+
+class BonusWindow(NamedTuple):
+    start: datetime.time
+    end: datetime.time
+    ratio: float
+    # As written in the config, used to label the bonus records
+    start_iso: str
+    end_iso: str
+    pct: object
+
+def _as_int(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+def _as_ints(value) -> list:
+    if not value:
+        return []
+    return [int(item) for item in value]
+
+def parse_bonus_windows(items) -> tuple:
+    windows = []
+    for item in items or []:
+        windows.append(BonusWindow(
+            start=datetime.time.fromisoformat(item['start']),
+            end=datetime.time.fromisoformat(item['end']),
+            ratio=float(item['pct']) / 100,
+            start_iso=item['start'],
+            end_iso=item['end'],
+            pct=item['pct'],
+        ))
+    return tuple(windows)
+
+class GuildConfig:
+    """One guild's configuration with typed values, raw keeps the entry as stored"""
+    def __init__(self, guild_id, raw: dict):
+        self.guild_id = int(guild_id)
+        self.raw = raw
+        self.member_roles = _as_ints(raw.get('member_roles'))
+        self.admin_roles = _as_ints(raw.get('admin_roles'))
+        self.command_channels = _as_ints(raw.get('command_channels'))
+        self.channel_stats = _as_ints(raw.get('channel_stats'))
+        self.max_active = _as_int(raw.get('max_active'))
+        self.dashboard_channel = _as_int(raw.get('dashboard_channel'))
+        self.mobile_dash_channel = _as_int(raw.get('mobile_dash_channel'))
+        self.countdown_stats = _as_int(raw.get('countdown_stats'))
+        self.campstatus_stats = _as_int(raw.get('campstatus_stats'))
+        self.active_stats = _as_int(raw.get('active_stats'))
+        camp_hours = _as_int(raw.get('camp_hour_count'))
+        self.camp_hour_count = camp_hours if camp_hours is not None else DEFAULT_CAMP_HOURS
+        self.bonus_hours = parse_bonus_windows(raw.get('bonus_hours'))
+
+    def __repr__(self):
+        return f'{self.raw}'
+
+class ConfigService:
+    def __init__(self, legacy_path=LEGACY_CONFIG_PATH):
+        self.legacy_path = legacy_path
+        self._raw = {}
+        self._guilds = {}
+        self._lock = asyncio.Lock()
+        self.loaded = False
+        self.loads = 0
+        # Called with the guild id after a write, None after a full load
+        self.listeners = []
+
+    async def _import_legacy(self):
+        if not os.path.exists(self.legacy_path):
+            return
+        with open(self.legacy_path, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+        count = await db.import_guild_configs(legacy)
+        if count:
+            print(f'{com.get_current_iso()} - Imported config for {count} guilds from {self.legacy_path}', flush=True)
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+    def _store(self, guild_id, entry):
+        if entry:
+            self._raw[guild_id] = entry
+            self._guilds[guild_id] = GuildConfig(guild_id, entry)
+        else:
+            self._raw.pop(guild_id, None)
+            self._guilds.pop(guild_id, None)
+
+    async def load(self, force=False):
+        """Loads every guild's config, only once unless forced"""
+        async with self._lock:
+            if self.loaded and not force:
+                return
+            await db.wait_initialized()
+            await self._import_legacy()
+            raw = await db.get_guild_configs()
+            self._raw = {}
+            self._guilds = {}
+            for guild_id, entry in raw.items():
+                self._store(guild_id, entry)
+            self.loaded = True
+            self.loads += 1
+        self._notify(None)
+
+    async def _reload(self, guild_id):
+        self._store(int(guild_id), await db.get_guild_config(guild_id))
+        self._notify(int(guild_id))
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def _notify(self, guild_id):
+        for callback in self.listeners:
+            callback(guild_id)
+
+    def get(self, guild_id) -> GuildConfig:
+        """The guild's config, None if the guild has no entry"""
+        return self._guilds.get(int(guild_id))
+
+    def raw(self, guild_id) -> dict:
+        """Copy of the guild's entry as stored"""
+        return copy.deepcopy(self._raw.get(int(guild_id)) or {})
+
+    async def set(self, guild_id, key, value):
+        await db.set_guild_config_value(guild_id, key, value)
+        await self._reload(guild_id)
+        return value
+
+    async def append(self, guild_id, key, item) -> list:
+        res = await db.append_guild_config_value(guild_id, key, item)
+        await self._reload(guild_id)
+        return res
+
+configs = ConfigService()
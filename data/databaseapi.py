@@ -1,13 +1,146 @@
 import aiosqlite
+import asyncio
+import json
+import os
 import time
-from static.common import get_hours_from_secs, get_current_timestamp, SECS_IN_WEEK
+from contextlib import asynccontextmanager
+from data import migrations
+from static.common import get_hours_from_secs, get_current_timestamp, SECS_IN_DAY, SECS_IN_WEEK
 from datetime import datetime
 
 HOURS_SOFTCAP = 5
 
+DB_PATH = 'data/urnby.db'
+READER_COUNT = 4
+# Per connection prepared statement cache, every query uses constant SQL text with bound parameters so repeats are hits
+STATEMENT_CACHE_SIZE = 256
+
+# Connection level PRAGMAs, applied once to every pooled connection when it is opened
+STORAGE_PROFILES = {
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+}
+STORAGE_PROFILE = os.getenv('DB_STORAGE_PROFILE', 'default')
+
+    # ==============================================================================
+    # Connection pool
+    # ==============================================================================
+
+class ConnectionPool:
+    """Long lived connections shared by the whole bot.
+
+    Readers are borrowed exclusively from a bounded queue, all writes go through
+    the single writer connection so SQLite never sees two competing writers.
+    """
+    def __init__(self, path, readers=READER_COUNT, profile=STORAGE_PROFILE):
+        self.path = path
+        self.reader_count = readers
+        self.profile = STORAGE_PROFILES[profile]
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, read_only=False):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = aiosqlite.Row
+        for pragma, value in self.profile.items():
+            await conn.execute(f"PRAGMA {pragma} = {value}")
+        if read_only:
+            await conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    async def open(self):
+        # Writer first so journal_mode=WAL is in place before readers attach
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            conn = await self._connect(read_only=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        print(f"Database pool opened on {self.path} with {self.reader_count} readers, profile {self.profile}", flush=True)
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers = []
+            self._readers = asyncio.Queue()
+            if self._writer:
+                await self._writer.close()
+                self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            # Never hand an open transaction to the next borrower
+            if self._writer.in_transaction:
+                await self._writer.rollback()
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+async def get_pool() -> ConnectionPool:
+    # Cogs start their loops and listeners before bot.on_ready, so open lazily on first use
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(DB_PATH)
+                await pool.open()
+                _pool = pool
+    return _pool
+
+async def close_database():
+    global _pool
+    if _pool is not None:
+        await command_log.flush()
+        await _pool.close()
+        _pool = None
+
+@asynccontextmanager
+async def _reader():
+    pool = await get_pool()
+    async with pool.reader() as db:
+        yield db
+
+@asynccontextmanager
+async def _writer():
+    pool = await get_pool()
+    async with pool.writer() as db:
+        yield db
+
+    # ==============================================================================
+    # Setup
+    # ==============================================================================
+
 async def check_tables(tbls):
     l = []
-    async with aiosqlite.connect('data/urnby.db') as db:
+    async with _reader() as db:
         query = "SELECT name FROM sqlite_master WHERE type='table';"
         async with db.execute(query) as cursor:
             rows = await cursor.fetchall()
@@ -17,118 +150,250 @@ async def check_tables(tbls):
         return []
     return set(tbls) - set(l)
         
+# Set once the schema is migrated, for loaders that start before on_ready has run init_database
+_initialized = asyncio.Event()
+
 async def init_database():
-    async with aiosqlite.connect('data/urnby.db') as db:
-        tables = [
-        """CREATE TABLE IF NOT EXISTS "historical"(server, user, character, session, in_timestamp, out_timestamp, _DEBUG_user_name, _DEBUG_in, _DEBUG_out, _DEBUG_delta);""",
-        """CREATE TABLE IF NOT EXISTS "session"(server, session, created_by, _DEBUG_started_by, _DEBUG_start, start_timestamp, ended_by, _DEBUG_ended_by, _DEBUG_end, end_timestamp, _DEBUG_delta);""",
-        """CREATE TABLE IF NOT EXISTS "session_history"(server, session, created_by, _DEBUG_started_by, _DEBUG_start, start_timestamp, ended_by, _DEBUG_ended_by, _DEBUG_end, end_timestamp,      _DEBUG_delta);""",
-        """CREATE TABLE IF NOT EXISTS "active"(server, user, character, session, in_timestamp, out_timestamp, _DEBUG_user_name, _DEBUG_in, _DEBUG_out, _DEBUG_delta);""",
-        """CREATE TABLE IF NOT EXISTS "commands"(server, command_name, options, datetime, user, user_name, channel_name);""",
-        """CREATE TABLE IF NOT EXISTS "tod"(server, mob, tod_timestamp, submitted_timestamp, submitted_by_id, _DEBUG_submitted_datetime, _DEBUG_submitted_by, _DEBUG_tod_datetime);""",
-        """CREATE TABLE IF NOT EXISTS "reps"(server, user, name, in_timestamp, UNIQUE(server, user));""",
-        ]
-        for query in tables:
-            await db.execute(query)
-        await db.commit()
+    async with _writer() as db:
+        await migrations.migrate(db)
+    await state_cache.preload()
+    _initialized.set()
+
+async def wait_initialized():
+    await _initialized.wait()
 
 async def flush_wal():
-    async with aiosqlite.connect('data/urnby.db') as db:
+    # Checkpoint instead of toggling journal_mode, which fails while pooled connections are open
+    async with _writer() as db:
         try:
-            query = f"""PRAGMA journal_mode = DELETE"""
+            query = "PRAGMA wal_checkpoint(TRUNCATE)"
             res = await db.execute(query)
-            await db.commit()
-            print(f"Database mode set to: {await res.fetchall()}", flush=True)
-            query = f"""PRAGMA journal_mode = WAL"""
-            res = await db.execute(query)
-            await db.commit()
-            print(f"Database mode set to: {await res.fetchall()}", flush=True)
+            print(f"Database WAL checkpoint: {[tuple(row) for row in await res.fetchall()]}", flush=True)
         except aiosqlite.OperationalError as err:
-            print(f"Failed flushing WAL, are there multiple connections to the database?", flush=True)
+            print(f"Failed flushing WAL, {err}", flush=True)
             return False
     return True
 
 async def set_db_to_wal():
-    async with aiosqlite.connect('data/urnby.db') as db:
-            query = f"PRAGMA journal_mode=WAL"
-            res = await db.execute(query)
-            print(f"Database mode set to: {await res.fetchall()}",flush=True)
-            await db.commit() 
+    async with _writer() as db:
+        query = "PRAGMA journal_mode=WAL"
+        res = await db.execute(query)
+        print(f"Database mode set to: {[tuple(row) for row in await res.fetchall()]}",flush=True)
             
+    # ==============================================================================
+    # Guild state cache (session, active and reps tables)
+    # ==============================================================================
+
+SESSION_COLUMNS = ['session', 'created_by', '_DEBUG_started_by', '_DEBUG_start', 'start_timestamp', 'ended_by', '_DEBUG_ended_by', '_DEBUG_end', 'end_timestamp', '_DEBUG_delta']
+ACTIVE_COLUMNS = ['user', 'character', 'session', 'in_timestamp', 'out_timestamp', '_DEBUG_user_name', '_DEBUG_in', '_DEBUG_out', '_DEBUG_delta']
+REP_COLUMNS = ['user', 'name', 'in_timestamp']
+
+# Builds the dict a "SELECT rowid, *" would return for a row we just wrote
+def _as_row(rowid, guild_id, columns, record):
+    return {'rowid': rowid, 'server': int(guild_id), **{col: record[col] for col in columns}}
+
+class GuildState:
+    def __init__(self, session, actives, reps):
+        self.session = session
+        # Keyed by user, insertion order is rowid order like the tables
+        self.actives = {int(item['user']): item for item in actives}
+        self.reps = {int(item['user']): item for item in reps}
+        # Replacement queue tiering inputs, derived from historical so dropped on any historical write
+        self.tiers = None
+
+class StateCache:
+    """Write-through copy of each guild's session, actives and reps.
+
+    Writers update the cached state after their commit, readers are served from memory
+    once a guild is loaded. Every call hands out copies so callers can't mutate the cache.
+    """
+    def __init__(self):
+        self._states = {}
+        # Bumped by every write, a load that raced a write is thrown away instead of cached
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _read(self, guild_id) -> GuildState:
+        async with _reader() as db:
+            async with db.execute("SELECT rowid, * FROM session WHERE server = ?", (guild_id,)) as cursor:
+                sessions = [dict(row) for row in await cursor.fetchall()]
+            async with db.execute("SELECT rowid, * FROM active WHERE server = ? ORDER BY rowid", (guild_id,)) as cursor:
+                actives = [dict(row) for row in await cursor.fetchall()]
+            async with db.execute("SELECT rowid, * FROM reps WHERE server = ? ORDER BY rowid", (guild_id,)) as cursor:
+                reps = [dict(row) for row in await cursor.fetchall()]
+        if len(sessions) > 1:
+            raise ValueError(f'Error, server {guild_id} has more then one active session {len(sessions)}')
+        return GuildState(sessions[0] if sessions else None, actives, reps)
+
+    async def get(self, guild_id) -> GuildState:
+        guild_id = int(guild_id)
+        state = self._states.get(guild_id)
+        if state is not None:
+            self.hits += 1
+            return state
+        self.misses += 1
+        version = self.version(guild_id)
+        state = await self._read(guild_id)
+        if self.version(guild_id) == version:
+            self._states[guild_id] = state
+        return state
+
+    async def preload(self):
+        async with _reader() as db:
+            query = "SELECT server FROM session UNION SELECT server FROM active UNION SELECT server FROM reps"
+            async with db.execute(query) as cursor:
+                guilds = [row[0] for row in await cursor.fetchall()]
+        for guild_id in guilds:
+            await self.get(guild_id)
+        print(f"State cache loaded for {len(self._states)} guilds", flush=True)
+
+    # Called by writers after commit with a function that applies the change to a loaded state
+    def update(self, guild_id, change=None):
+        guild_id = int(guild_id)
+        self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+        state = self._states.get(guild_id)
+        if state is not None and change is not None:
+            change(state)
+
+    def drop_tiers(self, guild_id):
+        def change(state):
+            state.tiers = None
+        self.update(guild_id, change)
+
+    def version(self, guild_id) -> int:
+        return self._versions.get(int(guild_id), 0)
+
+    def invalidate(self, guild_id=None):
+        """Forget cached state, for one guild or all of them, after the tables were changed outside this module"""
+        if guild_id is None:
+            for guild in list(self._states):
+                self.update(guild)
+            self._states.clear()
+            return
+        self.update(guild_id)
+        self._states.pop(int(guild_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'guilds': len(self._states), 'hits': self.hits, 'misses': self.misses, 'hit_ratio': round(self.hits / total, 4) if total else 0}
+
+state_cache = StateCache()
+
     # ==============================================================================
     # Session (session or session_history tables)
     # ============================================================================== 
     
 async def get_session(guild_id):
-    res = {}
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM session WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
-            rows = await cursor.fetchall()
-            if len(rows) < 1:
-                return None
-            elif len(rows) > 1:
-                raise ValueError(f'Error, server {guild_id} has more then one active session {len(rows)}')
-            res = dict(rows[0])
-    return res
+    state = await state_cache.get(guild_id)
+    if state.session is None:
+        return None
+    return dict(state.session)
     
 async def set_session(guild_id, session):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
+    async with _writer() as db:
         # Only one session allowed per server
-        query = f"""SELECT count(*) FROM session WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
+        query = "SELECT count(*) FROM session WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             res = await cursor.fetchall()
             if dict(res[0])['count(*)'] != 0:
                 return None
         # Session name must be unique
-        query = f"""SELECT count(*) FROM session_history WHERE server = {guild_id} AND session = '{session['session']}'"""
-        async with db.execute(query) as cursor:
+        query = "SELECT count(*) FROM session_history WHERE server = ? AND session = ?"
+        async with db.execute(query, (int(guild_id), session['session'])) as cursor:
             res = await cursor.fetchall()
             if dict(res[0])['count(*)'] != 0:
                 return None
             
-        query = f"""INSERT INTO session(server,      session,  created_by,  _DEBUG_started_by,  _DEBUG_start,  start_timestamp,  ended_by,  _DEBUG_ended_by,  _DEBUG_end,  end_timestamp,  _DEBUG_delta)
-                                 VALUES({guild_id}, :session, :created_by, :_DEBUG_started_by, :_DEBUG_start, :start_timestamp, :ended_by, :_DEBUG_ended_by, :_DEBUG_end, :end_timestamp, :_DEBUG_delta)"""
-        async with db.execute(query, session) as cursor:
+        query = """INSERT INTO session(server,  session,  created_by,  _DEBUG_started_by,  _DEBUG_start,  start_timestamp,  ended_by,  _DEBUG_ended_by,  _DEBUG_end,  end_timestamp,  _DEBUG_delta)
+                                VALUES(:server, :session, :created_by, :_DEBUG_started_by, :_DEBUG_start, :start_timestamp, :ended_by, :_DEBUG_ended_by, :_DEBUG_end, :end_timestamp, :_DEBUG_delta)"""
+        async with db.execute(query, {**session, 'server': int(guild_id)}) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        row = _as_row(lastrow, guild_id, SESSION_COLUMNS, session)
+        def change(state):
+            state.session = row
+            state.tiers = None
+        state_cache.update(guild_id, change)
     return lastrow
 
 async def delete_session(guild_id):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT count(*) FROM session WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
+    async with _writer() as db:
+        query = "SELECT count(*) FROM session WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             res = await cursor.fetchall()
             if dict(res[0])['count(*)'] != 1:
                 return None
-        query = f"""DELETE FROM session WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
+        query = "DELETE FROM session WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        def change(state):
+            state.session = None
+            state.tiers = None
+        state_cache.update(guild_id, change)
     return lastrow
 
 
 async def store_historical_session(guild_id, session):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"""INSERT INTO session_history(server,      session,  created_by,  _DEBUG_started_by,  _DEBUG_start,  start_timestamp,  ended_by,  _DEBUG_ended_by,  _DEBUG_end,  end_timestamp,  _DEBUG_delta)
-                                         VALUES({guild_id}, :session, :created_by, :_DEBUG_started_by, :_DEBUG_start, :start_timestamp, :ended_by, :_DEBUG_ended_by, :_DEBUG_end, :end_timestamp, :_DEBUG_delta)"""
-        async with db.execute(query, session) as cursor:
+    async with _writer() as db:
+        query = """INSERT INTO session_history(server,  session,  created_by,  _DEBUG_started_by,  _DEBUG_start,  start_timestamp,  ended_by,  _DEBUG_ended_by,  _DEBUG_end,  end_timestamp,  _DEBUG_delta)
+                                        VALUES(:server, :session, :created_by, :_DEBUG_started_by, :_DEBUG_start, :start_timestamp, :ended_by, :_DEBUG_ended_by, :_DEBUG_end, :end_timestamp, :_DEBUG_delta)"""
+        async with db.execute(query, {**session, 'server': int(guild_id)}) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
     return lastrow
 
+# Closes the session in one transaction: every active is moved to historical along with its bonus
+# records, the session is archived and the replacement queue cleared. get_bonuses(record, row) returns
+# the bonus records for a closed out record. Returns None if there was no session to end
+async def end_session(guild_id, session, ended_at, get_bonuses=None) -> dict:
+    closed = []
+    bonuses = []
+    async with _writer() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        query = "SELECT count(*) FROM session WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
+            if (await cursor.fetchone())[0] != 1:
+                return None
+        query = "SELECT * FROM active WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
+            actives = [dict(row) for row in await cursor.fetchall()]
+        await db.execute("DELETE FROM active WHERE server = ?", (int(guild_id),))
+        for record in actives:
+            record['_DEBUG_out'] = ended_at.isoformat()
+            record['out_timestamp'] = int(ended_at.timestamp())
+            record['_DEBUG_delta'] = get_hours_from_secs(record['out_timestamp']-record['in_timestamp'])
+            row = await _insert_historical(db, guild_id, record)
+            closed.append({'record': record, 'row': row})
+            if not get_bonuses:
+                continue
+            for bonus in get_bonuses(record, row) or []:
+                bonus_row = await _insert_historical(db, guild_id, bonus)
+                bonuses.append({'record': bonus, 'row': bonus_row})
+        query = """INSERT INTO session_history(server,  session,  created_by,  _DEBUG_started_by,  _DEBUG_start,  start_timestamp,  ended_by,  _DEBUG_ended_by,  _DEBUG_end,  end_timestamp,  _DEBUG_delta)
+                                        VALUES(:server, :session, :created_by, :_DEBUG_started_by, :_DEBUG_start, :start_timestamp, :ended_by, :_DEBUG_ended_by, :_DEBUG_end, :end_timestamp, :_DEBUG_delta)"""
+        await db.execute(query, {**session, 'server': int(guild_id)})
+        await db.execute("DELETE FROM session WHERE server = ?", (int(guild_id),))
+        await db.execute("DELETE FROM reps WHERE server = ?", (int(guild_id),))
+        await db.commit()
+        def change(state):
+            state.session = None
+            state.actives.clear()
+            state.reps.clear()
+            state.tiers = None
+        state_cache.update(guild_id, change)
+        bump_historical_version(guild_id)
+    return {'closed': closed, 'bonuses': bonuses}
+
 async def get_last_rows_historical_session(guild_id, count):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM session_history WHERE server = {guild_id} ORDER BY rowid DESC LIMIT {count}"""
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM session_history WHERE server = ? ORDER BY rowid DESC LIMIT ?"
+        async with db.execute(query, (int(guild_id), int(count))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
@@ -138,125 +403,108 @@ async def get_last_rows_historical_session(guild_id, count):
     # ==============================================================================
     
 async def get_all_actives(guild_id) -> list:
-    res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM active WHERE server = {guild_id}"
-        async with db.execute(query) as cursor:
-            rows = await cursor.fetchall()
-            res = [dict(row) for row in rows]
-    return res
+    state = await state_cache.get(guild_id)
+    return [dict(item) for item in state.actives.values()]
 
 async def is_user_active(guild_id, user_id) -> bool:
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT count(*) FROM active WHERE server = {guild_id} AND user = {user_id}"
-        async with db.execute(query) as cursor:
-            res = await cursor.fetchall()
-            return dict(res[0])['count(*)'] != 0
+    state = await state_cache.get(guild_id)
+    return int(user_id) in state.actives
 
 # Returns None if user was already in active
 async def store_active_record(guild_id, record):
-    guild_actives = await get_all_actives(str(guild_id))
-    for item in guild_actives:
-        if item['user'] == record['user']:
-            return None
-            
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"""INSERT INTO active(server,      user,  character,  session,  in_timestamp,  out_timestamp,  _DEBUG_user_name,  _DEBUG_in,  _DEBUG_out,  _DEBUG_delta)
-                                VALUES({guild_id}, :user, :character, :session, :in_timestamp, :out_timestamp, :_DEBUG_user_name, :_DEBUG_in, :_DEBUG_out, :_DEBUG_delta)"""
-        async with db.execute(query, record) as cursor:
+    async with _writer() as db:
+        # Checked under the write lock, the cache can't change while we hold it
+        if await is_user_active(guild_id, record['user']):
+            return None
+        query = """INSERT INTO active(server,  user,  character,  session,  in_timestamp,  out_timestamp,  _DEBUG_user_name,  _DEBUG_in,  _DEBUG_out,  _DEBUG_delta)
+                               VALUES(:server, :user, :character, :session, :in_timestamp, :out_timestamp, :_DEBUG_user_name, :_DEBUG_in, :_DEBUG_out, :_DEBUG_delta)"""
+        async with db.execute(query, {**record, 'server': int(guild_id)}) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        row = _as_row(lastrow, guild_id, ACTIVE_COLUMNS, record)
+        def change(state):
+            state.actives[int(row['user'])] = row
+        state_cache.update(guild_id, change)
     return lastrow
 
 # Returns None if user not in active
 async def remove_active_record(guild_id, record):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-
+    async with _writer() as db:
         if not await is_user_active(guild_id, record['user']):
             return None
-
-        query = f"""DELETE FROM active WHERE server = {guild_id} AND user = {record['user']}"""
-        async with db.execute(query) as cursor:
+        query = "DELETE FROM active WHERE server = ? AND user = ?"
+        async with db.execute(query, (int(guild_id), int(record['user']))) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        state_cache.update(guild_id, lambda state: state.actives.pop(int(record['user']), None))
     return lastrow
 
 async def get_historical_session(guild_id, session_name):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM historical WHERE server = {guild_id} AND session = '{session_name}'"""
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND session = ?"
+        async with db.execute(query, (int(guild_id), session_name)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_historical(guild_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id}"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_session_history(guild_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM session_history WHERE server = {guild_id}"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM session_history WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_last_rows_historical(guild_id, count):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM historical WHERE server = {guild_id} ORDER BY rowid DESC LIMIT {count}"""
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? ORDER BY rowid DESC LIMIT ?"
+        async with db.execute(query, (int(guild_id), int(count))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_historical_user(guild_id, user_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {user_id}"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND user = ?"
+        async with db.execute(query, (int(guild_id), int(user_id))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
     
 async def get_historical_user_current_hours(guild_id, user_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {user_id} AND character LIKE 'URN_ZERO_OUT_EVENT%' ORDER BY out_timestamp DESC LIMIT 1"
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND user = ? AND character LIKE 'URN_ZERO_OUT_EVENT%' ORDER BY out_timestamp DESC LIMIT 1"
         last_urn = 0
-        async with db.execute(query) as cursor:
+        async with db.execute(query, (int(guild_id), int(user_id))) as cursor:
             rows = await cursor.fetchall()
             last_urn = [dict(row) for row in rows][0]['in_timestamp']
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {user_id} AND out_timestamp > {last_urn}"
-        async with db.execute(query) as cursor:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND user = ? AND out_timestamp > ?"
+        async with db.execute(query, (int(guild_id), int(user_id), last_urn)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_hisorical_user_last_record(guild_id, user_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {user_id} ORDER BY out_timestamp DESC LIMIT 1"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND user = ? ORDER BY out_timestamp DESC LIMIT 1"
+        async with db.execute(query, (int(guild_id), int(user_id))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows][0]
     return res
@@ -271,87 +519,338 @@ async def get_historical_user_current_bonus(guild_id, user_id):
     
 async def get_historical_record(guild_id, rowid):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND rowid = {rowid}"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? AND rowid = ?"
+        async with db.execute(query, (int(guild_id), int(rowid))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
-        await db.commit()
     return res
     
+# Inserts on the writer and keeps user_totals in step, caller commits
+async def _insert_historical(db, guild_id, record):
+    query = """INSERT INTO historical(server,  user,  character,  session,  in_timestamp,  out_timestamp,  _DEBUG_user_name,  _DEBUG_in,  _DEBUG_out,  _DEBUG_delta)
+                               VALUES(:server, :user, :character, :session, :in_timestamp, :out_timestamp, :_DEBUG_user_name, :_DEBUG_in, :_DEBUG_out, :_DEBUG_delta)"""
+    async with db.execute(query, {**record, 'server': int(guild_id)}) as cursor:
+        lastrow = cursor.lastrowid
+    await _add_to_user_totals(db, guild_id, record)
+    return lastrow
+
+# Bumped after every committed insert or delete on a guild's historical rows, anything derived from
+# historical is valid for as long as the version it was read at is current
+_historical_versions = {}
+
+def historical_version(guild_id) -> int:
+    return _historical_versions.get(int(guild_id), 0)
+
+def bump_historical_version(guild_id):
+    _historical_versions[int(guild_id)] = historical_version(guild_id) + 1
+
 async def store_new_historical(guild_id, record):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"""INSERT INTO historical(server,      user,  character,  session,  in_timestamp,  out_timestamp,  _DEBUG_user_name,  _DEBUG_in,  _DEBUG_out,  _DEBUG_delta)
-                                    VALUES({guild_id}, :user, :character, :session, :in_timestamp, :out_timestamp, :_DEBUG_user_name, :_DEBUG_in, :_DEBUG_out, :_DEBUG_delta)"""
-        async with db.execute(query, record) as cursor:
-            lastrow = cursor.lastrowid
+    async with _writer() as db:
+        lastrow = await _insert_historical(db, guild_id, record)
         await db.commit()
+        state_cache.drop_tiers(guild_id)
+        bump_historical_version(guild_id)
     return lastrow
 
+# Clocks one user out in one transaction: the active record is moved to historical along with its bonus
+# records, get_bonuses(record, row) as for end_session. Returns None if the user was not active
+async def close_active_record(guild_id, record, get_bonuses=None) -> dict:
+    bonuses = []
+    async with _writer() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        query = "DELETE FROM active WHERE server = ? AND user = ?"
+        async with db.execute(query, (int(guild_id), int(record['user']))) as cursor:
+            if not cursor.rowcount:
+                return None
+        row = await _insert_historical(db, guild_id, record)
+        for bonus in (get_bonuses(record, row) or []) if get_bonuses else []:
+            bonus_row = await _insert_historical(db, guild_id, bonus)
+            bonuses.append({'record': bonus, 'row': bonus_row})
+        await db.commit()
+        def change(state):
+            state.actives.pop(int(record['user']), None)
+            state.tiers = None
+        state_cache.update(guild_id, change)
+        bump_historical_version(guild_id)
+    return {'row': row, 'bonuses': bonuses}
+
 async def delete_historical_record(guild_id, rowid):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"DELETE FROM historical WHERE server = {guild_id} AND rowid = {rowid}"
-        async with db.execute(query) as cursor:
+    async with _writer() as db:
+        query = "SELECT user FROM historical WHERE server = ? AND rowid = ?"
+        async with db.execute(query, (int(guild_id), int(rowid))) as cursor:
+            row = await cursor.fetchone()
+        query = "DELETE FROM historical WHERE server = ? AND rowid = ?"
+        async with db.execute(query, (int(guild_id), int(rowid))) as cursor:
             res = await cursor.fetchall()
+        if row:
+            await _rebuild_user_totals(db, guild_id, row['user'])
         await db.commit()
+        state_cache.drop_tiers(guild_id)
+        bump_historical_version(guild_id)
     return res
     
+# Replaces the bonus records of every clocked record that started in [start, end) in one transaction.
+# get_bonuses(records) returns the new bonus records for a list of source records (with rowid).
+# Returns the number of source records, removed and added bonus records
+async def replace_bonus_records(guild_id, start, end, get_bonuses) -> dict:
+    async with _writer() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        query = """SELECT rowid, * FROM historical WHERE server = :server AND in_timestamp >= :start AND in_timestamp < :end
+                   AND NOT instr(character, 'BONUS') AND NOT instr(character, 'URN_ZERO_OUT_EVENT')"""
+        async with db.execute(query, {'server': int(guild_id), 'start': int(start), 'end': int(end)}) as cursor:
+            sources = [dict(row) for row in await cursor.fetchall()]
+        # Bonus records name their source row after the first space of character, bonus labels have no spaces
+        query = """DELETE FROM historical WHERE server = :server AND instr(character, '_PCT_BONUS_')
+                   AND CAST(substr(character, instr(character, ' ') + 1) AS INTEGER) IN (SELECT value FROM json_each(:rows))"""
+        async with db.execute(query, {'server': int(guild_id), 'rows': json.dumps([source['rowid'] for source in sources])}) as cursor:
+            removed = cursor.rowcount
+        bonuses = get_bonuses(sources) or []
+        query = """INSERT INTO historical(server,  user,  character,  session,  in_timestamp,  out_timestamp,  _DEBUG_user_name,  _DEBUG_in,  _DEBUG_out,  _DEBUG_delta)
+                               VALUES(:server, :user, :character, :session, :in_timestamp, :out_timestamp, :_DEBUG_user_name, :_DEBUG_in, :_DEBUG_out, :_DEBUG_delta)"""
+        await db.executemany(query, [{**record, 'server': int(guild_id)} for record in bonuses])
+        await _rebuild_user_totals(db, guild_id)
+        await db.commit()
+        state_cache.drop_tiers(guild_id)
+        bump_historical_version(guild_id)
+    return {'sources': len(sources), 'removed': removed, 'added': len(bonuses)}
+
+    # ==============================================================================
+    # User totals (user_totals table, derived from historical)
+    # ==============================================================================
+
+USER_TOTALS_AGGREGATE = """SELECT server, user,
+                                  total(out_timestamp - in_timestamp),
+                                  total(CASE WHEN instr(character, 'BONUS') THEN out_timestamp - in_timestamp END),
+                                  total(CASE WHEN in_timestamp < out_timestamp THEN out_timestamp - in_timestamp END),
+                                  count(CASE WHEN instr(character, 'URN_ZERO_OUT_EVENT') THEN 1 END),
+                                  max(max(in_timestamp), 0),
+                                  max(max(out_timestamp), 0)
+                           FROM historical"""
+
+# Must be called on the writer inside the same transaction as the historical insert
+async def _add_to_user_totals(db, guild_id, record):
+    delta = record['out_timestamp'] - record['in_timestamp']
+    params = {
+        'server': int(guild_id),
+        'user': int(record['user']),
+        'total': delta,
+        'bonus_total': delta if 'BONUS' in record['character'] else 0,
+        'lifetime_total': delta if record['in_timestamp'] < record['out_timestamp'] else 0,
+        'urns': 1 if 'URN_ZERO_OUT_EVENT' in record['character'] else 0,
+        'last_in': record['in_timestamp'],
+        'last_out': record['out_timestamp'],
+    }
+    query = """INSERT INTO user_totals(server,  user,  total,  bonus_total,  lifetime_total,  urns,  last_in,  last_out)
+                                VALUES(:server, :user, :total, :bonus_total, :lifetime_total, :urns, max(:last_in, 0), max(:last_out, 0))
+               ON CONFLICT(server, user) DO UPDATE SET total = total + excluded.total,
+                                                       bonus_total = bonus_total + excluded.bonus_total,
+                                                       lifetime_total = lifetime_total + excluded.lifetime_total,
+                                                       urns = urns + excluded.urns,
+                                                       last_in = max(last_in, excluded.last_in),
+                                                       last_out = max(last_out, excluded.last_out)"""
+    await db.execute(query, params)
+
+# Recomputes from historical, for one user when given, otherwise the whole guild. Caller commits
+async def _rebuild_user_totals(db, guild_id, user=None):
+    if user is None:
+        await db.execute("DELETE FROM user_totals WHERE server = ?", (int(guild_id),))
+        await db.execute(f"INSERT INTO user_totals {USER_TOTALS_AGGREGATE} WHERE server = ? GROUP BY user", (int(guild_id),))
+        return
+    await db.execute("DELETE FROM user_totals WHERE server = ? AND user = ?", (int(guild_id), user))
+    await db.execute(f"INSERT INTO user_totals {USER_TOTALS_AGGREGATE} WHERE server = ? AND user = ? GROUP BY user", (int(guild_id), user))
+
+async def rebuild_user_totals(guild_id) -> int:
+    async with _writer() as db:
+        await _rebuild_user_totals(db, guild_id)
+        async with db.execute("SELECT count(*) FROM user_totals WHERE server = ?", (int(guild_id),)) as cursor:
+            count = (await cursor.fetchone())[0]
+        await db.commit()
+    return count
+
+async def get_user_totals(guild_id, user) -> dict:
+    async with _reader() as db:
+        query = "SELECT * FROM user_totals WHERE server = ? AND user = ?"
+        async with db.execute(query, (int(guild_id), int(user))) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    return dict(row)
+
+async def get_guild_user_totals(guild_id) -> dict:
+    res = {}
+    async with _reader() as db:
+        query = "SELECT * FROM user_totals WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
+            async for row in cursor:
+                res[row['user']] = dict(row)
+    return res
+
 async def get_last_urn(guild_id, user_id):
-    query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {user_id} AND character LIKE 'URN_ZERO_OUT_EVENT%' ORDER BY in_timestamp DESC LIMIT 1"
-    last_urn = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        async with db.execute(query) as cursor:
+    query = "SELECT rowid, * FROM historical WHERE server = ? AND user = ? AND character LIKE 'URN_ZERO_OUT_EVENT%' ORDER BY in_timestamp DESC LIMIT 1"
+    async with _reader() as db:
+        async with db.execute(query, (int(guild_id), int(user_id))) as cursor:
             row = await cursor.fetchone()
         if row:
             return dict(row)
         else:
             return None
     
+    # ==============================================================================
+    # Guild config (guild_config table)
+    # ==============================================================================
+# One row per guild and key, values are stored as JSON text
+
+async def get_guild_configs() -> dict:
+    """Every guild's config as {guild_id: {key: value}}"""
+    res = {}
+    async with _reader() as db:
+        query = "SELECT server, key, value FROM guild_config"
+        async with db.execute(query) as cursor:
+            async for row in cursor:
+                res.setdefault(int(row['server']), {})[row['key']] = json.loads(row['value'])
+    return res
+
+async def get_guild_config(guild_id) -> dict:
+    res = {}
+    async with _reader() as db:
+        query = "SELECT key, value FROM guild_config WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
+            async for row in cursor:
+                res[row['key']] = json.loads(row['value'])
+    return res
+
+async def set_guild_config_value(guild_id, key, value):
+    query = """INSERT INTO guild_config(server, key, value) VALUES(?, ?, ?)
+               ON CONFLICT(server, key) DO UPDATE SET value = excluded.value"""
+    async with _writer() as db:
+        await db.execute(query, (int(guild_id), key, json.dumps(value)))
+        await db.commit()
+
+# Appends to a list value in the same statement that reads it, a value that isn't a list is replaced
+async def append_guild_config_value(guild_id, key, item) -> list:
+    query = """INSERT INTO guild_config(server, key, value) VALUES(:server, :key, json_array(json(:item)))
+               ON CONFLICT(server, key) DO UPDATE SET value = json_insert(CASE WHEN json_type(value) = 'array' THEN value ELSE '[]' END, '$[#]', json(:item))
+               RETURNING value"""
+    async with _writer() as db:
+        async with db.execute(query, {'server': int(guild_id), 'key': key, 'item': json.dumps(item)}) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    return json.loads(row['value'])
+
+# Imports a config.json style dict, only if no guild config is stored yet. Returns the number of guilds imported
+async def import_guild_configs(config: dict) -> int:
+    async with _writer() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("SELECT count(*) FROM guild_config") as cursor:
+            if (await cursor.fetchone())[0]:
+                await db.rollback()
+                return 0
+        query = "INSERT INTO guild_config(server, key, value) VALUES(?, ?, ?)"
+        await db.executemany(query, [(int(guild_id), key, json.dumps(value))
+                                     for guild_id, entry in config.items() for key, value in (entry or {}).items()])
+        await db.commit()
+    return len(config)
+
     # ==============================================================================
     # Commands (commands table)
     # ============================================================================== 
 
+COMMAND_FLUSH_COUNT = 25
+COMMAND_FLUSH_MS = 2000
+
+class CommandLog:
+    """Write-behind buffer for the commands audit table.
+
+    Entries are queued in memory and written with one executemany transaction once
+    flush_count entries are pending or flush_ms has passed since the first one queued.
+    """
+    def __init__(self, flush_count=COMMAND_FLUSH_COUNT, flush_ms=COMMAND_FLUSH_MS):
+        self.flush_count = flush_count
+        self.flush_ms = flush_ms
+        self.pending = []
+        self._timer = None
+        self._tasks = set()
+        self._flush_lock = asyncio.Lock()
+
+    def enqueue(self, guild_id, command):
+        self.pending.append({**command, 'server': int(guild_id)})
+        loop = asyncio.get_running_loop()
+        if len(self.pending) >= self.flush_count:
+            self._flush_in_background()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_ms / 1000, self._flush_in_background)
+
+    def _flush_in_background(self):
+        task = asyncio.ensure_future(self._safe_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _safe_flush(self):
+        try:
+            await self.flush()
+        except Exception as err:
+            print(f"Failed flushing {len(self.pending)} command log entries, will retry: {err}", flush=True)
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, []
+            try:
+                async with _writer() as db:
+                    query = """INSERT INTO commands(server,  command_name,  options,  datetime,  user,  user_name,  channel_name)
+                                             VALUES(:server, :command_name, :options, :datetime, :user, :user_name, :channel_name)"""
+                    await db.executemany(query, batch)
+                    await db.commit()
+            except Exception:
+                # Keep order, entries queued while we were failing go after the batch
+                self.pending = batch + self.pending
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(self.flush_ms / 1000, self._flush_in_background)
+                raise
+            return len(batch)
+
+command_log = CommandLog()
+
+# Buffered, the row is written by the next command_log flush
 async def store_command(guild_id, command):
-    lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"""INSERT INTO commands(server,      command_name,  options,  datetime,  user,  user_name,  channel_name)
-                                  VALUES({guild_id}, :command_name, :options, :datetime, :user, :user_name, :channel_name)"""
-        async with db.execute(query, command) as cursor:
-            lastrow = cursor.lastrowid
-        await db.commit()
-    return lastrow
+    command_log.enqueue(guild_id, command)
     
 async def get_commands_history(guild_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM commands WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
+    # Unflushed entries must be visible to readers
+    await command_log.flush()
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM commands WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_last_rows_commands_history(guild_id, count) -> list[dict]:
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT rowid, * FROM commands WHERE server = {guild_id} ORDER BY rowid DESC LIMIT {count}"""
-        async with db.execute(query) as cursor:
+    await command_log.flush()
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM commands WHERE server = ? ORDER BY rowid DESC LIMIT ?"
+        async with db.execute(query, (int(guild_id), int(count))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
 async def get_user_commands_history(guild_id, user_id, start_at=None, count=10) -> list[dict]:
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
+    await command_log.flush()
+    async with _reader() as db:
         if start_at:
             count += start_at
-        query = f"""SELECT rowid, * FROM commands WHERE server = {guild_id} and user = {user_id} ORDER BY rowid DESC LIMIT {count}"""
-        async with db.execute(query) as cursor:
+        query = "SELECT rowid, * FROM commands WHERE server = ? and user = ? ORDER BY rowid DESC LIMIT ?"
+        async with db.execute(query, (int(guild_id), int(user_id), int(count))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
         if start_at:
@@ -361,12 +860,12 @@ async def get_user_commands_history(guild_id, user_id, start_at=None, count=10)
     # Tod
     # ============================================================================== 
 
+# Latest ToD submitted for the guild whatever the mob, mob_name is not used for filtering
 async def get_tod(guild_id, mob_name="Drusella Sathir") -> dict:
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM tod WHERE server = {guild_id} ORDER BY submitted_timestamp DESC LIMIT 1"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM tod WHERE server = ? ORDER BY submitted_timestamp DESC LIMIT 1"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             row = await cursor.fetchone()
             if not row:
                 return None
@@ -375,10 +874,10 @@ async def get_tod(guild_id, mob_name="Drusella Sathir") -> dict:
     
 async def store_tod(guild_id, info):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        query = f"""INSERT INTO tod(server,       mob,  tod_timestamp,  submitted_timestamp,  submitted_by_id,  _DEBUG_submitted_datetime,  _DEBUG_submitted_by,  _DEBUG_tod_datetime)
-                             VALUES({guild_id}, :mob, :tod_timestamp, :submitted_timestamp, :submitted_by_id, :_DEBUG_submitted_datetime, :_DEBUG_submitted_by, :_DEBUG_tod_datetime)"""
-        async with db.execute(query, info) as cursor:
+    async with _writer() as db:
+        query = """INSERT INTO tod(server,  mob,  tod_timestamp,  submitted_timestamp,  submitted_by_id,  _DEBUG_submitted_datetime,  _DEBUG_submitted_by,  _DEBUG_tod_datetime)
+                            VALUES(:server, :mob, :tod_timestamp, :submitted_timestamp, :submitted_by_id, :_DEBUG_submitted_datetime, :_DEBUG_submitted_by, :_DEBUG_tod_datetime)"""
+        async with db.execute(query, {**info, 'server': int(guild_id)}) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
     return lastrow
@@ -387,24 +886,44 @@ async def store_tod(guild_id, info):
     # Replacement Queue
     # ============================================================================== 
 
+# Tiering inputs for every rep, aggregated in one query instead of per rep lookups
+async def _get_replacement_tiers(guild_id) -> dict:
+    tiers = {}
+    async with _reader() as db:
+        query = """SELECT user,
+                          coalesce(sum(CASE WHEN session = (SELECT session FROM session WHERE server = :server) AND NOT instr(character, 'BONUS') THEN out_timestamp END), 0)
+                            - coalesce(sum(CASE WHEN session = (SELECT session FROM session WHERE server = :server) AND NOT instr(character, 'BONUS') THEN in_timestamp END), 0) AS session_seconds,
+                          max(CASE WHEN character LIKE 'URN_ZERO_OUT_EVENT%' THEN in_timestamp END) AS last_urn
+                   FROM historical WHERE server = :server AND user IN (SELECT user FROM reps WHERE server = :server) GROUP BY user"""
+        async with db.execute(query, {'server': int(guild_id)}) as cursor:
+            async for row in cursor:
+                tiers[int(row['user'])] = dict(row)
+    return tiers
+
+# Queue order is green, then over HOURS_SOFTCAP this session (red), then urned in the last week (probation)
+# Tiers are cached with the guild state until the next historical, session or reps write
 async def get_replacement_queue(guild_id) -> list:
-    res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM reps WHERE server = {guild_id}"
-        async with db.execute(query) as cursor:
-            rows = await cursor.fetchall()
-            res = [dict(row) for row in rows]
+    state = await state_cache.get(guild_id)
+    # Same order the reps table scan gave through its UNIQUE(server, user) index
+    res = [dict(item) for item in sorted(state.reps.values(), key=lambda item: item['user'])]
+    if not res:
+        return res
+    tiers = state.tiers
+    if tiers is None:
+        version = state_cache.version(guild_id)
+        tiers = await _get_replacement_tiers(guild_id)
+        if state_cache.version(guild_id) == version:
+            state.tiers = tiers
+    probation_cutoff = get_current_timestamp() - SECS_IN_DAY * 7
     green_res = []
     red_res = []
     probation_res = []
     for item in res:
-        user_hours = await get_user_hours_v2(guild_id, item['user'])
-        if user_hours['session_total'] > HOURS_SOFTCAP:
+        tier = tiers.get(int(item['user']), {'session_seconds': 0, 'last_urn': None})
+        if get_hours_from_secs(int(tier['session_seconds'])) > HOURS_SOFTCAP:
             red_res.append(item)
             continue
-        last_user_urn = await get_last_urn(guild_id, item['user'])
-        if last_user_urn and last_user_urn['in_timestamp'] > int((get_current_timestamp() - datetime.timedelta(days=7)).timestamp()):
+        if tier['last_urn'] and tier['last_urn'] > probation_cutoff:
             probation_res.append(item)
             continue
         green_res.append(item)
@@ -414,31 +933,35 @@ async def get_replacement_queue(guild_id) -> list:
 
 async def add_replacement(guild_id, replacement):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
+    async with _writer() as db:
         try:
-            query = f"""INSERT INTO reps(server, user, name, in_timestamp)
-                                    VALUES({guild_id}, :user, :name, :in_timestamp)"""
-            async with db.execute(query, replacement) as cursor:
+            query = """INSERT INTO reps(server, user, name, in_timestamp)
+                                   VALUES(:server, :user, :name, :in_timestamp)"""
+            async with db.execute(query, {**replacement, 'server': int(guild_id)}) as cursor:
                 lastrow = cursor.lastrowid
         except aiosqlite.IntegrityError:
             return None
         else:
             await db.commit()
+            row = _as_row(lastrow, guild_id, REP_COLUMNS, replacement)
+            def change(state):
+                state.reps[int(row['user'])] = row
+                state.tiers = None
+            state_cache.update(guild_id, change)
     return lastrow
 
 async def remove_replacement(guild_id, user_id):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT count(*) FROM reps WHERE server = {guild_id} AND user = {user_id}"""
-        async with db.execute(query) as cursor:
-            res = await cursor.fetchall()
-            if dict(res[0])['count(*)'] == 0:
-                return None
-        query = f"""DELETE FROM reps WHERE server = {guild_id} AND user = {user_id}"""
-        async with db.execute(query) as cursor:
+    async with _writer() as db:
+        if await get_replacement(guild_id, user_id) is None:
+            return None
+        query = "DELETE FROM reps WHERE server = ? AND user = ?"
+        async with db.execute(query, (int(guild_id), int(user_id))) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        def change(state):
+            state.reps.pop(int(user_id), None)
+        state_cache.update(guild_id, change)
     return lastrow
     
 async def remove_replacements(guild_id, users=[]):
@@ -450,25 +973,24 @@ async def remove_replacements(guild_id, users=[]):
 
 async def clear_replacement_queue(guild_id):
     lastrow = 0
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""DELETE FROM reps WHERE server = {guild_id}"""
-        async with db.execute(query) as cursor:
+    async with _writer() as db:
+        query = "DELETE FROM reps WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             lastrow = cursor.lastrowid
         await db.commit()
+        def change(state):
+            state.reps.clear()
+            state.tiers = None
+        state_cache.update(guild_id, change)
     return lastrow
 
+# Same shape as 'SELECT * FROM reps', without the rowid
 async def get_replacement(guild_id, user_id):
-    res = {}
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f'''SELECT * FROM reps WHERE "server" = {guild_id} AND "user" = {user_id}'''
-        async with db.execute(query) as cursor:
-            rows = await cursor.fetchall()
-            if len(rows) < 1:
-                return None
-            res = dict(rows[0])
-    return res
+    state = await state_cache.get(guild_id)
+    rep = state.reps.get(int(user_id))
+    if rep is None:
+        return None
+    return {key: value for key, value in rep.items() if key != 'rowid'}
 
 async def get_replacements_before_user(guild_id, user_id) -> list:
 
@@ -476,14 +998,9 @@ async def get_replacements_before_user(guild_id, user_id) -> list:
     if not rep:
         rep = {'in_timestamp': get_current_timestamp()}
     
-    res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"""SELECT * FROM reps WHERE "server" = {guild_id} AND "in_timestamp" < {rep['in_timestamp']} ORDER BY in_timestamp DESC"""
-        async with db.execute(query) as cursor:
-            rows = await cursor.fetchall()
-            res = [dict(row) for row in rows]
-    return res
+    state = await state_cache.get(guild_id)
+    res = [{key: value for key, value in item.items() if key != 'rowid'} for item in state.reps.values() if item['in_timestamp'] < rep['in_timestamp']]
+    return sorted(res, key=lambda item: item['in_timestamp'], reverse=True)
 
     # ==============================================================================
     # Misc
@@ -492,153 +1009,160 @@ async def get_replacements_before_user(guild_id, user_id) -> list:
 # Returns list of int of unique users stored in historical for a given guild
 async def get_unique_users(guild_id) -> list[int]:
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT DISTINCT user FROM historical WHERE server = {guild_id}"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT DISTINCT user FROM historical WHERE server = ?"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [row['user'] for row in rows]
     return res
 
 async def get_user_last_session(guild_id, user):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f'SELECT rowid, * FROM historical WHERE "server" = {guild_id} AND "user" = {user} ORDER BY out_timestamp DESC LIMIT 1'
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = 'SELECT rowid, * FROM historical WHERE "server" = ? AND "user" = ? ORDER BY out_timestamp DESC LIMIT 1'
+        async with db.execute(query, (int(guild_id), int(user))) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res[0]
 
-async def get_user_seconds(guild_id, user, guild_historical=None):
-    
-    if not guild_historical:
-        guild_historical = await get_historical(guild_id)
-    
-    if not guild_historical:
-        return None
-        
-    found = [_ for _ in guild_historical if _['user'] == int(user)]
-    
-    if len(found) == 0:
+async def get_user_seconds(guild_id, user):
+    totals = await get_user_totals(guild_id, user)
+    if not totals:
         return 0
-    
-    in_tot = 0
-    out_tot = 0
-    for item in found:
-        in_tot += item['in_timestamp']
-        out_tot += item['out_timestamp']
-    return int(out_tot - in_tot)
-
-async def get_user_hours(guild_id, user, guild_historical=None, limit=None) -> float:
-    secs = await get_user_seconds(guild_id, user, guild_historical)
+    return int(totals['total'])
+
+async def get_user_hours(guild_id, user, limit=None) -> float:
+    secs = await get_user_seconds(guild_id, user)
     
     return get_hours_from_secs(secs)
 
-# Wraps get_users_hours but only needs one grab from historical json
+# Wraps get_users_hours but only needs one grab from user_totals
 async def get_users_hours(guild_id, users, limit=None) -> list[dict]:
-    guild_historical = await get_historical(guild_id)
+    guild_totals = await get_guild_user_totals(guild_id)
     res = []
-    if not guild_historical:
+    if not guild_totals:
         return res
     
     for user in users:
-        tot = await get_user_hours(guild_id, user, guild_historical, limit=limit)
+        totals = guild_totals.get(int(user))
+        tot = get_hours_from_secs(int(totals['total'])) if totals else get_hours_from_secs(0)
         res.append({'user': user, 'total':tot})
     sorted_res = list(sorted(res, key= lambda user: user['total'], reverse=True))
     if limit:
         sorted_res = sorted_res[:limit]
     return sorted_res
 
+# Top users by hours in one sorted, limited query on user_totals
+async def get_top_users_hours(guild_id, limit) -> list[dict]:
+    res = []
+    async with _reader() as db:
+        query = "SELECT user, total FROM user_totals WHERE server = ? ORDER BY total DESC, user LIMIT ?"
+        async with db.execute(query, (int(guild_id), int(limit))) as cursor:
+            async for row in cursor:
+                res.append({'user': row['user'], 'total': get_hours_from_secs(int(row['total']))})
+    return res
+
 async def get_urns(guild_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} and character LIKE 'URN_ZERO_OUT_EVENT%'"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? and character LIKE 'URN_ZERO_OUT_EVENT%'"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [row['user'] for row in rows]
     return res
     
 async def get_urns_v2(guild_id):
     res = []
-    async with aiosqlite.connect('data/urnby.db') as db:
-        db.row_factory = aiosqlite.Row
-        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} and character LIKE 'URN_ZERO_OUT_EVENT%'"
-        async with db.execute(query) as cursor:
+    async with _reader() as db:
+        query = "SELECT rowid, * FROM historical WHERE server = ? and character LIKE 'URN_ZERO_OUT_EVENT%'"
+        async with db.execute(query, (int(guild_id),)) as cursor:
             rows = await cursor.fetchall()
             res = [dict(row) for row in rows]
     return res
 
-async def get_user_seconds_v2(guild_id, user, guild_historical=None):
-    
-    
-    user_historical = await get_historical_user(guild_id, user)
-    
-    if len(user_historical) == 0:
-        return {'user': user, 'total': 0, 
+# Latest urn in_timestamp per user, {user: timestamp}
+async def get_last_urns(guild_id) -> dict:
+    res = {}
+    async with _reader() as db:
+        query = "SELECT user, max(in_timestamp) AS last_urn FROM historical WHERE server = ? AND character LIKE 'URN_ZERO_OUT_EVENT%' GROUP BY user"
+        async with db.execute(query, (int(guild_id),)) as cursor:
+            async for row in cursor:
+                res[row['user']] = row['last_urn']
+    return res
+
+# Per user totals for a guild computed in one aggregate query, keyed by user
+# Categories mirror the original per record loop: BONUS and URN_ZERO_OUT_EVENT are case sensitive substrings
+async def get_users_seconds_v2(guild_id, user=None) -> dict:
+    session = await get_session(guild_id)
+    params = {'server': int(guild_id), 'session': session['session'] if session else None}
+    # Only two possible statement texts, both stay in the statement cache
+    user_filter = ''
+    if user is not None:
+        user_filter = 'AND user = :user'
+        params['user'] = int(user)
+    query = f"""WITH agg AS (
+                    SELECT user,
+                           coalesce(sum(out_timestamp), 0) - coalesce(sum(in_timestamp), 0) AS total,
+                           coalesce(sum(CASE WHEN instr(character, 'BONUS') THEN out_timestamp END), 0)
+                             - coalesce(sum(CASE WHEN instr(character, 'BONUS') THEN in_timestamp END), 0) AS bonus_total,
+                           coalesce(sum(CASE WHEN in_timestamp < out_timestamp THEN out_timestamp END), 0)
+                             - coalesce(sum(CASE WHEN in_timestamp < out_timestamp THEN in_timestamp END), 0) AS lifetime_total,
+                           coalesce(sum(CASE WHEN session = :session AND NOT instr(character, 'BONUS') THEN out_timestamp END), 0)
+                             - coalesce(sum(CASE WHEN session = :session AND NOT instr(character, 'BONUS') THEN in_timestamp END), 0) AS session_total,
+                           count(CASE WHEN instr(character, 'URN_ZERO_OUT_EVENT') THEN 1 END) AS urns,
+                           max(max(in_timestamp), 0) AS latest_in,
+                           max(max(out_timestamp), 0) AS latest_out,
+                           max(rowid) AS last_row
+                    FROM historical WHERE server = :server {user_filter} GROUP BY user)
+                SELECT agg.*, historical._DEBUG_user_name AS display_name
+                FROM agg JOIN historical ON historical.rowid = agg.last_row"""
+    res = {}
+    async with _reader() as db:
+        async with db.execute(query, params) as cursor:
+            async for row in cursor:
+                item = dict(row)
+                del item['last_row']
+                for key in ('total', 'bonus_total', 'lifetime_total', 'session_total'):
+                    item[key] = int(item[key])
+                res[item['user']] = item
+    return res
+
+def _empty_user_seconds(user) -> dict:
+    return {'user': user, 'total': 0, 
                           'bonus_total': 0, 
                           'lifetime_total': 0,
-                          'session_total': 0}
-    session = await get_session(guild_id)
-    #god bless this mess
-    in_tot = 0
-    out_tot = 0
-    bonus_in_tot = 0
-    bonus_out_tot = 0
-    lifetime_in_tot = 0
-    lifetime_out_tot = 0
-    session_in_tot = 0
-    session_out_tot = 0
-    latest_in = 0
-    latest_out = 0
-    urns = 0
-    for item in user_historical:
-        in_tot += item['in_timestamp']
-        out_tot += item['out_timestamp']
-        if item['in_timestamp'] > latest_in:
-            latest_in = item['in_timestamp']
-        if item['out_timestamp'] > latest_out:
-            latest_out = item['out_timestamp']
-        if "URN_ZERO_OUT_EVENT" in item['character']:
-            urns += 1
-        if "BONUS" in item['character']:
-            bonus_in_tot += item['in_timestamp']
-            bonus_out_tot += item['out_timestamp']
-        if item['in_timestamp'] < item['out_timestamp']:
-            lifetime_in_tot += item['in_timestamp']
-            lifetime_out_tot += item['out_timestamp']
-        if session and item['session'] == session['session'] and "BONUS" not in item['character']:
-            session_in_tot += item['in_timestamp']
-            session_out_tot += item['out_timestamp']
-    return {'user': user, 'total': int(out_tot - in_tot), 
-                          'bonus_total': int(bonus_out_tot - bonus_in_tot), 
-                          'lifetime_total': int(lifetime_out_tot - lifetime_in_tot),
-                          'session_total': int(session_out_tot - session_in_tot),
-                          'urns': urns,
-                          'latest_in': latest_in,
-                          'latest_out': latest_out,
-                          'display_name': item['_DEBUG_user_name'],
+                          'session_total': 0,
+                          'urns': 0,
+                          'latest_in': 0,
+                          'latest_out': 0,
+                          'display_name': '',
                           }
 
-async def get_user_hours_v2(guild_id, user, limit=None) :
-    secs = await get_user_seconds_v2(guild_id, user)
+def _seconds_to_hours_v2(secs) -> dict:
     hours = secs
     hours['total'] = get_hours_from_secs(secs['total'])
     hours['bonus_total'] = get_hours_from_secs(secs['bonus_total'])
     hours['lifetime_total'] = get_hours_from_secs(secs['lifetime_total'])
     hours['session_total'] = get_hours_from_secs(secs['session_total'])
-    
-    
     return hours
 
+async def get_user_seconds_v2(guild_id, user, guild_historical=None):
+    res = await get_users_seconds_v2(guild_id, user)
+    # Keyed by int user id, callers may pass the id as a string
+    return res.get(int(user)) or _empty_user_seconds(user)
+
+async def get_user_hours_v2(guild_id, user, limit=None) :
+    secs = await get_user_seconds_v2(guild_id, user)
+    return _seconds_to_hours_v2(secs)
+
 async def get_users_hours_v2(guild_id, users, limit=None, trim_afk=False, print_info= False) -> list[dict]:
     res = []
     start = time.perf_counter()
+    guild_seconds = await get_users_seconds_v2(guild_id)
+    now = get_current_timestamp()
+    cutoff = now - (SECS_IN_WEEK * 2)
     for user in users:
-        item = await get_user_hours_v2(guild_id, user, limit=limit)
-        now = get_current_timestamp()
-        cutoff = now - (SECS_IN_WEEK * 2)
+        item = _seconds_to_hours_v2(guild_seconds.get(int(user)) or _empty_user_seconds(user))
         if item['latest_in'] <= cutoff or item['latest_out'] <= cutoff:
             if print_info:
                 since = round((now - item['latest_out']) / SECS_IN_WEEK, 2)
@@ -654,4 +1178,52 @@ async def get_users_hours_v2(guild_id, users, limit=None, trim_afk=False, print_
         sorted_res = sorted_res[:limit]
     end = time.perf_counter()
     #print(f"user hours performance: {end-start}")
-    return sorted_res
\ No newline at end of file
+    return sorted_res
+
+class LeaderboardCache:
+    """/list leaderboard per guild, served until the guild's historical version or session moves.
+
+    session_total is counted against the running session, so starting or ending one invalidates the
+    snapshot as well. Actives are not part of the totals. Snapshots are shared between callers and must
+    not be modified.
+    """
+    def __init__(self):
+        # guild_id -> ((historical version, session name), leaderboard)
+        self._snapshots = {}
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _key(self, guild_id) -> tuple:
+        session = await get_session(guild_id)
+        return (historical_version(guild_id), session['session'] if session else None)
+
+    async def get(self, guild_id) -> list[dict]:
+        guild_id = int(guild_id)
+        snapshot = self._snapshots.get(guild_id)
+        if snapshot and snapshot[0] == await self._key(guild_id):
+            self.hits += 1
+            return snapshot[1]
+        # One rebuild per guild, requests arriving meanwhile wait for it
+        async with self._locks.setdefault(guild_id, asyncio.Lock()):
+            key = await self._key(guild_id)
+            snapshot = self._snapshots.get(guild_id)
+            if snapshot and snapshot[0] == key:
+                self.hits += 1
+                return snapshot[1]
+            self.misses += 1
+            users = await get_unique_users(guild_id)
+            leaderboard = await get_users_hours_v2(guild_id, users)
+            self._snapshots[guild_id] = (key, leaderboard)
+        print(f"[{guild_id}] - Leaderboard snapshot rebuilt at historical version {key[0]}, session {key[1]}", flush=True)
+        return leaderboard
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'guilds': len(self._snapshots), 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0}
+
+leaderboard_cache = LeaderboardCache()
+
+async def get_leaderboard(guild_id) -> list[dict]:
+    return await leaderboard_cache.get(guild_id)
@@ -0,0 +1,83 @@
+# Streaming table exports for /get data
+# Rows are read in batches from a dedicated read only connection inside a worker thread and written
+# straight through gzip, so the event loop is never blocked and memory stays flat whatever the table size.
+# The whole export runs in one read transaction, on WAL that is a consistent snapshot of the table
+# while the bot keeps writing, no checkpoint or journal_mode change is needed.
+import asyncio
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+
+import data.databaseapi as db
+
+EXPORT_DIR = 'temp'
+EXPORT_BATCH = 1000
+EXPORT_COMPRESSLEVEL = 6
+EXPORT_FORMATS = ['jsonl', 'csv']
+
+EXPORT_QUERIES = {
+    'actives':           "SELECT rowid, * FROM active WHERE server = ?",
+    'historical':        "SELECT rowid, * FROM historical WHERE server = ?",
+    'session':           "SELECT rowid, * FROM session WHERE server = ?",
+    'commands':          "SELECT rowid, * FROM commands WHERE server = ?",
+    'historicalsession': "SELECT rowid, * FROM session_history WHERE server = ?",
+}
+
+def _write_jsonl(out, columns, batches):
+    for batch in batches:
+        out.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in batch)
+
+def _write_csv(out, columns, batches):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+
+WRITERS = {
+    'jsonl': _write_jsonl,
+    'csv':   _write_csv,
+}
+
+def _export(db_path, query, params, fmt, out_path) -> int:
+    count = 0
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, isolation_level=None)
+    try:
+        # Explicit read transaction, every batch comes from the same snapshot
+        conn.execute("BEGIN")
+        cursor = conn.execute(query, params)
+        columns = [col[0] for col in cursor.description]
+
+        def batches():
+            nonlocal count
+            while rows := cursor.fetchmany(EXPORT_BATCH):
+                count += len(rows)
+                yield rows
+
+        with gzip.open(out_path, 'wt', compresslevel=EXPORT_COMPRESSLEVEL, encoding='utf-8', newline='') as out:
+            WRITERS[fmt](out, columns, batches())
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return count
+
+async def export_table(guild_id, data_type, fmt='jsonl') -> tuple[str, int]:
+    """Export one guild's rows of a table to a gzip file, returns (path, row count). The caller removes the file"""
+    if data_type not in EXPORT_QUERIES:
+        raise ValueError(f'Unknown export type {data_type}')
+    if fmt not in WRITERS:
+        raise ValueError(f'Unknown export format {fmt}')
+    if data_type == 'commands':
+        # Buffered audit rows must be part of the export
+        await db.command_log.flush()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, out_path = tempfile.mkstemp(prefix=f'{guild_id}_{data_type}_', suffix=f'.{fmt}.gz', dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(_export, db.DB_PATH, EXPORT_QUERIES[data_type], (int(guild_id),), fmt, out_path)
+    except BaseException:
+        os.remove(out_path)
+        raise
+    return out_path, count
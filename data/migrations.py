@@ -0,0 +1,84 @@
+# Versioned schema migrations, applied automatically by databaseapi.init_database
+# The applied version is tracked in PRAGMA user_version. Each migration runs in its own
+# BEGIN IMMEDIATE transaction together with the version bump, so it is applied exactly once
+# and readers on WAL connections keep working while it runs. Only ever append to this list,
+# never edit a migration that has shipped.
+
+MIGRATIONS = [
+    # 1 - Baseline tables
+    [
+        """CREATE TABLE IF NOT EXISTS "historical"(server, user, character, session, in_timestamp, out_timestamp, _DEBUG_user_name, _DEBUG_in, _DEBUG_out, _DEBUG_delta);""",
+        """CREATE TABLE IF NOT EXISTS "session"(server, session, created_by, _DEBUG_started_by, _DEBUG_start, start_timestamp, ended_by, _DEBUG_ended_by, _DEBUG_end, end_timestamp, _DEBUG_delta);""",
+        """CREATE TABLE IF NOT EXISTS "session_history"(server, session, created_by, _DEBUG_started_by, _DEBUG_start, start_timestamp, ended_by, _DEBUG_ended_by, _DEBUG_end, end_timestamp,      _DEBUG_delta);""",
+        """CREATE TABLE IF NOT EXISTS "active"(server, user, character, session, in_timestamp, out_timestamp, _DEBUG_user_name, _DEBUG_in, _DEBUG_out, _DEBUG_delta);""",
+        """CREATE TABLE IF NOT EXISTS "commands"(server, command_name, options, datetime, user, user_name, channel_name);""",
+        """CREATE TABLE IF NOT EXISTS "tod"(server, mob, tod_timestamp, submitted_timestamp, submitted_by_id, _DEBUG_submitted_datetime, _DEBUG_submitted_by, _DEBUG_tod_datetime);""",
+        """CREATE TABLE IF NOT EXISTS "reps"(server, user, name, in_timestamp, UNIQUE(server, user));""",
+    ],
+    # 2 - Indexes on hot lookup columns
+    [
+        # get_historical_user, get_user_last_session, get_last_urn
+        """CREATE INDEX IF NOT EXISTS "idx_historical_server_user_out" ON "historical"(server, user, out_timestamp);""",
+        # get_historical_session
+        """CREATE INDEX IF NOT EXISTS "idx_historical_server_session" ON "historical"(server, session);""",
+        # get_user_commands_history, rowid is implicitly the last column of every index
+        """CREATE INDEX IF NOT EXISTS "idx_commands_server_user" ON "commands"(server, user);""",
+        # get_tod
+        """CREATE INDEX IF NOT EXISTS "idx_tod_server_mob_submitted" ON "tod"(server, mob, submitted_timestamp);""",
+        # set_session uniqueness check
+        """CREATE INDEX IF NOT EXISTS "idx_session_history_server_session" ON "session_history"(server, session);""",
+        # is_user_active, remove_active_record
+        """CREATE INDEX IF NOT EXISTS "idx_active_server_user" ON "active"(server, user);""",
+    ],
+    # 3 - Materialized per user totals, maintained by store_new_historical and delete_historical_record
+    [
+        """CREATE TABLE IF NOT EXISTS "user_totals"(server, user, total, bonus_total, lifetime_total, urns, last_in, last_out, PRIMARY KEY(server, user));""",
+        """INSERT OR REPLACE INTO user_totals(server, user, total, bonus_total, lifetime_total, urns, last_in, last_out)
+           SELECT server, user,
+                  total(out_timestamp - in_timestamp),
+                  total(CASE WHEN instr(character, 'BONUS') THEN out_timestamp - in_timestamp END),
+                  total(CASE WHEN in_timestamp < out_timestamp THEN out_timestamp - in_timestamp END),
+                  count(CASE WHEN instr(character, 'URN_ZERO_OUT_EVENT') THEN 1 END),
+                  max(max(in_timestamp), 0),
+                  max(max(out_timestamp), 0)
+           FROM historical GROUP BY server, user;""",
+    ],
+    # 4 - Per guild config rows, config.json is imported into it by data.config on first load
+    [
+        """CREATE TABLE IF NOT EXISTS "guild_config"(server, key, value, PRIMARY KEY(server, key));""",
+    ],
+    # 5 - get_tod returns the latest ToD of any mob, the index from 2 only served a lookup by mob
+    [
+        """DROP INDEX IF EXISTS "idx_tod_server_mob_submitted";""",
+        """CREATE INDEX IF NOT EXISTS "idx_tod_server_submitted" ON "tod"(server, submitted_timestamp);""",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+async def get_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def migrate(db) -> int:
+    """Apply every pending migration on the writer connection, returns the resulting version"""
+    version = await get_version(db)
+    while version < SCHEMA_VERSION:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-read inside the write lock in case another process migrated first
+            version = await get_version(db)
+            if version >= SCHEMA_VERSION:
+                await db.rollback()
+                break
+            for query in MIGRATIONS[version]:
+                await db.execute(query)
+            version += 1
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        print(f"Database migrated to schema version {version}", flush=True)
+    return version
@@ -0,0 +1,67 @@
+# Bonus records, per record datetime_combine loop (old behaviour) vs compiled second-of-day windows
+# The old loop is given correctly localized window bounds so both produce the same records, the outputs
+# are checked to be identical. Records span a DST change.
+# Run from the repository root: python -m perf.bench_bonus
+import datetime
+import random
+import time
+
+import static.bonus as bonus
+import static.common as com
+from data.config import parse_bonus_windows
+
+WINDOWS = parse_bonus_windows([{'start': '01:00', 'end': '05:30', 'pct': 50}, {'start': '12:00', 'end': '14:00', 'pct': 25}])
+SIZES = [100, 1000, 10000]
+
+def legacy_record_bonuses(windows, record, row):
+    bonuses = []
+    for window in windows:
+        _in = com.datetime_from_timestamp(record['in_timestamp'])
+        _out = com.datetime_from_timestamp(record['out_timestamp'])
+        for day in range((_out.date() - _in.date()).days+1):
+            date = _in.date()+datetime.timedelta(days=day)
+            bonus_in = com.ny_tz.localize(datetime.datetime.combine(date, window.start))
+            bonus_out = com.ny_tz.localize(datetime.datetime.combine(date, window.end))
+            if _in < bonus_out and _out > bonus_in:
+                duration = int(min(_out.timestamp()-_in.timestamp(),
+                               _out.timestamp()-bonus_in.timestamp(),
+                               bonus_out.timestamp()-_in.timestamp(),
+                               bonus_out.timestamp()-bonus_in.timestamp()))
+                duration = int(duration * window.ratio)
+                start = _in if _in > bonus_in else bonus_in
+                rec = dict(record)
+                rec['character'] = f'{window.pct}_PCT_BONUS_{window.start_iso}_TO_{window.end_iso} {row}'
+                rec['in_timestamp'] = int(start.timestamp())
+                rec['out_timestamp'] = int(start.timestamp()+duration)
+                rec['_DEBUG_in'] = com.datetime_from_timestamp(rec['in_timestamp']).isoformat()
+                rec['_DEBUG_out'] = com.datetime_from_timestamp(rec['out_timestamp']).isoformat()
+                rec['_DEBUG_delta'] = com.get_hours_from_secs(duration)
+                bonuses.append(rec)
+    return bonuses
+
+def make_records(count, rng):
+    # Around the November DST change
+    base = int(com.ny_tz.localize(datetime.datetime(2026, 10, 25)).timestamp())
+    records = []
+    for row in range(count):
+        _in = base + rng.randrange(14 * com.SECS_IN_DAY)
+        records.append(({'user': rng.randrange(50), 'character': 'char', 'session': 's', 'in_timestamp': _in,
+                         'out_timestamp': _in + rng.randrange(60, 30 * com.SECS_IN_HOUR), '_DEBUG_user_name': 'name',
+                         '_DEBUG_in': '', '_DEBUG_out': '', '_DEBUG_delta': 0}, row))
+    return records
+
+def main():
+    rng = random.Random(24)
+    for size in SIZES:
+        records = make_records(size, rng)
+        start = time.perf_counter()
+        legacy = [item for record, row in records for item in legacy_record_bonuses(WINDOWS, record, row)]
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        current = bonus.batch_bonuses(bonus.compile_windows(WINDOWS), records)
+        current_time = time.perf_counter() - start
+        assert sorted(legacy, key=repr) == sorted(current, key=repr), 'bonus records differ'
+        print(f'{size:6} records {len(current):6} bonuses  legacy {legacy_time*1e3:8.1f} ms  compiled {current_time*1e3:8.1f} ms')
+
+if __name__ == '__main__':
+    main()
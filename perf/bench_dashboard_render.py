@@ -0,0 +1,137 @@
+# Dashboard rendering, old concatenation + ansi_format per cell vs the view model renderers
+# Both render the same view, the outputs are checked to be identical.
+# Run from the repository root: python -m perf.bench_dashboard_render
+import random
+import time
+
+import cogs.dashboard as dash
+from cogs.dashboard import ActiveRow, QueueRow, TopRow, DashboardView, TextColor, Format
+
+ROUNDS = 2000
+
+def legacy_ansi_format(t, format=Format.Normal, exformat=None, background=None, color=None):
+    uni_esc = f'\u001b'
+    format_start = '['
+    format_end = 'm'
+    res = uni_esc + format_start
+    if format:
+        res += str(format.value)
+    else:
+        res += str(Format.Normal.value)
+    if exformat:
+        res += ';' + str(exformat.value)
+    if background:
+        res += ';' + str(background.value)
+    if color:
+        res += ';' + str(color.value)
+    res += format_end + t + uni_esc + format_start + str(Format.Normal.value) + format_end
+    return res
+
+def legacy_render(view, header):
+    def get_seperator(mobile=False):
+        reduce = dash.MOBILE_REDUCE_SPACE if mobile else 0
+        return f"{'-'*(50-reduce)}"
+
+    def get_col1(mobile=False):
+        col1 = []
+        reduce = dash.MOBILE_REDUCE_SPACE if mobile else 0
+        seperator = get_seperator(mobile)
+        col1.append(f"{' Active Session':15}{view.open_label:^{19-reduce}}{'DS in: ':7}{view.ds_in:8}{' ':1}")
+        col1.append(seperator)
+        col1.append(f"{' ' + view.session_name[:28-reduce]:{30-reduce}}{'@ ':2}{view.session_start:13}{' EST ':5}")
+        col1.append(seperator)
+        col1.append(f"{' Active Users':<{34-reduce}}{'Current / Total':>15}{' ':1}")
+        col1.append(seperator)
+        for item in view.actives:
+            formated_times = legacy_ansi_format(f"{item.delta:>5.2f}{' / ':3}{item.ses_delta:>5.2f}{' ':1}", format=Format.Bold, color=item.color)
+            col1.append(f"{' ' + item.name[:24-reduce]:{36-reduce}}{formated_times:14}")
+        col1.append(seperator)
+        col1.append(f"{' Camp Queue':{36-reduce}}{'Mins in queue':>13}{' ':1}")
+        col1.append(seperator)
+        for item in view.queue:
+            col1.append(legacy_ansi_format(f"{' ' + item.name[:35-reduce] +' '+ item.ses_hours:{43-reduce}}{' @ ':3}{item.mins:3}{' ':1}", format=Format.Bold, color=item.color))
+        return col1
+
+    def get_col2(mobile=False):
+        col2 = []
+        reduce = 10 if mobile else 0
+        col2.append(f" Top {view.top_count} in Hours")
+        col2.append(get_seperator(mobile))
+        for idx in range(view.top_count):
+            if idx >= len(view.top):
+                col2.append(f"")
+                continue
+            medal = ['🥇', '🥈', '🥉'][idx] if idx < 3 else ''
+            col2.append(f"{' ' + view.top[idx].name[:41-reduce]:{42-reduce}}{' ':1}{view.top[idx].total:>6.2f}{' ':1}{medal}")
+        return col2
+
+    title = header
+    if view.spawn_timestamp:
+        title += f' DS Spawn <t:{view.spawn_timestamp}:R> at <t:{view.spawn_timestamp}>'
+    title += f'_ ```ansi\n'
+    tail = "```\n"
+    col1 = get_col1()
+    col2 = get_col2()
+    desktop_dash = title
+    for idx, _ in enumerate(col1):
+        div = '-' if idx == 1 else '|'
+        if len(desktop_dash) < 1900:
+            desktop_dash += col1[idx] + div + col2[idx]
+        desktop_dash += '\n'
+    desktop_dash += tail
+    mcol1 = get_col1(True)
+    mcol2 = get_col2(True)
+    mobile_dash = title
+    for idx in range(len(mcol1)):
+        mobile_dash += mcol1[idx] + '\n'
+    mobile_dash += '\n' + get_seperator(True) + '\n'
+    for idx in range(len(mcol2)):
+        if len(mobile_dash) < 1900:
+            mobile_dash += mcol2[idx] + '\n'
+    mobile_dash += tail
+    if view.paused:
+        desktop_dash += "Paused till session start. "
+        mobile_dash += "Paused till session start. "
+        if view.camp_open:
+            desktop_dash += "Camp is open!"
+            mobile_dash += "Camp is open!"
+    return desktop_dash, mobile_dash
+
+def make_view(actives, queue, rng):
+    colors = [TextColor.Green, TextColor.Red, TextColor.Pink]
+    top = tuple(TopRow(f'member{idx}', round(rng.uniform(0, 400), 2)) for idx in range(7 + actives + queue - 2))
+    return DashboardView(
+        open_label='<OPEN>',
+        ds_in=f'{rng.randrange(2000):4}mins',
+        session_name='Evening camp',
+        session_start='Oct18 07:00PM',
+        actives=tuple(ActiveRow(f'active{idx}', round(rng.uniform(0, 6), 2), round(rng.uniform(0, 9), 2), rng.choice(colors)) for idx in range(actives)),
+        queue=tuple(QueueRow(f'queued{idx}', rng.choice(['', '{2.5}']), rng.randrange(300), rng.choice(colors)) for idx in range(queue)),
+        top=top,
+        top_count=7 + actives + queue,
+        spawn_timestamp=1800000000,
+        paused=False,
+        camp_open=False,
+    )
+
+def main():
+    rng = random.Random(15)
+    header = '_Last Updated: <t:1792310712:R>.'
+    for actives, queue in ((5, 2), (15, 8), (40, 20)):
+        view = make_view(actives, queue, rng)
+        legacy = legacy_render(view, header)
+        current = (header + dash.render_desktop(view, 1900 - len(header)), header + dash.render_mobile(view, 1900 - len(header)))
+        assert legacy == current, 'renderers differ'
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            legacy_render(view, header)
+        legacy_time = (time.perf_counter() - start) / ROUNDS
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            dash.render_desktop(view, 1900 - len(header))
+            dash.render_mobile(view, 1900 - len(header))
+        current_time = (time.perf_counter() - start) / ROUNDS
+        print(f'{actives:3} actives {queue:3} queued  legacy {legacy_time*1e6:8.1f} us  view model {current_time*1e6:8.1f} us')
+
+if __name__ == '__main__':
+    main()
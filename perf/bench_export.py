@@ -0,0 +1,57 @@
+# /get data export, fetchall + json.dump (old behaviour) vs streaming gzip export in a worker thread
+# Reports wall time and peak Python memory for each, and checks the JSONL export round trips.
+# Run from the repository root: python -m perf.bench_export
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import data.databaseapi as db
+import data.export as export
+
+GUILD = 1000
+SIZES = [10000, 100000]
+
+async def seed(rows):
+    await db.init_database()
+    records = [(GUILD, idx % 300, '', 'bench', idx, idx + 3600, f'user{idx % 300}', '', '', 1.0) for idx in range(rows)]
+    async with db._writer() as conn:
+        await conn.executemany("INSERT INTO historical VALUES (?,?,?,?,?,?,?,?,?,?)", records)
+        await conn.commit()
+
+async def legacy_export(tmp):
+    data = await db.get_historical(GUILD)
+    path = os.path.join(tmp, 'data.json')
+    json.dump(data, open(path, 'w', encoding='utf-8'), indent=1)
+    return path
+
+async def measure(label, coro):
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = await coro
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{label:12} {elapsed*1000:9.1f} ms  peak {peak / 1024 / 1024:7.2f} MiB')
+    return res
+
+async def main():
+    for rows in SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            export.EXPORT_DIR = tmp
+            await seed(rows)
+            print(f'{rows} rows')
+            await measure('legacy', legacy_export(tmp))
+            path, count = await measure('streaming', export.export_table(GUILD, 'historical', 'jsonl'))
+            with gzip.open(path, 'rt', encoding='utf-8') as src:
+                exported = [json.loads(line) for line in src]
+            assert count == rows and exported == await db.get_historical(GUILD)
+            await measure('streaming csv', export.export_table(GUILD, 'historical', 'csv'))
+            await db.close_database()
+
+if __name__ == '__main__':
+    asyncio.run(main())
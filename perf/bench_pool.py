@@ -0,0 +1,65 @@
+# Per call latency of the data layer, connect-per-call (old behaviour) vs the shared pool
+# Session and actives are served from StateCache, so the queries timed here are historical reads that
+# always reach SQLite and the difference is the connection handling alone.
+# Run from the repository root: python -m perf.bench_pool
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+import data.databaseapi as db
+
+GUILD = 1000
+CALLS = 500
+USER = 7
+
+async def legacy_get_historical_session(guild_id):
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND session = 'bench'"
+        async with conn.execute(query) as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+async def legacy_get_historical_user(guild_id):
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        query = f"SELECT rowid, * FROM historical WHERE server = {guild_id} AND user = {USER}"
+        async with conn.execute(query) as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+async def pooled_get_historical_session(guild_id):
+    return await db.get_historical_session(guild_id, 'bench')
+
+async def pooled_get_historical_user(guild_id):
+    return await db.get_historical_user(guild_id, USER)
+
+async def seed():
+    await db.init_database()
+    for user in range(40):
+        await db.store_new_historical(GUILD, {'user': user, 'character': '', 'session': 'bench', 'in_timestamp': 0, 'out_timestamp': 3600,
+                                              '_DEBUG_user_name': f'user{user}', '_DEBUG_in': '', '_DEBUG_out': '', '_DEBUG_delta': ''})
+
+async def timeit(label, func):
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        await func(GUILD)
+    elapsed = time.perf_counter() - start
+    print(f'{label:40} {elapsed/CALLS*1e6:10.1f} us/call')
+    return elapsed
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        await seed()
+        await timeit('get_historical_session connect-per-call', legacy_get_historical_session)
+        await timeit('get_historical_session pooled', pooled_get_historical_session)
+        await timeit('get_historical_user connect-per-call', legacy_get_historical_user)
+        await timeit('get_historical_user pooled', pooled_get_historical_user)
+        await db.close_database()
+
+if __name__ == '__main__':
+    asyncio.run(main())
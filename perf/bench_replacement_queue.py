@@ -0,0 +1,75 @@
+# get_replacement_queue, per rep lookups (old behaviour) vs one set based query
+# Also checks that both produce the same queue order. Run from the repository root: python -m perf.bench_replacement_queue
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import data.databaseapi as db
+from static.common import get_current_timestamp, SECS_IN_DAY
+
+GUILD = 1000
+USERS = 300
+REPS = 40
+HISTORICAL_ROWS = 20000
+CALLS = 20
+
+async def legacy_get_replacement_queue(guild_id) -> list:
+    async with db._reader() as conn:
+        query = f"SELECT rowid, * FROM reps WHERE server = {guild_id}"
+        async with conn.execute(query) as cursor:
+            res = [dict(row) for row in await cursor.fetchall()]
+    green_res = []
+    red_res = []
+    probation_res = []
+    for item in res:
+        user_hours = await db.get_user_hours_v2(guild_id, item['user'])
+        if user_hours['session_total'] > db.HOURS_SOFTCAP:
+            red_res.append(item)
+            continue
+        last_user_urn = await db.get_last_urn(guild_id, item['user'])
+        # The original compared against datetime.timedelta(days=7) and raised, this is the intended cutoff
+        if last_user_urn and last_user_urn['in_timestamp'] > get_current_timestamp() - SECS_IN_DAY * 7:
+            probation_res.append(item)
+            continue
+        green_res.append(item)
+    return green_res + red_res + probation_res
+
+async def seed():
+    await db.init_database()
+    now = get_current_timestamp()
+    await db.set_session(GUILD, {'session': 'bench', 'created_by': 1, 'ended_by': '', 'start_timestamp': now, 'end_timestamp': 0,
+                                 '_DEBUG_start': '', '_DEBUG_started_by': '', '_DEBUG_end': '', '_DEBUG_ended_by': '', '_DEBUG_delta': ''})
+    rng = random.Random(5)
+    records = []
+    for _ in range(HISTORICAL_ROWS):
+        user = rng.randrange(USERS)
+        _in = now - rng.randrange(SECS_IN_DAY * 30)
+        _out = _in + rng.randrange(1, 4 * 3600)
+        character = rng.choice(['', '', '', '', '50_PCT_BONUS_00:00_TO_06:00 1']) if rng.random() > 0.005 else 'URN_ZERO_OUT_EVENT -10'
+        session = 'bench' if rng.random() < 0.05 else 'old'
+        records.append((GUILD, user, character, session, _in, _out, f'user{user}', '', '', ''))
+    async with db._writer() as conn:
+        await conn.executemany("INSERT INTO historical VALUES (?,?,?,?,?,?,?,?,?,?)", records)
+        await conn.commit()
+    for user in rng.sample(range(USERS), REPS):
+        await db.add_replacement(GUILD, {'user': user, 'name': f'user{user}', 'in_timestamp': now - rng.randrange(3600)})
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        await seed()
+        legacy = await legacy_get_replacement_queue(GUILD)
+        current = await db.get_replacement_queue(GUILD)
+        assert legacy == current, (legacy, current)
+        print(f'Queue order matches for {len(current)} reps')
+        for label, func in (('per rep lookups', legacy_get_replacement_queue), ('set based', db.get_replacement_queue)):
+            start = time.perf_counter()
+            for _ in range(CALLS):
+                await func(GUILD)
+            print(f'{label:20} {(time.perf_counter() - start) / CALLS * 1000:8.2f} ms/call')
+        await db.close_database()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+# Repeated hot queries, interpolated SQL text (old behaviour) vs constant text with bound parameters
+# Interpolated ids give a new statement text per user so every call misses the statement cache
+# Run from the repository root: python -m perf.bench_statements
+import asyncio
+import os
+import tempfile
+import time
+
+import data.databaseapi as db
+
+GUILD = 1000
+USERS = 500
+ROUNDS = 4
+
+async def interpolated_is_user_active(conn, guild_id, user_id):
+    async with conn.execute(f"SELECT count(*) FROM active WHERE server = {guild_id} AND user = {user_id}") as cursor:
+        return (await cursor.fetchone())[0] != 0
+
+async def bound_is_user_active(conn, guild_id, user_id):
+    async with conn.execute("SELECT count(*) FROM active WHERE server = ? AND user = ?", (guild_id, user_id)) as cursor:
+        return (await cursor.fetchone())[0] != 0
+
+async def interpolated_get_replacement(conn, guild_id, user_id):
+    async with conn.execute(f'SELECT * FROM reps WHERE "server" = {guild_id} AND "user" = {user_id}') as cursor:
+        return await cursor.fetchall()
+
+async def bound_get_replacement(conn, guild_id, user_id):
+    async with conn.execute('SELECT * FROM reps WHERE "server" = ? AND "user" = ?', (guild_id, user_id)) as cursor:
+        return await cursor.fetchall()
+
+async def timeit(label, conn, func):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for user in range(USERS):
+            await func(conn, GUILD, user)
+    elapsed = time.perf_counter() - start
+    print(f'{label:36} {elapsed / (ROUNDS * USERS) * 1e6:8.1f} us/call')
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        await db.init_database()
+        for user in range(0, USERS, 10):
+            await db.add_replacement(GUILD, {'user': user, 'name': f'user{user}', 'in_timestamp': user})
+        async with db._reader() as conn:
+            await timeit('is_user_active interpolated', conn, interpolated_is_user_active)
+            await timeit('is_user_active bound', conn, bound_is_user_active)
+            await timeit('get_replacement interpolated', conn, interpolated_get_replacement)
+            await timeit('get_replacement bound', conn, bound_get_replacement)
+        await db.close_database()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+# get_users_hours_v2, per user loop (old behaviour) vs single GROUP BY aggregation
+# Run from the repository root: python -m perf.bench_users_hours
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import data.databaseapi as db
+from static.common import get_current_timestamp, SECS_IN_WEEK
+
+GUILD = 1000
+USERS = 200
+SIZES = [1000, 10000, 100000]
+
+async def legacy_get_user_hours_v2(guild_id, user):
+    user_historical = await db.get_historical_user(guild_id, user)
+    session = await db.get_session(guild_id)
+    in_tot = out_tot = bonus_in_tot = bonus_out_tot = 0
+    lifetime_in_tot = lifetime_out_tot = session_in_tot = session_out_tot = 0
+    latest_in = latest_out = urns = 0
+    for item in user_historical:
+        in_tot += item['in_timestamp']
+        out_tot += item['out_timestamp']
+        latest_in = max(latest_in, item['in_timestamp'])
+        latest_out = max(latest_out, item['out_timestamp'])
+        if "URN_ZERO_OUT_EVENT" in item['character']:
+            urns += 1
+        if "BONUS" in item['character']:
+            bonus_in_tot += item['in_timestamp']
+            bonus_out_tot += item['out_timestamp']
+        if item['in_timestamp'] < item['out_timestamp']:
+            lifetime_in_tot += item['in_timestamp']
+            lifetime_out_tot += item['out_timestamp']
+        if session and item['session'] == session['session'] and "BONUS" not in item['character']:
+            session_in_tot += item['in_timestamp']
+            session_out_tot += item['out_timestamp']
+    return {'user': user,
+            'total': db.get_hours_from_secs(int(out_tot - in_tot)),
+            'bonus_total': db.get_hours_from_secs(int(bonus_out_tot - bonus_in_tot)),
+            'lifetime_total': db.get_hours_from_secs(int(lifetime_out_tot - lifetime_in_tot)),
+            'session_total': db.get_hours_from_secs(int(session_out_tot - session_in_tot)),
+            'urns': urns, 'latest_in': latest_in, 'latest_out': latest_out}
+
+async def legacy_get_users_hours_v2(guild_id, users):
+    res = [await legacy_get_user_hours_v2(guild_id, user) for user in users]
+    return list(sorted(res, key= lambda user: user['total'], reverse=True))
+
+async def seed(rows):
+    await db.init_database()
+    now = get_current_timestamp()
+    await db.set_session(GUILD, {'session': 'bench', 'created_by': 1, 'ended_by': '', 'start_timestamp': now, 'end_timestamp': 0,
+                                 '_DEBUG_start': '', '_DEBUG_started_by': '', '_DEBUG_end': '', '_DEBUG_ended_by': '', '_DEBUG_delta': ''})
+    rng = random.Random(rows)
+    records = []
+    for idx in range(rows):
+        user = rng.randrange(USERS)
+        _in = now - rng.randrange(SECS_IN_WEEK * 8)
+        _out = _in + rng.randrange(1, 6 * 3600)
+        character = rng.choice(['', '', '', '50_PCT_BONUS_00:00_TO_06:00 1', 'URN_ZERO_OUT_EVENT -10'])
+        if character.startswith('URN'):
+            _in, _out = _out, _in
+        records.append((GUILD, user, character, rng.choice(['bench', 'old']), _in, _out, f'user{user}', '', '', ''))
+    async with db._writer() as conn:
+        await conn.executemany("INSERT INTO historical VALUES (?,?,?,?,?,?,?,?,?,?)", records)
+        await conn.commit()
+
+async def main():
+    for rows in SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            await seed(rows)
+            users = await db.get_unique_users(GUILD)
+            start = time.perf_counter()
+            legacy = await legacy_get_users_hours_v2(GUILD, users)
+            legacy_time = time.perf_counter() - start
+            start = time.perf_counter()
+            current = await db.get_users_hours_v2(GUILD, users)
+            current_time = time.perf_counter() - start
+            for old, new in zip(legacy, current):
+                assert all(old[key] == new[key] for key in old), (old, new)
+            print(f'{rows:7} rows  per user loop {legacy_time*1000:9.1f} ms  aggregate {current_time*1000:9.1f} ms')
+            await db.close_database()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+# Bonus hour windows compiled to second-of-day ranges
+# A window is compiled once per set of configured windows. Window bounds are turned into timestamps per
+# local day through the timezone (so they follow DST) and memoized, the overlap with a record is then
+# plain integer arithmetic. Windows whose end is before their start run past midnight into the next day.
+import datetime
+import functools
+from typing import NamedTuple
+
+import static.common as com
+
+class CompiledWindow(NamedTuple):
+    start: int
+    # Past a day when the window ends the next day
+    end: int
+    ratio: float
+    label: str
+
+def _second_of_day(t: datetime.time) -> int:
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+@functools.lru_cache(maxsize=256)
+def compile_windows(windows: tuple) -> tuple:
+    """Compiles config BonusWindows, the result is cached per distinct set of windows"""
+    compiled = []
+    for window in windows:
+        start = _second_of_day(window.start)
+        end = _second_of_day(window.end)
+        if end <= start:
+            end += com.SECS_IN_DAY
+        compiled.append(CompiledWindow(start, end, window.ratio, f'{window.pct}_PCT_BONUS_{window.start_iso}_TO_{window.end_iso}'))
+    return tuple(compiled)
+
+@functools.lru_cache(maxsize=16384)
+def local_timestamp(ordinal: int, second: int) -> int:
+    """Timestamp of a wall clock second on a local day, second may run past the end of the day"""
+    wall = datetime.datetime.combine(datetime.date.fromordinal(ordinal), datetime.time()) + datetime.timedelta(seconds=second)
+    return int(com.ny_tz.localize(wall).timestamp())
+
+def local_ordinal(timestamp) -> int:
+    return com.datetime_from_timestamp(timestamp).date().toordinal()
+
+def _bonus_record(record, row, window, start, duration) -> dict:
+    rec = dict(record)
+    rec.pop('rowid', None)
+    rec['character'] = f'{window.label} {row}'
+    rec['in_timestamp'] = start
+    rec['out_timestamp'] = start + duration
+    rec['_DEBUG_in'] = com.datetime_from_timestamp(start).isoformat()
+    rec['_DEBUG_out'] = com.datetime_from_timestamp(start + duration).isoformat()
+    rec['_DEBUG_delta'] = com.get_hours_from_secs(duration)
+    return rec
+
+def record_bonuses(windows: tuple, record, row) -> list[dict]:
+    """Bonus records earned by one historical record, windows as returned by compile_windows"""
+    _in = int(record['in_timestamp'])
+    _out = int(record['out_timestamp'])
+    if not windows or _out <= _in:
+        return []
+    first = local_ordinal(_in)
+    last = local_ordinal(_out)
+    bonuses = []
+    for window in windows:
+        # A window running past midnight can cover the start of the record from the day before
+        for day in range(first - (window.end > com.SECS_IN_DAY), last + 1):
+            start = max(_in, local_timestamp(day, window.start))
+            end = min(_out, local_timestamp(day, window.end))
+            if end <= start:
+                continue
+            bonuses.append(_bonus_record(record, row, window, start, int((end - start) * window.ratio)))
+    return bonuses
+
+def batch_bonuses(windows: tuple, records) -> list[dict]:
+    """Bonus records for many (record, row) pairs"""
+    bonuses = []
+    for record, row in records:
+        bonuses.extend(record_bonuses(windows, record, row))
+    return bonuses
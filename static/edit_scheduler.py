@@ -0,0 +1,174 @@
+# Outbound edit scheduler for the background loops
+# Loops declare the state a message or channel should have, the scheduler sends it when the route's
+# sliding window allows. A target only ever keeps its latest desired state, so a burst of declarations
+# becomes one edit. Guilds with an active session go first, DiscordServerError is retried with backoff.
+import asyncio
+import collections
+import itertools
+import time
+
+import discord
+
+import data.databaseapi as db
+import static.common as com
+
+# Route limits as (edits, per seconds), channel renames are limited to 2 per 10 minutes by discord
+ROUTE_LIMITS = {
+    'message': (5, 5),
+    'channel': (2, 10 * 60),
+}
+SEND_CONCURRENCY = 4
+MAX_ATTEMPTS = 5
+BACKOFF = 2
+
+# At most limit sends in any period seconds, the send times of the last limit sends are kept
+class SlidingWindow:
+    def __init__(self, limit, period):
+        self.period = period
+        self.sends = collections.deque(maxlen=limit)
+
+    # Seconds until another send is allowed, 0 if one is allowed now
+    def wait_time(self, now) -> float:
+        if len(self.sends) < self.sends.maxlen:
+            return 0
+        return max(0, self.sends[0] + self.period - now)
+
+    def take(self, now):
+        self.sends.append(now)
+
+class PendingEdit:
+    def __init__(self, target, guild_id, kind, kwargs, on_sent, seq):
+        self.target = target
+        self.guild_id = guild_id
+        self.kind = kind
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.seq = seq
+        self.attempts = 0
+        self.not_before = 0
+
+    @property
+    def route(self):
+        # Message edits are limited per channel, renames per renamed channel
+        if self.kind == 'message':
+            return ('message', self.target.channel.id)
+        return ('channel', self.target.id)
+
+class EditScheduler:
+    def __init__(self):
+        # (kind, target id) -> PendingEdit, latest desired state only
+        self.pending = {}
+        self.in_flight = set()
+        self.windows = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._worker = None
+        # In flight _send tasks, the loop only keeps weak references to tasks
+        self._tasks = set()
+        self._sends = asyncio.Semaphore(SEND_CONCURRENCY)
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+
+    def _window(self, route):
+        if route not in self.windows:
+            self.windows[route] = SlidingWindow(*ROUTE_LIMITS[route[0]])
+        return self.windows[route]
+
+    def submit(self, target, guild_id, on_sent=None, **kwargs):
+        """Declare the state target should have, target is a discord.Message or a guild channel"""
+        kind = 'message' if isinstance(target, discord.Message) else 'channel'
+        key = (kind, target.id)
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = PendingEdit(target, guild_id, kind, kwargs, on_sent, next(self._seq))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self._wake.set()
+
+    def cancel(self, target):
+        for kind in ('message', 'channel'):
+            self.pending.pop((kind, target.id), None)
+
+    async def close(self):
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _priority(self, item):
+        session = await db.get_session(item.guild_id)
+        return (0 if session else 1, item.seq)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            ready = []
+            next_at = None
+            for key, item in self.pending.items():
+                if key in self.in_flight:
+                    continue
+                at = max(item.not_before, now + self._window(item.route).wait_time(now))
+                if at <= now:
+                    ready.append((key, item))
+                elif next_at is None or at < next_at:
+                    next_at = at
+            if not ready:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=None if next_at is None else next_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            priorities = {key: await self._priority(item) for key, item in ready}
+            ready.sort(key=lambda pair: priorities[pair[0]])
+            routes_taken = set()
+            for key, item in ready:
+                # One send per route per pass, the next pass re-checks the window
+                if item.route in routes_taken:
+                    continue
+                routes_taken.add(item.route)
+                self._window(item.route).take(time.monotonic())
+                del self.pending[key]
+                self.in_flight.add(key)
+                await self._sends.acquire()
+                task = asyncio.create_task(self._send(key, item))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key, item):
+        try:
+            await item.target.edit(**item.kwargs)
+        except discord.errors.DiscordServerError as err:
+            item.attempts += 1
+            if key in self.pending:
+                # A newer declaration supersedes the failed one
+                self.retries += 1
+            elif item.attempts >= MAX_ATTEMPTS:
+                self.failed += 1
+                print(f'{com.get_current_iso()} [{item.guild_id}] - Giving up on {item.kind} edit {item.target.id} after {item.attempts} attempts, {err}', flush=True)
+            else:
+                self.retries += 1
+                item.not_before = time.monotonic() + BACKOFF * 2 ** (item.attempts - 1)
+                self.pending[key] = item
+        except discord.errors.HTTPException as err:
+            self.failed += 1
+            print(f'{com.get_current_iso()} [{item.guild_id}] - Failed {item.kind} edit {item.target.id}, {err}', flush=True)
+        else:
+            self.sent += 1
+            if item.on_sent:
+                item.on_sent()
+        finally:
+            self.in_flight.discard(key)
+            self._sends.release()
+            self._wake.set()
+
+    def stats(self) -> dict:
+        return {'pending': len(self.pending), 'in_flight': len(self.in_flight), 'sent': self.sent,
+                'coalesced': self.coalesced, 'retries': self.retries, 'failed': self.failed}
+
+scheduler = EditScheduler()
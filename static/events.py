@@ -0,0 +1,8 @@
+# Guild scoped change events, sent through the bot's own event dispatcher
+# Any cog can subscribe with
+#   @commands.Cog.listener()
+#   async def on_guild_state_change(self, guild_id, reason):
+GUILD_STATE_CHANGE = 'guild_state_change'
+
+def publish_guild_change(bot, guild_id, reason: str):
+    bot.dispatch(GUILD_STATE_CHANGE, int(guild_id), reason)
@@ -0,0 +1,59 @@
+# Per guild locks for the commands that change session, actives, reps or hours
+# A lock is created the first time its guild needs one and dropped again once nobody holds or waits
+# for it, so only guilds with a command in flight have one. Time spent waiting is recorded per lock
+# holder name so contention shows up in /dashboardstats and in the log when a wait is long.
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import static.common as com
+
+# Waits longer than this are logged, in seconds
+SLOW_WAIT = 1
+
+class KeyedLocks:
+    def __init__(self):
+        # key -> [lock, holders and waiters]
+        self._locks = {}
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        # name -> [acquired, contended, wait_total]
+        self.by_name = {}
+
+    @asynccontextmanager
+    async def hold(self, key, name=''):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            contended = entry[0].locked()
+            start = time.monotonic()
+            async with entry[0]:
+                self._record(key, name, contended, time.monotonic() - start)
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+    def _record(self, key, name, contended, waited):
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        counts = self.by_name.setdefault(name, [0, 0, 0])
+        counts[0] += 1
+        counts[2] += waited
+        if contended:
+            self.contended += 1
+            counts[1] += 1
+        if waited >= SLOW_WAIT:
+            print(f'{com.get_current_iso()} [{key}] - {name} waited {waited:.2f}s for the guild lock', flush=True)
+
+    def stats(self) -> dict:
+        return {'locks': len(self._locks), 'acquired': self.acquired, 'contended': self.contended,
+                'wait_avg': round(self.wait_total / self.acquired, 4) if self.acquired else 0, 'wait_max': round(self.wait_max, 4),
+                'by_name': {name: {'acquired': counts[0], 'contended': counts[1], 'wait_total': round(counts[2], 4)}
+                            for name, counts in self.by_name.items()}}
+
+guild_locks = KeyedLocks()
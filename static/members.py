@@ -0,0 +1,148 @@
+# Shared member directory, guild members indexed by id with a TTL
+# Misses are filled in batches through gateway member requests (up to 100 ids each) instead of one
+# fetch_member REST call per user. The bot runs without the members intent, so no member update or
+# remove events arrive and entries can trail role changes by up to MEMBER_TTL. Members that come with an
+# interaction replace their entry, so anyone using a command is current.
+# RoleResolver answers role lookups for the checks, from the interaction's member when there is one and
+# from the directory otherwise.
+import asyncio
+import time
+
+import discord
+
+MEMBER_TTL = 10 * 60
+# Users that could not be found are remembered for less time, they may just have rejoined
+MISSING_TTL = 60
+# Discord caps a member request by user ids at 100
+CHUNK_SIZE = 100
+CHUNK_TIMEOUT = 10
+
+class MemberDirectory:
+    def __init__(self, ttl=MEMBER_TTL, missing_ttl=MISSING_TTL):
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        # guild_id -> {user_id: (member or None, expires)}
+        self._guilds = {}
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def _lookup(self, guild_id, user_id):
+        entry = self._guilds.get(guild_id, {}).get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry
+        return None
+
+    def _store(self, guild_id, user_id, member):
+        ttl = self.ttl if member else self.missing_ttl
+        self._guilds.setdefault(guild_id, {})[user_id] = (member, time.monotonic() + ttl)
+
+    async def _request(self, guild, user_ids) -> dict:
+        found = {}
+        for idx in range(0, len(user_ids), CHUNK_SIZE):
+            chunk = user_ids[idx:idx + CHUNK_SIZE]
+            self.requests += 1
+            try:
+                members = await asyncio.wait_for(guild.query_members(user_ids=chunk, limit=len(chunk), cache=False), timeout=CHUNK_TIMEOUT)
+            except (asyncio.TimeoutError, discord.ClientException):
+                # Gateway request unavailable, fall back to REST for this chunk
+                members = []
+                for user_id in chunk:
+                    try:
+                        members.append(await guild.fetch_member(user_id))
+                    except discord.errors.NotFound:
+                        pass
+            for member in members:
+                found[member.id] = member
+        return found
+
+    async def fetch_many(self, guild, user_ids) -> dict:
+        """Members for the given ids as {user_id: member or None}, one batched request for every miss"""
+        res = {}
+        missing = []
+        for user_id in dict.fromkeys(int(user_id) for user_id in user_ids):
+            entry = self._lookup(guild.id, user_id)
+            if entry:
+                self.hits += 1
+                res[user_id] = entry[0]
+            else:
+                self.misses += 1
+                missing.append(user_id)
+        if missing:
+            found = await self._request(guild, missing)
+            for user_id in missing:
+                self._store(guild.id, user_id, found.get(user_id))
+                res[user_id] = found.get(user_id)
+        return res
+
+    async def fetch(self, guild, user_id):
+        """One member or None if they are not in the guild"""
+        return (await self.fetch_many(guild, [user_id]))[int(user_id)]
+
+    def cached(self, guild, user_id):
+        """Member from the directory or the gateway member cache without any request, None on a miss"""
+        user_id = int(user_id)
+        entry = self._lookup(guild.id, user_id)
+        if entry and entry[0]:
+            return entry[0]
+        member = guild.get_member(user_id)
+        if member:
+            self._store(guild.id, user_id, member)
+        return member
+
+    def store(self, guild, member):
+        self._store(guild.id, member.id, member)
+
+    def invalidate(self, guild_id, user_id=None):
+        if user_id is None:
+            self._guilds.pop(guild_id, None)
+            return
+        self._guilds.get(guild_id, {}).pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'members': sum(len(members) for members in self._guilds.values()), 'hits': self.hits, 'misses': self.misses,
+                'requests': self.requests, 'hit_ratio': round(self.hits / total, 4) if total else 0}
+
+directory = MemberDirectory()
+
+class RoleResolver:
+    """Role ids of a member for the permission checks, REST is only used when no cache has the member"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.checks = 0
+        self.payload = 0
+        self.cached = 0
+        self.rest = 0
+
+    async def role_ids(self, guild, member) -> set:
+        """member is the interaction's discord.Member when it has one, otherwise a user id"""
+        self.checks += 1
+        if isinstance(member, discord.Member):
+            self.payload += 1
+            self.directory.store(guild, member)
+            return {role.id for role in member.roles}
+        user_id = member
+        member = self.directory.cached(guild, user_id)
+        if member:
+            self.cached += 1
+        else:
+            self.rest += 1
+            try:
+                member = await guild.fetch_member(int(user_id))
+            except discord.errors.NotFound:
+                return set()
+            self.directory.store(guild, member)
+        return {role.id for role in member.roles}
+
+    def stats(self) -> dict:
+        return {'checks': self.checks, 'payload': self.payload, 'cached': self.cached, 'rest': self.rest,
+                'cached_ratio': round((self.payload + self.cached) / self.checks, 4) if self.checks else 0}
+
+roles = RoleResolver(directory)
+
+async def on_guild_remove(guild):
+    directory.invalidate(guild.id)
+
+def register(bot):
+    bot.add_listener(on_guild_remove)
@@ -0,0 +1,78 @@
+# Memoized channel visibility verdicts for is_member_visible
+# Whether every configured member role can read a channel and its history only changes when the channel,
+# a role or the guild config changes, so the verdict is kept per (channel, member role set) and the
+# guild's verdicts are dropped on any of those events.
+import discord
+
+from data.config import configs
+
+class VisibilityCache:
+    def __init__(self):
+        # guild_id -> {(channel_id, member role ids): bool}
+        self._guilds = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _required():
+        req_perms = discord.Permissions.none()
+        req_perms.update(read_messages = True)
+        req_perms.update(read_message_history = True)
+        return req_perms
+
+    def _compute(self, guild, channel, member_roles) -> bool:
+        req_perms = self._required()
+        for role in member_roles:
+            _role = guild.get_role(role)
+            if _role is None:
+                return False
+            if not channel.permissions_for(_role).is_superset(req_perms):
+                return False
+        return True
+
+    def visible(self, guild, channel, member_roles) -> bool:
+        """True if every member role can read the channel and its history"""
+        key = (channel.id, frozenset(member_roles))
+        verdicts = self._guilds.setdefault(guild.id, {})
+        if key in verdicts:
+            self.hits += 1
+            return verdicts[key]
+        self.misses += 1
+        verdicts[key] = self._compute(guild, channel, member_roles)
+        return verdicts[key]
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self._guilds.clear()
+            return
+        self._guilds.pop(guild_id, None)
+
+    def stats(self) -> dict:
+        return {'verdicts': sum(len(verdicts) for verdicts in self._guilds.values()), 'hits': self.hits, 'misses': self.misses}
+
+visibility = VisibilityCache()
+
+# Overwrites of synced channels follow their category and threads their parent, so any channel
+# change drops the whole guild rather than a single channel
+async def on_guild_channel_update(before, after):
+    visibility.invalidate(after.guild.id)
+
+async def on_guild_channel_delete(channel):
+    visibility.invalidate(channel.guild.id)
+
+async def on_guild_role_update(before, after):
+    visibility.invalidate(after.guild.id)
+
+async def on_guild_role_delete(role):
+    visibility.invalidate(role.guild.id)
+
+async def on_guild_remove(guild):
+    visibility.invalidate(guild.id)
+
+def register(bot):
+    bot.add_listener(on_guild_channel_update)
+    bot.add_listener(on_guild_channel_delete)
+    bot.add_listener(on_guild_role_update)
+    bot.add_listener(on_guild_role_delete)
+    bot.add_listener(on_guild_remove)
+    configs.add_listener(visibility.invalidate)